@@ -2,6 +2,7 @@
 from __future__ import print_function
 
 import os
+import re
 import shutil
 import sys
 import time
@@ -152,21 +153,452 @@ benchmark: $(OBJECTS)
     elapsed_time = get_time() - time0
     return elapsed_time
 
+def benchtrace():
+    """Time compiling the generated sources untraced, under strace as
+    StraceRunner used to run it (just -fo), and with the options it found
+    the installed strace supports. Prints seconds, overhead relative to the
+    untraced compiles and total strace log size."""
+    calls = fabricate.StraceRunner.get_strace_system_calls()
+    if calls is None:
+        print('strace is not available')
+        return
+    log = os.path.abspath(os.path.join(BUILD_DIR, 'strace.txt'))
+    trace = ['-fo', log, '-e', 'trace=' + calls]
+    modes = [('untraced', []),
+             ('strace', ['strace'] + trace),
+             ('options', ['strace'] + fabricate.StraceRunner.get_strace_options()
+                         + trace)]
+    print('options: %s' % ' '.join(modes[2][1][1:-len(trace)]))
+    print('%-10s %10s %10s %14s' % ('mode', 'seconds', 'overhead', 'log bytes'))
+    untraced = None
+    for mode, prefix in modes:
+        log_size = 0
+        time0 = get_time()
+        for index in range(NUM_SOURCE_FILES):
+            fabricate.shell(prefix, COMPILER, '-c', 'source%d.c' % index,
+                            cwd=BUILD_DIR)
+            if os.path.exists(log):
+                log_size += os.path.getsize(log)
+                os.remove(log)
+        elapsed_time = get_time() - time0
+        if untraced is None:
+            untraced = elapsed_time
+        print('%-10s %10.3f %9.2fx %14d' % (mode, elapsed_time,
+                                           elapsed_time / untraced, log_size))
+
+HASH_SIZES = [1024, 1024**2, 64*1024**2, 1024**3, 4*1024**3]
+
+def benchhash(max_size=None):
+    """Time md5_hasher against a whole-file read on files from 1 KB up to
+    max_size bytes (4 GB by default). Prints size, seconds, MB/s and peak
+    RSS growth for each."""
+    import resource
+    if not os.path.exists(BUILD_DIR):
+        os.mkdir(BUILD_DIR)
+    filename = os.path.join(BUILD_DIR, 'hashfile.bin')
+    block = os.urandom(1024*1024)
+
+    def whole_file(filename):
+        f = open(filename, 'rb')
+        try:
+            return fabricate.md5func(f.read()).hexdigest()
+        finally:
+            f.close()
+
+    print('%12s %-10s %10s %10s %12s' % ('size', 'hasher', 'seconds', 'MB/s', 'peak RSS +KB'))
+    try:
+        for size in HASH_SIZES:
+            if max_size is not None and size > max_size:
+                break
+            f = open(filename, 'wb')
+            written = 0
+            while written < size:
+                f.write(block[:size-written])
+                written += len(block[:size-written])
+            f.close()
+            # streaming hasher first: ru_maxrss only ever grows
+            for name, hasher in [('streaming', fabricate.md5_hasher),
+                                 ('read()', whole_file)]:
+                rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                time0 = get_time()
+                try:
+                    hasher(filename)
+                except MemoryError:
+                    print('%12d %-10s %10s' % (size, name, 'MemoryError'))
+                    continue
+                elapsed_time = get_time() - time0
+                rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                print('%12d %-10s %10.4f %10.1f %12d' % (
+                    size, name, elapsed_time,
+                    size / 1024.0**2 / max(elapsed_time, 1e-9), rss1 - rss0))
+    finally:
+        os.remove(filename)
+
+def benchhashmany(count=50000):
+    """Compare hashing count small header-sized files one call at a time
+    against one batched hash_many() call, for each hasher that has one."""
+    hashdir = os.path.join(BUILD_DIR, 'hashmany')
+    if not os.path.exists(hashdir):
+        os.makedirs(hashdir)
+    filenames = []
+    for index in range(count):
+        filename = os.path.join(hashdir, 'header%d.h' % index)
+        if not os.path.exists(filename):
+            f = open(filename, 'w')
+            f.write('typedef int type_%d;\n' % index * (index % 50 + 1))
+            f.close()
+        filenames.append(filename)
+
+    print('%-10s %12s %12s %8s' % ('hasher', 'per-file', 'hash_many', 'speedup'))
+    for name in sorted(fabricate.hashers):
+        hasher = fabricate.hashers[name]
+        if name == 'fast' or getattr(hasher, 'hash_many', None) is None:
+            continue
+        time0 = get_time()
+        single = dict((filename, hasher(filename)) for filename in filenames)
+        single_time = get_time() - time0
+        time0 = get_time()
+        batch = hasher.hash_many(filenames)
+        batch_time = get_time() - time0
+        assert single == batch
+        print('%-10s %11.3fs %11.3fs %7.2fx' % (
+            name, single_time, batch_time, single_time / max(batch_time, 1e-9)))
+    shutil.rmtree(hashdir)
+
+# (name, dependency file name) of each format benchdeps compares
+DEPS_FORMATS = [('json', '.deps'), ('sqlite', '.deps.sqlite'),
+                ('binary', '.deps.bin')]
+
+LOAD_DEPS = """
+import resource, sys, time
+import fabricate
+rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+time0 = time.time()
+deps = fabricate.open_deps(sys.argv[1])
+deps.load()
+elapsed_time = time.time() - time0
+time0 = time.time()
+entry = deps[sys.argv[2]]
+lookup_time = time.time() - time0
+rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print('%f %f %d %d' % (elapsed_time, lookup_time, rss1 - rss0, len(deps)))
+"""
+
+def benchdeps(commands=10000, headers=400, formats=None):
+    """Write a synthetic dependency database of commands compile commands,
+    each depending on the same headers headers, in each format (or those
+    named in the formats list). Prints
+    file size, the time to load it and then look up one entry in a fresh
+    process, and the peak RSS growth."""
+    import subprocess
+    depsdir = os.path.join(BUILD_DIR, 'deps')
+    if not os.path.exists(depsdir):
+        os.makedirs(depsdir)
+    deps_formats = [(name, filename) for name, filename in DEPS_FORMATS
+                    if formats is None or name in formats]
+    filenames = [os.path.join(depsdir, name) for _, name in deps_formats]
+    header_hashes = dict(('include/header%d.h' % index, 'input-%032x' % index)
+                         for index in range(headers))
+    command = 'gcc -c -Iinclude src/source%d.c -o obj/source%d.o'
+    deps = fabricate.open_deps(filenames[-1])
+    for index in range(commands):
+        entry = dict(header_hashes)
+        entry['src/source%d.c' % index] = 'input-%032x' % (headers + index)
+        entry['obj/source%d.o' % index] = 'output-%032x' % index
+        deps[command % (index, index)] = entry
+    deps.save(hasher='md5')
+    del deps
+    for filename in filenames[:-1]:
+        fabricate.convert_deps(filenames[-1], filename)
+
+    print('%-8s %14s %10s %10s %14s' % ('format', 'size', 'load', 'lookup',
+                                        'peak RSS +KB'))
+    middle = commands // 2
+    for (name, _), filename in zip(deps_formats, filenames):
+        output = subprocess.check_output(
+            [sys.executable, '-c', LOAD_DEPS, filename,
+             command % (middle, middle)],
+            cwd=os.path.dirname(os.path.abspath(fabricate.__file__)))
+        elapsed_time, lookup_time, rss, count = output.split()
+        assert int(count) == commands
+        print('%-8s %14d %9.3fs %9.5fs %14s' % (
+            name, os.path.getsize(filename), float(elapsed_time),
+            float(lookup_time), rss.decode()))
+    shutil.rmtree(depsdir)
+
+def write_strace_log(filename, compilers=200, include_dirs=20, headers=50):
+    """Write a synthetic strace -f log of a make-like driver running
+    compilers gcc/cc1 processes, each searching include_dirs include
+    directories (in BUILD_DIR) for headers headers before opening them.
+    Returns the number of lines written."""
+    lines = ['1 execve("/usr/bin/make", ["make"], 0x7ffd /* 30 vars */) = 0']
+    pid = 2
+    for compiler in range(compilers):
+        gcc, cc1 = pid, pid + 1
+        pid += 2
+        lines.append('1 clone(child_stack=NULL, flags=CLONE_CHILD_CLEARTID|'
+                     'SIGCHLD <unfinished ...>')
+        lines.append('%d execve("/usr/bin/gcc", ["gcc", "-c"], 0x7ffd '
+                     '/* 30 vars */) = 0' % gcc)
+        lines.append('1 <... clone resumed>, child_tidptr=0x7f00) = %d' % gcc)
+        lines.append('%d vfork() = %d' % (gcc, cc1))
+        lines.append('%d execve("/usr/lib/gcc/cc1", ["cc1"], 0x7ffd '
+                     '/* 30 vars */) = 0' % cc1)
+        lines.append('%d openat(AT_FDCWD, "src/source%d.c", O_RDONLY|'
+                     'O_NOCTTY) = 3' % (cc1, compiler))
+        for header in range(headers):
+            for directory in range(include_dirs):
+                lines.append('%d openat(AT_FDCWD, "include%d/header%d.h", '
+                             'O_RDONLY|O_NOCTTY) = -1 ENOENT (No such file '
+                             'or directory)' % (cc1, directory, header))
+            lines.append('%d stat("include/header%d.h", {st_mode=S_IFREG|'
+                         '0644, st_size=512, ...}) = 0' % (cc1, header))
+            lines.append('%d openat(AT_FDCWD, "include/header%d.h", O_RDONLY|'
+                         'O_NOCTTY) = 4' % (cc1, header))
+        lines.append('%d openat(AT_FDCWD, "obj/source%d.o", O_WRONLY|O_CREAT|'
+                     'O_TRUNC, 0666) = 3' % (cc1, compiler))
+        lines.append('%d exit_group(0) = ?' % cc1)
+        lines.append('%d +++ exited with 0 +++' % cc1)
+        lines.append('%d exit_group(0) = ?' % gcc)
+        lines.append('%d +++ exited with 0 +++' % gcc)
+    lines.append('1 exit_group(0) = ?')
+    f = open(filename, 'w')
+    f.write('\n'.join(lines) + '\n')
+    f.close()
+    return len(lines)
+
+class RegexStraceRunner(fabricate.StraceRunner):
+    """StraceRunner with the log parser it had before it parsed bytes in one
+    pass, matching every regular expression against each (text) line, kept
+    as a baseline for benchstrace."""
+
+    _open_re       = re.compile(r'(?P<pid>\d+)\s+open\("(?P<name>[^"]*)", (?P<mode>[^,)]*)')
+    _openat_re     = re.compile(r'(?P<pid>\d+)\s+openat\([^,]*, "(?P<name>[^"]*)", (?P<mode>[^,)]*)')
+    _stat_re       = re.compile(r'(?P<pid>\d+)\s+l?stat(?:64)?\("(?P<name>[^"]*)", .*') # stat,lstat,stat64,lstat64
+    _execve_re     = re.compile(r'(?P<pid>\d+)\s+execve\("(?P<name>[^"]*)", .*')
+    _creat_re      = re.compile(r'(?P<pid>\d+)\s+creat\("(?P<name>[^"]*)", .*')
+    _mkdir_re      = re.compile(r'(?P<pid>\d+)\s+mkdir\("(?P<name>[^"]*)", .*\)\s*=\s(?P<result>-?[0-9]*).*')
+    _rename_re     = re.compile(r'(?P<pid>\d+)\s+rename\("[^"]*", "(?P<name>[^"]*)"\)')
+    _symlink_re    = re.compile(r'(?P<pid>\d+)\s+symlink\("[^"]*", "(?P<name>[^"]*)"\)')
+    _kill_re       = re.compile(r'(?P<pid>\d+)\s+killed by.*')
+    _chdir_re      = re.compile(r'(?P<pid>\d+)\s+chdir\("(?P<cwd>[^"]*)"\)')
+    _exit_group_re = re.compile(r'(?P<pid>\d+)\s+exit_group\((?P<status>.*)\).*')
+    _clone_re      = re.compile(r'(?P<pid_clone>\d+)\s+(clone|fork|vfork)\(.*\)\s*=\s*(?P<pid>\d*)')
+
+    _unfinished_start_re = re.compile(r'(?P<pid>\d+)(?P<body>.*)<unfinished ...>$')
+    _unfinished_end_re   = re.compile(r'(?P<pid>\d+)\s+\<\.\.\..*\>(?P<body>.*)')
+
+    def _parse(self, lines):
+        self.status = 0
+        processes  = {}
+        unfinished = {}
+        for line in lines:
+           self._match_line(line, processes, unfinished)
+
+        deps = set()
+        outputs = set()
+        for pid, process in processes.items():
+            deps = deps.union(process.deps)
+            outputs = outputs.union(process.outputs)
+
+        return self.status, list(deps), list(outputs)
+
+    def _match_line(self, line, processes, unfinished):
+        unfinished_start_match = self._unfinished_start_re.match(line)
+        unfinished_end_match = self._unfinished_end_re.match(line)
+        if unfinished_start_match:
+            pid = unfinished_start_match.group('pid')
+            body = unfinished_start_match.group('body')
+            unfinished[pid] = pid + ' ' + body
+            return
+        elif unfinished_end_match:
+            pid = unfinished_end_match.group('pid')
+            body = unfinished_end_match.group('body')
+            if pid not in unfinished:
+                return
+            line = unfinished[pid] + body
+            del unfinished[pid]
+
+        is_output = False
+        open_match = self._open_re.match(line)
+        openat_match = self._openat_re.match(line)
+        stat_match = self._stat_re.match(line)
+        execve_match = self._execve_re.match(line)
+        creat_match = self._creat_re.match(line)
+        mkdir_match = self._mkdir_re.match(line)
+        symlink_match = self._symlink_re.match(line)
+        rename_match = self._rename_re.match(line)
+        clone_match = self._clone_re.match(line)
+
+        kill_match = self._kill_re.match(line)
+        if kill_match:
+            return None, None, None
+
+        match = None
+        if execve_match:
+            pid = execve_match.group('pid')
+            match = execve_match
+            if pid not in processes and len(processes) == 0:
+                processes[pid] = fabricate.StraceProcess()
+        elif clone_match:
+            pid = clone_match.group('pid')
+            pid_clone = clone_match.group('pid_clone')
+            if pid not in processes:
+                processes[pid] = fabricate.StraceProcess(processes[pid_clone].cwd)
+            else:
+                processes[pid].cwd = processes[pid_clone].cwd
+                processes[pid].delayed = False
+                for delayed_line in processes[pid].delayed_lines:
+                    self._match_line(delayed_line, processes, unfinished)
+                processes[pid].delayed_lines = []
+        elif open_match:
+            match = open_match
+            mode = match.group('mode')
+            if 'O_WRONLY' in mode or 'O_RDWR' in mode:
+                is_output = True
+        elif openat_match:
+            match = openat_match
+            mode = match.group('mode')
+            if 'O_WRONLY' in mode or 'O_RDWR' in mode:
+                is_output = True
+        elif stat_match:
+            match = stat_match
+        elif creat_match:
+            match = creat_match
+            is_output = True
+        elif mkdir_match:
+            match = mkdir_match
+            if match.group('result') == '0':
+                is_output = True
+        elif symlink_match:
+            match =  symlink_match
+            is_output = True
+        elif rename_match:
+            match = rename_match
+            is_output = True
+
+        if match:
+            name = match.group('name')
+            pid  = match.group('pid')
+            if not self._matching_is_delayed(processes, pid, line):
+                cwd = processes[pid].cwd
+                if cwd != '.':
+                    name = os.path.join(cwd, name)
+                name = os.path.normpath(name)
+                if os.path.isabs(name) and name.startswith(self.build_dir):
+                    name = name[len(self.build_dir):]
+                    name = name.lstrip(os.path.sep)
+
+                toolchain = not is_output and self._builder._toolchain_dep(name)
+                if toolchain:
+                    processes[pid].add_dep(toolchain)
+                elif (self._builder._is_relevant(name)
+                      and not self.ignore(name)
+                      and os.path.lexists(name)):
+                    if is_output:
+                        processes[pid].add_output(name)
+                    else:
+                        processes[pid].add_dep(name)
+
+        match = self._chdir_re.match(line)
+        if match:
+            pid  = match.group('pid')
+            if not self._matching_is_delayed(processes, pid, line):
+                processes[pid].cwd = os.path.join(processes[pid].cwd, match.group('cwd'))
+
+        match = self._exit_group_re.match(line)
+        if match:
+            self.status = int(match.group('status'))
+
+def benchstrace(trace=None, compilers=200):
+    """Time StraceRunner's log parser on the strace log file trace (eg: one
+    kept by running a build with --keep, parsed relative to the current
+    directory), or on a synthetic log of compilers compiles, against the
+    regex parser of RegexStraceRunner. Prints the number of lines and
+    dependencies found, seconds and lines/s for each."""
+    orig_cwd = os.getcwd()
+    stracedir = os.path.abspath(os.path.join(BUILD_DIR, 'strace'))
+    if trace is None:
+        for subdir in ['src', 'include', 'obj']:
+            if not os.path.exists(os.path.join(stracedir, subdir)):
+                os.makedirs(os.path.join(stracedir, subdir))
+        for name in (['src/source%d.c' % index for index in range(compilers)] +
+                     ['include/header%d.h' % index for index in range(50)] +
+                     ['obj/source%d.o' % index for index in range(compilers)]):
+            open(os.path.join(stracedir, name), 'w').close()
+        trace = os.path.join(stracedir, 'strace.txt')
+        write_strace_log(trace, compilers)
+        os.chdir(stracedir)
+    results = []
+    try:
+        builder = fabricate.Builder(runner='always_runner')
+        # the old parser reads text lines, the current one bytes
+        for name, runner_class, mode in [('regex', RegexStraceRunner, 'r'),
+                                         ('strace', fabricate.StraceRunner, 'rb')]:
+            # parse without needing strace installed
+            runner = runner_class.__new__(runner_class)
+            runner._builder = builder
+            runner.build_dir = os.getcwd()
+            runner._path_caches = {}
+            f = open(trace, mode)
+            try:
+                lines = sum(1 for line in f)
+                f.seek(0)
+                time0 = get_time()
+                status, deps, outputs = runner._parse(f)
+                elapsed_time = get_time() - time0
+            finally:
+                f.close()
+            results.append((name, lines, len(deps), len(outputs), elapsed_time))
+    finally:
+        os.chdir(orig_cwd)
+        if os.path.exists(stracedir):
+            shutil.rmtree(stracedir)
+    print('%-8s %10s %8s %8s %10s %12s' % ('parser', 'lines', 'deps', 'outputs',
+                                           'seconds', 'lines/s'))
+    for name, lines, deps, outputs, elapsed_time in results:
+        print('%-8s %10d %8d %8d %10.3f %12d' % (name, lines, deps, outputs,
+                                                 elapsed_time,
+                                                 lines / max(elapsed_time, 1e-9)))
+
 def clean():
     if os.path.exists(BUILD_DIR):
         shutil.rmtree(BUILD_DIR)
 
 def usage():
-    print('Usage: benchmark.py compiler generate|benchmark [runner=smart_runner [jobs=1]]|benchmake [jobs=1]|clean')
+    print('Usage: benchmark.py compiler generate|benchmark [runner=smart_runner [jobs=1]]|benchmake [jobs=1]|benchtrace|clean')
+    print('       benchmark.py benchhash [max_size_bytes=4G]')
+    print('       benchmark.py benchhashmany [files=50000]')
+    print('       benchmark.py benchdeps [commands=10000 [headers=400 [format,...]]]')
+    print('       benchmark.py benchstrace [strace_log|compiles=200]')
     sys.exit(1)
 
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
+    if len(sys.argv) < 3 and sys.argv[1:] not in (['benchhash'], ['benchhashmany'], ['benchdeps'],
+                                               ['benchstrace']):
         usage()
     orig_cwd = os.getcwd()
-    os.chdir(os.path.dirname(__file__))
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
     jobs = 1
     try:
+        if sys.argv[1] == 'benchhash':
+            benchhash(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+            sys.exit(0)
+        if sys.argv[1] == 'benchhashmany':
+            benchhashmany(int(sys.argv[2]) if len(sys.argv) > 2 else 50000)
+            sys.exit(0)
+        if sys.argv[1] == 'benchdeps':
+            benchdeps(*[int(arg) for arg in sys.argv[2:4]],
+                      formats=sys.argv[4].split(',') if len(sys.argv) > 4 else None)
+            sys.exit(0)
+        if sys.argv[1] == 'benchstrace':
+            arg = sys.argv[2] if len(sys.argv) > 2 else '200'
+            if arg.isdigit():
+                benchstrace(compilers=int(arg))
+            else:
+                os.chdir(orig_cwd)
+                benchstrace(arg)
+            sys.exit(0)
         COMPILER = sys.argv[1]
         if sys.argv[2] == 'generate':
             generate()
@@ -182,6 +614,8 @@ if __name__ == '__main__':
             if len(sys.argv) > 3:
                 jobs = int(sys.argv[3])
             print(benchmake(jobs))
+        elif sys.argv[2] == 'benchtrace':
+            benchtrace()
         elif sys.argv[2] == 'clean':
             clean()
         else:
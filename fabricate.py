@@ -29,21 +29,46 @@ __version__ = '1.29.3'
 deps_version = 2
 
 import atexit
+import binascii
+import itertools
+import mmap
 import optparse
 import os
 import platform
 import re
 import shlex
 import stat
+import struct
 import subprocess
 import sys
 import tempfile
 import time
 import threading # NB uses old camelCase names for backward compatibility
 import traceback
+import zlib
+from array import array
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
+# sqlite3 may not be built into Python, only needed for SqliteDeps
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+# for locking files shared between builds
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
 # multiprocessing module only exists on Python >= 2.6
 try:
     import multiprocessing
+    import multiprocessing.dummy
 except ImportError:
     class MultiprocessingModule(object):
         def __getattr__(self, name):
@@ -65,7 +90,10 @@ except (ImportError, AttributeError):
 # so you can do "from fabricate import *" to simplify your build script
 __all__ = ['setup', 'run', 'autoclean', 'main', 'shell', 'fabricate_version',
            'memoize', 'outofdate', 'parse_options', 'after',
-           'ExecutionError', 'md5_hasher', 'mtime_hasher',
+           'ExecutionError', 'md5_hasher', 'mtime_hasher', 'hybrid_hasher',
+           'blake2b_hasher', 'MerkleHasher', 'StatCache',
+           'HashCache', 'toolchain_fingerprint', 'JsonDeps', 'BinaryDeps',
+           'SqliteDeps', 'ShardedDeps', 'open_deps', 'convert_deps',
            'Runner', 'AtimesRunner', 'StraceRunner', 'AlwaysRunner',
            'SmartRunner', 'Builder']
 
@@ -97,6 +125,7 @@ try:
 except ImportError:
     import md5
     md5func = md5.new
+    hashlib = None
 
 # Use json, or pickle on older Python versions if simplejson not installed
 try:
@@ -118,6 +147,99 @@ def printerr(message):
     """ Print given message to stderr with a line feed. """
     print(message, file=sys.stderr)
 
+def _fsync_dir(dirname):
+    """ Make a new or renamed directory entry in dirname durable, where the
+        OS supports syncing directories. """
+    try:
+        fd = os.open(dirname or '.', os.O_RDONLY)
+    except OSError:
+        return                  # eg: Windows can't open directories
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _atomic_write(filename, write, mode='w'):
+    """ Write filename by calling write(f) on a temporary file next to it,
+        syncing that to disk and renaming it over filename, so a crash or
+        kill leaves either the old file or the new one but never a
+        partially written one. """
+    temp_name = '%s.%d.tmp' % (filename, os.getpid())
+    f = open(temp_name, mode)
+    try:
+        try:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        if hasattr(os, 'replace'):
+            os.replace(temp_name, filename)
+        else:
+            # no atomic replace on Windows before Python 3.3
+            if platform.system() == 'Windows' and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(temp_name, filename)
+    except:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+    _fsync_dir(os.path.dirname(filename))
+
+class _FileLock(object):
+    """ An exclusive lock between processes (and threads) using lock file
+        filename, held in a with statement, which may be nested. The lock is
+        advisory, and does nothing on an OS with neither flock() nor
+        msvcrt.locking(). """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.fd = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            if self.depth == 0:
+                if self.fd is None:
+                    self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT,
+                                      0o666)
+                if fcntl is not None:
+                    fcntl.flock(self.fd, fcntl.LOCK_EX)
+                elif msvcrt is not None:
+                    os.lseek(self.fd, 0, 0)
+                    while True:
+                        try:
+                            msvcrt.locking(self.fd, msvcrt.LK_LOCK, 1)
+                            break
+                        except (IOError, OSError):
+                            pass    # LK_LOCK gives up after 10 seconds
+        except:
+            self.lock.release()
+            raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                os.lseek(self.fd, 0, 0)
+                msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+        self.lock.release()
+
+    def close(self):
+        """ Close the lock file, unless the lock is held. """
+        with self.lock:
+            if self.fd is not None and self.depth == 0:
+                os.close(self.fd)
+                self.fd = None
+
 class PathError(Exception):
     pass
 
@@ -207,32 +329,143 @@ def _shell(args, input=None, silent=True, shell=False, ignore_status=False, **kw
     if silent:
         return output
 
-def md5_hasher(filename):
-    """ Return MD5 hash of given filename if it is a regular file or
-        a symlink with a hashable target, or the MD5 hash of the
-        target_filename if it is a symlink without a hashable target,
-        or the MD5 hash of the filename if it is a directory, or None
-        if file doesn't exist.
-
-        Note: Pyhton versions before 3.2 do not support os.readlink on
-        Windows so symlinks without a hashable target fall back to
-        a hash of the filename if the symlink target is a directory,
-        or None if the symlink is broken"""
+# files are hashed in chunks of this many bytes so memory use stays flat
+hash_chunk_size = 1024*1024
+# files at least this big are hashed through an mmap instead of read() calls
+hash_mmap_threshold = 64*1024*1024
+
+def _hash_file(hashobj, f):
+    """ Feed the contents of open binary file f into hashobj without ever
+        holding more than hash_chunk_size bytes of it in memory, and return
+        hashobj. Large files are mapped rather than read so their pages come
+        straight from the page cache and can be dropped again by the OS. """
+    size = os.fstat(f.fileno()).st_size
+    if size >= hash_mmap_threshold:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError, OverflowError):
+            pass                # can't map (eg: 32-bit address space)
+        else:
+            try:
+                # madvise() only exists on Python >= 3.8; where it does, drop
+                # each window from our mapping once it's been hashed
+                advise = getattr(m, 'madvise', None)
+                if advise is not None:
+                    advise(mmap.MADV_SEQUENTIAL)
+                for offset in range(0, len(m), hash_chunk_size):
+                    hashobj.update(m[offset:offset+hash_chunk_size])
+                    if advise is not None:
+                        advise(mmap.MADV_DONTNEED, offset,
+                               min(hash_chunk_size, len(m) - offset))
+            finally:
+                m.close()
+            return hashobj
+    while True:
+        chunk = f.read(hash_chunk_size)
+        if not chunk:
+            break
+        hashobj.update(chunk)
+    return hashobj
+
+def _content_hasher(filename, new_hash):
+    """ Helper for md5_hasher() and the other content hashers: return the hex
+        digest of filename's contents (or symlink target or directory name)
+        using hash objects created by new_hash(). """
     if not isinstance(filename, bytes):
         filename = filename.encode('utf-8')
     try:
         f = open(filename, 'rb')
         try:
-            return md5func(f.read()).hexdigest()
+            return _hash_file(new_hash(), f).hexdigest()
         finally:
             f.close()
     except IOError:
         if hasattr(os, 'readlink') and os.path.islink(filename):
-            return md5func(os.readlink(filename)).hexdigest()
+            hashobj = new_hash()
+            hashobj.update(os.readlink(filename))
+            return hashobj.hexdigest()
         elif os.path.isdir(filename):
-            return md5func(filename).hexdigest()
+            hashobj = new_hash()
+            hashobj.update(filename)
+            return hashobj.hexdigest()
         return None
 
+def _content_hash_many(filenames, new_hash):
+    """ Batch version of _content_hasher(): return a dict of filename -> hash
+        for each of filenames. Small regular files are read with a single
+        os.read() on a raw descriptor rather than through a file object,
+        which is most of the per-file overhead when hashing lots of headers;
+        everything else goes through _content_hasher(). """
+    hashes = {}
+    flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+    for filename in filenames:
+        try:
+            fd = os.open(filename, flags)
+        except OSError:
+            hashes[filename] = _content_hasher(filename, new_hash)
+            continue
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode) or st.st_size > hash_chunk_size:
+                hashed = None
+            else:
+                hashobj = new_hash()
+                while True:
+                    chunk = os.read(fd, hash_chunk_size)
+                    if not chunk:
+                        break
+                    hashobj.update(chunk)
+                hashed = hashobj.hexdigest()
+        finally:
+            os.close(fd)
+        if hashed is None:
+            hashed = _content_hasher(filename, new_hash)
+        hashes[filename] = hashed
+    return hashes
+
+def md5_hasher(filename):
+    """ Return MD5 hash of given filename if it is a regular file or
+        a symlink with a hashable target, or the MD5 hash of the
+        target_filename if it is a symlink without a hashable target,
+        or the MD5 hash of the filename if it is a directory, or None
+        if file doesn't exist.
+
+        Note: Pyhton versions before 3.2 do not support os.readlink on
+        Windows so symlinks without a hashable target fall back to
+        a hash of the filename if the symlink target is a directory,
+        or None if the symlink is broken"""
+    return _content_hasher(filename, md5func)
+md5_hasher.hash_many = lambda filenames: _content_hash_many(filenames, md5func)
+
+def _blake2b_func():
+    return hashlib.blake2b(digest_size=16)
+
+def blake2b_hasher(filename):
+    """ Like md5_hasher(), but using BLAKE2b (with a 128-bit digest), which
+        is considerably faster than MD5 on 64-bit machines. Only available
+        on Python >= 3.6. """
+    return _content_hasher(filename, _blake2b_func)
+blake2b_hasher.hash_many = \
+    lambda filenames: _content_hash_many(filenames, _blake2b_func)
+
+# xxHash is faster still, but only if the third-party xxhash module is installed
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+else:
+    xxhash_name = 'xxh3_128' if hasattr(xxhash, 'xxh3_128') else 'xxh64'
+    xxhash_func = getattr(xxhash, xxhash_name)
+
+    def xxhash_hasher(filename):
+        """ Like md5_hasher(), but using xxHash (XXH3-128 or XXH64, depending
+            on the installed xxhash module's version). Only defined if the
+            xxhash module is installed. """
+        return _content_hasher(filename, xxhash_func)
+    xxhash_hasher.hash_many = \
+        lambda filenames: _content_hash_many(filenames, xxhash_func)
+    __all__.append('xxhash_hasher')
+
 def mtime_hasher(filename):
     """ Return modification time of file, or None if file doesn't exist. """
     try:
@@ -240,6 +473,488 @@ def mtime_hasher(filename):
         return repr(st.st_mtime)
     except (IOError, OSError):
         return None
+mtime_hasher.hash_many = \
+    lambda filenames: dict((f, mtime_hasher(f)) for f in filenames)
+
+def hybrid_hasher(filename):
+    """ Return the same MD5 hash as md5_hasher(), but when used as a Builder's
+        hasher (-s on the command line), the builder keeps a persistent
+        StatCache so that a file is only re-read when its size, inode or
+        nanosecond mtime/ctime have changed. So it's nearly as fast as
+        mtime_hasher, but touching a file or checking out identical content
+        doesn't cause a rebuild. """
+    return md5_hasher(filename)
+hybrid_hasher.hash_many = md5_hasher.hash_many
+
+def hash_many(hasher, filenames):
+    """ Return a dict of filename -> hasher(filename) for each of filenames.
+        Hashers may provide a hash_many(filenames) function attribute that
+        returns the same dict but amortises per-file overhead (or hands the
+        whole list to a native or kernel implementation); it's used if
+        present. """
+    batch = getattr(hasher, 'hash_many', None)
+    if batch is not None:
+        return batch(filenames)
+    return dict((filename, hasher(filename)) for filename in filenames)
+
+# Hashers selectable by name, eg: Builder(hasher='blake2b') or --hasher=blake2b.
+# Each name is also the tag written to .deps files, so hashes made by one
+# hasher are never compared against hashes made by another.
+hashers = {
+    'md5': md5_hasher,
+    'mtime': mtime_hasher,
+    'hybrid': hybrid_hasher,
+}
+# hashers whose hashes are identical to another's, so share its tag
+_same_hashes = {'hybrid': 'md5'}
+# 'fast' selects the fastest hasher available, down to plain MD5
+hashers['fast'] = md5_hasher
+if hasattr(hashlib, 'blake2b'):
+    hashers['blake2b'] = hashers['fast'] = blake2b_hasher
+if xxhash is not None:
+    hashers[xxhash_name] = hashers['xxhash'] = hashers['fast'] = xxhash_hasher
+    _same_hashes['xxhash'] = xxhash_name
+
+def get_hasher(hasher):
+    """ Return the hasher function named by hasher, or hasher itself if it
+        isn't a string. """
+    if isinstance(hasher, string_types):
+        try:
+            return hashers[hasher]
+        except KeyError:
+            raise ValueError('unknown hasher %r, choose from: %s'
+                             % (hasher, ', '.join(sorted(hashers))))
+    return hasher
+
+def hasher_name(hasher):
+    """ Return the name hasher's hashes are tagged with in the .deps file:
+        its name in the hashers dict if it's there, else its __name__. """
+    for name, func in sorted(hashers.items()):
+        if func is hasher and name != 'fast':
+            return _same_hashes.get(name, name)
+    return getattr(hasher, '__name__', repr(hasher))
+
+def _stat_signature(st):
+    """ Return [st_dev, st_ino, st_size, st_mtime_ns, st_ctime_ns] for the
+        given os.stat() result. Falls back to float times scaled to
+        nanoseconds on Python versions without st_mtime_ns. """
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    ctime_ns = getattr(st, 'st_ctime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+        ctime_ns = int(st.st_ctime * 1e9)
+    return [st.st_dev, st.st_ino, st.st_size, mtime_ns, ctime_ns]
+
+# A file modified less than this many seconds before it was hashed could be
+# modified again without its timestamp changing (like git's "racy" index
+# entries), so its stat signature isn't trusted until it's a bit older.
+stat_racy_window = FAT_mtime_resolution
+
+# if version of stat cache file has changed, we know to not use it
+stat_cache_version = 1
+
+# stat cache file name -> (its stat signature, its entries) in a parallel
+# worker process, so each job doesn't read the whole file again
+_worker_stat_entries = {}
+
+class StatCache(object):
+    """ Persistent cache of file hashes keyed by each file's stat signature,
+        so that a file that hasn't changed since it was last hashed costs a
+        single os.lstat() instead of a full read.
+
+        "filename" is where the cache is saved between builds (None to keep
+        it in memory only) and "tag" names the hasher whose hashes it holds;
+        a cache file saved with a different tag is ignored. It's thread
+        safe: its entries are loaded, looked up and updated with self.lock
+        held, but files are hashed without it.
+
+        A StatCache pickled for a parallel worker is read only: the worker
+        loads the cache file itself (once per worker process) rather than
+        having every entry pickled for each job, and never saves it. """
+
+    def __init__(self, filename=None, tag=None):
+        self.filename = filename
+        self.tag = tag
+        self.entries = None
+        self.read_only = False
+        self._save_registered = False
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['entries'] = None
+        state['read_only'] = True
+        del state['lock']       # locks can't be pickled
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def hash(self, filename, hasher):
+        """ Return hasher(filename), skipping the hasher if filename is a
+            regular file whose stat signature matches a trusted entry. """
+        return self.hash_many([filename], hasher)[filename]
+
+    def hash_many(self, filenames, hasher):
+        """ Return a dict of filename -> hash like hash(), with the files
+            that do need hashing passed to the hasher in one batch. """
+        stats = []
+        for filename in filenames:
+            try:
+                stats.append((filename, os.lstat(filename)))
+            except OSError:
+                stats.append((filename, None))
+        hashes = {}
+        signatures = {}
+        todo = []
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            for filename, st in stats:
+                if st is None:
+                    self.entries.pop(filename, None)
+                    todo.append(filename)
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    # only trust signatures of plain files, not symlinks or dirs
+                    todo.append(filename)
+                    continue
+                signature = _stat_signature(st)
+                entry = self.entries.get(filename)
+                if entry is not None and entry[0] == signature:
+                    hashes[filename] = entry[1]
+                else:
+                    signatures[filename] = signature
+                    todo.append(filename)
+        if todo:
+            now = time.time()
+            hashes.update(hash_many(hasher, todo))
+            with self.lock:
+                for filename, signature in signatures.items():
+                    hashed = hashes[filename]
+                    if hashed is not None and signature[3] < (now - stat_racy_window) * 1e9:
+                        self.entries[filename] = [signature, hashed]
+                    else:
+                        self.entries.pop(filename, None)
+        return hashes
+
+    def load(self):
+        """ Load cache entries from self.filename, if it's a valid cache. """
+        with self.lock:
+            self._load()
+
+    def _load(self):
+        """ Like load(), called with the lock held. """
+        self.entries = {}
+        if self.filename is None:
+            return
+        if self.read_only:
+            try:
+                signature = _stat_signature(os.stat(self.filename))
+            except OSError:
+                return
+            loaded = _worker_stat_entries.get(self.filename)
+            if loaded is not None and loaded[0] == [signature, self.tag]:
+                self.entries = loaded[1]
+                return
+        elif not self._save_registered:
+            atexit.register(self.save)
+            self._save_registered = True
+        try:
+            f = open(self.filename)
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return
+        if isinstance(data, dict) and \
+           data.get('version') == stat_cache_version and \
+           data.get('hasher') == self.tag:
+            self.entries = data.get('entries', {})
+        if self.read_only:
+            _worker_stat_entries[self.filename] = ([signature, self.tag],
+                                                   self.entries)
+
+    def save(self):
+        """ Save cache entries to self.filename, unless it's read only. """
+        with self.lock:
+            if self.entries is None or self.filename is None or \
+               self.read_only:
+                return
+            data = {'version': stat_cache_version, 'hasher': self.tag,
+                    'entries': self.entries}
+            _atomic_write(self.filename, lambda f: json.dump(data, f))
+
+class MerkleHasher(object):
+    """ Hasher that hashes a directory by its contents rather than its name:
+        each directory's hash covers the names, types and hashes of its
+        entries, recursively (a Merkle tree), so it changes when anything in
+        the tree does. Files (and symlinks, which aren't followed) are hashed
+        with the given content "hasher" via a StatCache, and each directory's
+        listing and hash are kept keyed by its stat signature, so re-hashing
+        a large tree after a change deep inside it only lists directories
+        that gained or lost entries, only reads files whose signature
+        changed, and only recomputes the hashes on the path up to the root.
+
+        "cache" is the StatCache to use for files; a Builder with a stat
+        cache (eg: hasher='merkle' with -s) shares its own, otherwise an
+        in-memory one is used. """
+
+    def __init__(self, hasher=md5_hasher, cache=None):
+        self.hasher = get_hasher(hasher)
+        self.cache = cache
+        self._memory_cache = StatCache()
+        self.dirs = {}
+        if self.hasher is md5_hasher:
+            self.__name__ = 'merkle'
+        else:
+            self.__name__ = 'merkle_' + hasher_name(self.hasher)
+
+    def __getstate__(self):
+        # nor are directories' listings and hashes sent to parallel workers
+        state = self.__dict__.copy()
+        state['dirs'] = {}
+        return state
+
+    def __call__(self, filename):
+        return self.hash_many([filename])[filename]
+
+    def hash_many(self, filenames):
+        hashes = {}
+        files = []
+        for filename in filenames:
+            try:
+                st = os.lstat(filename)
+            except OSError:
+                st = None
+            if st is not None and stat.S_ISDIR(st.st_mode):
+                hashes[filename] = self._hash_dir(filename, st)
+            else:
+                files.append(filename)
+        hashes.update((self.cache or self._memory_cache).hash_many(files, self.hasher))
+        return hashes
+
+    def _hash_dir(self, path, st):
+        """ Return the Merkle hash of directory path, whose lstat is st, or
+            None if it can't be listed (eg: it was deleted or is unreadable).
+        """
+        signature = _stat_signature(st)
+        entry = self.dirs.get(path)
+        if entry is not None and entry[0] == signature:
+            names = entry[1]
+        else:
+            try:
+                names = sorted(os.listdir(path))
+            except OSError:
+                self.dirs.pop(path, None)
+                return None
+        children = []
+        files = []
+        for name in names:
+            child = os.path.join(path, name)
+            try:
+                child_st = os.lstat(child)
+            except OSError:
+                continue        # deleted while we were looking
+            if stat.S_ISDIR(child_st.st_mode):
+                children.append(('d', name, self._hash_dir(child, child_st)))
+            else:
+                files.append(child)
+        hashes = (self.cache or self._memory_cache).hash_many(files, self.hasher)
+        for child in files:
+            children.append(('f', os.path.basename(child), hashes[child]))
+        children.sort()
+        if entry is not None and entry[2] == children:
+            hashed = entry[3]
+        else:
+            hashobj = md5func()
+            for kind, name, hashed in children:
+                line = '%s %s %s\n' % (kind, name, hashed)
+                hashobj.update(line.encode('utf-8', 'replace'))
+            hashed = hashobj.hexdigest()
+        if signature[3] < (time.time() - stat_racy_window) * 1e9:
+            self.dirs[path] = [signature, names, children, hashed]
+        else:
+            # listing may change without changing the signature, see StatCache
+            self.dirs[path] = [None, names, children, hashed]
+        return hashed
+
+hashers['merkle'] = MerkleHasher()
+
+# prefix of the pseudo-dependencies that stand for a whole toolchain tree
+toolchain_prefix = 'toolchain:'
+
+# package manager databases, which change whenever system packages do
+package_databases = [
+    '/var/lib/dpkg/status',
+    '/var/lib/rpm/rpmdb.sqlite',
+    '/var/lib/rpm/Packages',
+    '/var/lib/pacman/local',
+    '/lib/apk/db/installed',
+]
+
+def toolchain_fingerprint(path):
+    """ Return a hash of a cheap manifest of the read-only toolchain tree (or
+        single file, such as a compiler binary) at path, or None if path
+        doesn't exist. The manifest is the stat signature of path and of
+        every directory beneath it, plus those of the package databases:
+        adding, removing or replacing a file changes its directory's mtime
+        (package managers and installers replace files by renaming), so
+        the fingerprint changes without stat'ing or reading every file. """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    hashobj = md5func()
+    def add(name, st):
+        line = '%s %r\n' % (name, _stat_signature(st))
+        hashobj.update(line.encode('utf-8', 'replace'))
+    add(path, st)
+    if stat.S_ISDIR(st.st_mode):
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for dirname in dirnames:
+                dirname = os.path.join(dirpath, dirname)
+                try:
+                    add(dirname, os.stat(dirname))
+                except OSError:
+                    pass
+    for database in package_databases:
+        try:
+            add(database, os.stat(database))
+        except OSError:
+            pass
+    return hashobj.hexdigest()
+
+class _pending_hash(object):
+    """ A hash that one thread is computing and others are waiting for, or
+        the exception computing it raised """
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        """ Wait for the hash and return it, raising the exception computing
+            it raised, if any. """
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class HashCache(dict):
+    """ Thread safe dict of filename -> hash for files already hashed in this
+        build. Use hash() to look up or compute a hash: each file is hashed
+        at most once, even when several threads ask for it at the same time
+        (later callers wait for the first caller's result). Counts of cache
+        hits, misses (files actually hashed) and coalesced requests (callers
+        that waited on another's hash) are kept for tuning.
+
+        A HashCache pickled for a parallel worker is empty, with the set of
+        names of the files that were in it in its "known" attribute. """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._init_state()
+
+    def _init_state(self):
+        self.lock = threading.Lock()
+        self.known = frozenset()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __reduce__(self):
+        # parallel workers get an empty cache, rather than every hash so far
+        # being pickled for each job (and locks can't be pickled anyway),
+        # with just the names of the files already hashed in self.known
+        with self.lock:
+            known = self.known.union(self)
+        return (HashCache, (), {'known': known})
+
+    def hash(self, filename, hasher):
+        """ Return the cached hash of filename, or hasher(filename) if it
+            isn't cached yet. Hashes of None aren't cached. """
+        with self.lock:
+            if filename in self:
+                self.hits += 1
+                return self[filename]
+            pending = self.pending.get(filename)
+            if pending is None:
+                pending = self.pending[filename] = _pending_hash()
+                self.misses += 1
+                waiting = False
+            else:
+                self.coalesced += 1
+                waiting = True
+        if waiting:
+            return pending.wait()
+        try:
+            pending.result = hasher(filename)
+        except BaseException as e:
+            pending.error = e
+            raise
+        finally:
+            with self.lock:
+                if pending.result is not None:
+                    self[filename] = pending.result
+                del self.pending[filename]
+            pending.event.set()
+        return pending.result
+
+    def hash_many(self, filenames, hasher_many):
+        """ Return a dict of filename -> hash like hash() for each of
+            filenames, but with the files that aren't cached or being hashed
+            by another thread passed to hasher_many() in a single call. """
+        hashes = {}
+        mine = []
+        waiting = []
+        with self.lock:
+            for filename in filenames:
+                if filename in hashes:
+                    continue
+                if filename in self:
+                    self.hits += 1
+                    hashes[filename] = self[filename]
+                    continue
+                hashes[filename] = None
+                pending = self.pending.get(filename)
+                if pending is None:
+                    pending = self.pending[filename] = _pending_hash()
+                    self.misses += 1
+                    mine.append((filename, pending))
+                else:
+                    self.coalesced += 1
+                    waiting.append((filename, pending))
+        try:
+            if mine:
+                computed = hasher_many([filename for filename, _ in mine])
+                for filename, pending in mine:
+                    pending.result = computed.get(filename)
+        except BaseException as e:
+            for filename, pending in mine:
+                pending.error = e
+            raise
+        finally:
+            with self.lock:
+                for filename, pending in mine:
+                    if pending.result is not None:
+                        self[filename] = pending.result
+                    del self.pending[filename]
+            for filename, pending in mine:
+                pending.event.set()
+        # only wait on other threads once our own hashes are published
+        for filename, pending in mine + waiting:
+            hashes[filename] = pending.wait()
+        return hashes
+
+    def stats(self):
+        """ Return a summary of the cache counters for debug output. """
+        return ('%d hits, %d misses, %d coalesced'
+                % (self.hits, self.misses, self.coalesced))
 
 class RunnerUnsupportedException(Exception):
     """ Exception raise by Runner constructor if it is not supported
@@ -520,19 +1235,113 @@ class StraceProcess(object):
                (self.cwd, self.deps, self.outputs)
 
 def _call_strace(self, *args, **kwargs):
-    """ Top level function call for Strace that can be run in parallel """
-    return self(*args, **kwargs)
+    """ Top level function call for Strace that can be run in parallel.
+        Returns (deps, outputs, hashes), where hashes is a dict of the hashes
+        of the outputs and of any deps the builder hadn't already hashed when
+        the command was queued (its hash_cache.known), so that the hashing is
+        done by the worker process instead of the single results handler
+        thread. """
+    deps, outputs = self(*args, **kwargs)
+    builder = getattr(self, '_builder', None)
+    if builder is None:
+        return deps, outputs, None
+    known = builder.hash_cache.known
+    todo = [dep for dep in deps if dep not in known]
+    hashes = builder._compute_hash_many(todo + list(outputs))
+    return deps, outputs, hashes
+
+def _find_program(name):
+    """ Return the path of program name on the PATH, or None. """
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return os.path.abspath(path)
+    return None
+
+def _decode_name(name):
+    """ Return file name from an strace log as a string. """
+    if PY3:
+        return name.decode(sys.getfilesystemencoding(), 'surrogateescape')
+    return name
+
+def _strace_string(args):
+    """ Return (the string at the start of strace's args, the rest of the
+        args after it), or (None, args) if they don't start with a string.
+    """
+    if not args.startswith(b'"'):
+        return None, args
+    end = args.find(b'"', 1)
+    if end < 0:
+        return None, args
+    return args[1:end], args[end+1:]
+
+_strace_number = re.compile(br'\s*(-?\d*)')
+
+def _strace_result(args):
+    """ Return the number (as bytes) that the call whose strace args (and
+        result) are given returned, or None if they don't have a result. """
+    index = args.rfind(b'=')
+    if index < 0 or not args[:index].rstrip().endswith(b')'):
+        return None
+    return _strace_number.match(args, index + 1).group(1)
 
 class StraceRunner(Runner):
     keep_temps = False
+    # the system calls traced, of those strace supports
+    possible_system_calls = ['open', 'openat', 'stat', 'stat64', 'lstat',
+                             'lstat64', 'execve', 'exit_group', 'chdir',
+                             'mkdir', 'rename', 'clone', 'vfork', 'fork',
+                             'symlink', 'creat']
+    # options that make tracing cheaper, of those strace supports: with
+    # seccomp-bpf the traced processes only stop for the system calls traced,
+    # and -qq and signal=none leave out messages about attaching, exits and
+    # signals, which aren't parsed. Failed calls can't be left out (with -z
+    # or status=): a mkdir() failing with EEXIST makes the directory an input
+    possible_options = [['--seccomp-bpf'], ['-qq'], ['-e', 'signal=none']]
+    # file that what strace supports is cached in (None to not cache), and
+    # what's been probed by this process
+    probe_cache = os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or
+        os.path.join(os.path.expanduser('~'), '.cache'),
+        'fabricate', 'strace.json')
+    probe_cache_version = 2
+    _probed = {}
+
+    # a parallel worker process's path caches, for each runner it's run jobs
+    # for, so each job needn't start with empty ones
+    _worker_path_caches = {}
+    _runner_ids = itertools.count()
 
     def __init__(self, builder, build_dir=None):
         self.strace_system_calls = StraceRunner.get_strace_system_calls()
         if self.strace_system_calls is None:
             raise RunnerUnsupportedException('strace is not available')
+        self.strace_options = StraceRunner.get_strace_options()
         self._builder = builder
         self.temp_count = 0
         self.build_dir = os.path.abspath(build_dir or os.getcwd())
+        # what each (cwd, name) seen in strace's output was classified as,
+        # for the rest of the build: names are relative to the build's
+        # current directory, so there's one of these for each directory the
+        # build script has been in. Whether files exist isn't cached, as
+        # they may be created or deleted by later commands.
+        self._path_caches = {}
+        self._paths = {}
+        self._runner_id = '%d.%d' % (os.getpid(), next(self._runner_ids))
+
+    def __getstate__(self):
+        # rather than having these (potentially large) caches pickled along
+        # with each parallel job, the jobs a worker process runs share its
+        # own caches for this runner
+        state = self.__dict__.copy()
+        del state['_path_caches']
+        state['_paths'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._path_caches = StraceRunner._worker_path_caches.setdefault(
+            self._runner_id, {})
 
     @staticmethod
     def get_strace_system_calls():
@@ -541,41 +1350,130 @@ class StraceRunner(Runner):
         if platform.system() == 'Windows':
             # even if windows has strace, it's probably a dodgy cygwin one
             return None
-        possible_system_calls = ['open','openat','stat', 'stat64', 'lstat', 'lstat64',
-            'execve','exit_group','chdir','mkdir','rename','clone','vfork',
-            'fork','symlink','creat']
-        valid_system_calls = []
+        probe = StraceRunner._probe()
+        return None if probe is None else probe['calls']
+
+    @staticmethod
+    def get_strace_options():
+        """ Return the list of arguments for the possible_options that the
+            strace on the PATH supports (empty if there's no strace). """
+        probe = StraceRunner._probe()
+        return [] if probe is None else probe['options']
+
+    @staticmethod
+    def _probe():
+        """ Return a dict of what the strace on the PATH supports ('calls':
+            the system calls get_strace_system_calls() returns, 'options':
+            what get_strace_options() returns), or None if there's no
+            strace. Probing runs strace, so the result is kept
+            for this process, and in the file probe_cache for later ones,
+            keyed by strace's path, size and modification time. """
+        path = _find_program('strace')
+        if path is None:
+            return None
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime)
+        probe = StraceRunner._probed.get(key)
+        if probe is not None:
+            return probe
+        cache = StraceRunner._read_probe_cache()
+        probe = cache.get(path)
+        if not isinstance(probe, dict) or \
+           [probe.get('size'), probe.get('mtime')] != [st.st_size, st.st_mtime]:
+            probe = {'size': st.st_size, 'mtime': st.st_mtime}
+        if 'calls' not in probe or 'options' not in probe:
+            if 'calls' not in probe:
+                calls = StraceRunner._probe_system_calls(path)
+                if calls is None:
+                    return None
+                probe['calls'] = calls
+            if 'options' not in probe:
+                probe['options'] = StraceRunner._probe_options(path,
+                                                               probe['calls'])
+            cache[path] = probe
+            StraceRunner._write_probe_cache(cache)
+        StraceRunner._probed[key] = probe
+        return probe
+
+    @staticmethod
+    def _probe_system_calls(path):
+        """ Return a comma separated list of the system calls fabricate
+            traces that strace at path supports, running it once if it
+            supports them all, and once more for each it doesn't. """
+        calls = list(StraceRunner.possible_system_calls)
         try:
-            # check strace is installed and if it supports each type of call
-            for system_call in possible_system_calls:
-                proc = subprocess.Popen(['strace', '-e', 'trace=' + system_call], stderr=subprocess.PIPE)
+            while calls:
+                proc = subprocess.Popen([path, '-e', 'trace=' + ','.join(calls)],
+                                        stderr=subprocess.PIPE)
                 stdout, stderr = proc.communicate()
-                proc.wait()
                 if b'invalid system call' not in stderr:
-                   valid_system_calls.append(system_call)
+                    break
+                match = re.search(br"invalid system call [`']([^']*)'", stderr)
+                invalid = match and _decode_name(match.group(1))
+                if invalid not in calls:
+                    # can't tell which it is, so check them one by one
+                    calls = [call for call in calls if b'invalid system call'
+                             not in subprocess.Popen(
+                                 [path, '-e', 'trace=' + call],
+                                 stderr=subprocess.PIPE).communicate()[1]]
+                    break
+                calls.remove(invalid)
         except OSError:
             return None
-        return ','.join(valid_system_calls)
-
-    # Regular expressions for parsing of strace log
-    _open_re       = re.compile(r'(?P<pid>\d+)\s+open\("(?P<name>[^"]*)", (?P<mode>[^,)]*)')
-    _openat_re     = re.compile(r'(?P<pid>\d+)\s+openat\([^,]*, "(?P<name>[^"]*)", (?P<mode>[^,)]*)')
-    _stat_re       = re.compile(r'(?P<pid>\d+)\s+l?stat(?:64)?\("(?P<name>[^"]*)", .*') # stat,lstat,stat64,lstat64
-    _execve_re     = re.compile(r'(?P<pid>\d+)\s+execve\("(?P<name>[^"]*)", .*')
-    _creat_re      = re.compile(r'(?P<pid>\d+)\s+creat\("(?P<name>[^"]*)", .*')
-    _mkdir_re      = re.compile(r'(?P<pid>\d+)\s+mkdir\("(?P<name>[^"]*)", .*\)\s*=\s(?P<result>-?[0-9]*).*')
-    _rename_re     = re.compile(r'(?P<pid>\d+)\s+rename\("[^"]*", "(?P<name>[^"]*)"\)')
-    _symlink_re    = re.compile(r'(?P<pid>\d+)\s+symlink\("[^"]*", "(?P<name>[^"]*)"\)')
-    _kill_re       = re.compile(r'(?P<pid>\d+)\s+killed by.*')
-    _chdir_re      = re.compile(r'(?P<pid>\d+)\s+chdir\("(?P<cwd>[^"]*)"\)')
-    _exit_group_re = re.compile(r'(?P<pid>\d+)\s+exit_group\((?P<status>.*)\).*')
-    _clone_re      = re.compile(r'(?P<pid_clone>\d+)\s+(clone|fork|vfork)\(.*\)\s*=\s*(?P<pid>\d*)')
-
-    # Regular expressions for detecting interrupted lines in strace log
-    # 3618  clone( <unfinished ...>
-    # 3618  <... clone resumed> child_stack=0, flags=CLONE, child_tidptr=0x7f83deffa780) = 3622
-    _unfinished_start_re = re.compile(r'(?P<pid>\d+)(?P<body>.*)<unfinished ...>$')
-    _unfinished_end_re   = re.compile(r'(?P<pid>\d+)\s+\<\.\.\..*\>(?P<body>.*)')
+        return ','.join(calls)
+
+    @staticmethod
+    def _probe_options(path, calls):
+        """ Return the arguments for the possible_options that strace at path
+            supports, running it on a command that does nothing once for
+            each. Options it rejects or warns about (eg: --seccomp-bpf on a
+            kernel without seccomp filters) aren't used. """
+        options = []
+        for option in StraceRunner.possible_options:
+            try:
+                proc = subprocess.Popen([path] + option +
+                                        ['-fo', os.devnull, '-e',
+                                         'trace=' + calls,
+                                         sys.executable, '-c', ''],
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+                stdout, stderr = proc.communicate()
+            except OSError:
+                break
+            if proc.returncode == 0 and not stderr.strip():
+                options.extend(option)
+        return options
+
+    @staticmethod
+    def _read_probe_cache():
+        if StraceRunner.probe_cache is None:
+            return {}
+        try:
+            f = open(StraceRunner.probe_cache)
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(data, dict) or \
+           data.get('version') != StraceRunner.probe_cache_version:
+            return {}
+        return data.get('strace', {})
+
+    @staticmethod
+    def _write_probe_cache(cache):
+        if StraceRunner.probe_cache is None:
+            return
+        data = {'version': StraceRunner.probe_cache_version, 'strace': cache}
+        try:
+            directory = os.path.dirname(StraceRunner.probe_cache)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            _atomic_write(StraceRunner.probe_cache,
+                          lambda f: json.dump(data, f, sort_keys=True))
+        except EnvironmentError:
+            pass            # eg: a read-only home directory
 
     def _do_strace(self, args, kwargs, outfile, outname):
         """ Run strace on given command args/kwargs, sending output to file.
@@ -583,7 +1481,7 @@ class StraceRunner(Runner):
         shell_keywords = dict(silent=False)
         shell_keywords.update(kwargs)
         try:
-            shell('strace', '-fo', outname, '-e',
+            shell('strace', self.strace_options, '-fo', outname, '-e',
                   'trace=' + self.strace_system_calls,
                   args, **shell_keywords)
         except ExecutionError as e:
@@ -595,144 +1493,231 @@ class StraceRunner(Runner):
             else:
                 # reset the file postion for reading
                 outfile.seek(0)
+        return self._parse(outfile)
+
+    def _stream_strace(self, args, kwargs, fifo):
+        """ Like _do_strace(), but strace writes to the named pipe fifo,
+            which a thread reads and parses while the command runs, so the
+            log never goes to disk and is parsed as soon as strace exits. """
+        shell_keywords = dict(silent=False)
+        shell_keywords.update(kwargs)
+        outcome = {'lines': 0}
+        def read():
+            try:
+                f = open(fifo, 'rb')    # waits for strace to open it
+                try:
+                    def lines():
+                        for line in f:
+                            outcome['lines'] += 1
+                            yield line
+                    outcome['result'] = self._parse(lines())
+                finally:
+                    f.close()
+            except Exception as e:
+                outcome['error'] = e
+        reader = threading.Thread(target=read)
+        reader.daemon = True
+        reader.start()
+        error = None
+        try:
+            shell('strace', self.strace_options, '-fo', fifo, '-e',
+                  'trace=' + self.strace_system_calls,
+                  args, **shell_keywords)
+        except ExecutionError as e:
+            error = e
+        finally:
+            # if strace failed to start it never opened the pipe, so open
+            # it here to give the reader end-of-file instead of waiting
+            while reader.is_alive():
+                try:
+                    os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass        # the reader isn't waiting in open() yet
+                reader.join(0.01)
+        if 'error' in outcome:
+            raise outcome['error']
+        if error is not None and not outcome['lines']:
+            # if strace failed to run, re-throw the exception
+            raise error
+        return outcome['result']
 
+    def _parse(self, lines):
+        """ Parse the lines of an strace log. Return (status code, list of
+            dependencies, list of outputs). """
         self.status = 0
         processes  = {}  # dictionary of processes (key = pid)
         unfinished = {}  # list of interrupted entries in strace log
-        for line in outfile:
+        self._paths = self._path_caches.setdefault(os.getcwd(), {})
+        for line in lines:
            self._match_line(line, processes, unfinished)
 
         # collect outputs and dependencies from all processes
         deps = set()
         outputs = set()
-        for pid, process in processes.items():
-            deps = deps.union(process.deps)
-            outputs = outputs.union(process.outputs)
+        for process in processes.values():
+            deps.update(process.deps)
+            outputs.update(process.outputs)
 
         return self.status, list(deps), list(outputs)
 
     def _match_line(self, line, processes, unfinished):
-        # look for split lines
-        unfinished_start_match = self._unfinished_start_re.match(line)
-        unfinished_end_match = self._unfinished_end_re.match(line)
-        if unfinished_start_match:
-            pid = unfinished_start_match.group('pid')
-            body = unfinished_start_match.group('body')
-            unfinished[pid] = pid + ' ' + body
+        """ Parse a line of the strace log (as bytes), eg:
+                3618  openat(AT_FDCWD, "a.c", O_RDONLY) = 3
+            by splitting it into pid and system call once, then passing the
+            call's arguments (and result) to its handler in _handlers. """
+        pid, _, rest = line.partition(b' ')
+        rest = rest.strip()
+        # join up lines split by other processes' calls:
+        #   3618  clone( <unfinished ...>
+        #   3618  <... clone resumed> child_stack=0, flags=CLONE) = 3622
+        if rest.endswith(b'<unfinished ...>'):
+            unfinished[pid] = rest[:-len(b'<unfinished ...>')]
             return
-        elif unfinished_end_match:
-            pid = unfinished_end_match.group('pid')
-            body = unfinished_end_match.group('body')
+        elif rest.startswith(b'<...'):
             if pid not in unfinished:
-                  # Looks like we need to hande an strace bug here
-                  # I think it is safe to ignore as I have only seen futex calls which strace should not output
-                   printerr('fabricate: Warning: resume without unfinished in strace output (strace bug?), \'%s\'' % line.strip())
-                   return
-            line = unfinished[pid] + body
-            del unfinished[pid]
-
-        is_output = False
-        open_match = self._open_re.match(line)
-        openat_match = self._openat_re.match(line)
-        stat_match = self._stat_re.match(line)
-        execve_match = self._execve_re.match(line)
-        creat_match = self._creat_re.match(line)
-        mkdir_match = self._mkdir_re.match(line)
-        symlink_match = self._symlink_re.match(line)
-        rename_match = self._rename_re.match(line)
-        clone_match = self._clone_re.match(line)
-
-        kill_match = self._kill_re.match(line)
-        if kill_match:
-            return None, None, None
-
-        match = None
-        if execve_match:
-            pid = execve_match.group('pid')
-            match = execve_match # Executables can be dependencies
-            if pid not in processes and len(processes) == 0:
-                # This is the first process so create dict entry
-                processes[pid] = StraceProcess()
-        elif clone_match:
-            pid = clone_match.group('pid')
-            pid_clone = clone_match.group('pid_clone')
-            if pid not in processes:
-                # Simple case where there are no delayed lines
-                processes[pid] = StraceProcess(processes[pid_clone].cwd)
+                # Looks like we need to hande an strace bug here
+                # I think it is safe to ignore as I have only seen futex calls which strace should not output
+                printerr('fabricate: Warning: resume without unfinished in '
+                         'strace output (strace bug?), %r' % line.strip())
+                return
+            rest = unfinished.pop(pid) + rest[rest.find(b'>')+1:]
+            line = pid + b' ' + rest
+
+        paren = rest.find(b'(')
+        if paren > 0:
+            handler = self._handlers.get(rest[:paren])
+            if handler is not None:
+                handler(self, pid, rest[paren+1:], line, processes)
+
+    def _add_file(self, pid, name, is_output, line, processes):
+        """ Add file name (as bytes) to process pid's dependencies, or its
+            outputs if "is_output" is set, if it's relevant. """
+        if name is None or self._matching_is_delayed(processes, pid, line):
+            return
+        key = (processes[pid].cwd, name)
+        try:
+            name, toolchain, relevant = self._paths[key]
+        except KeyError:
+            name, toolchain, relevant = self._paths[key] = \
+                self._classify(*key)
+
+        # files in a toolchain tree are all covered by one
+        # fingerprint instead of being hashed individually
+        if toolchain and not is_output:
+            processes[pid].add_dep(toolchain)
+        elif relevant and os.path.lexists(name):
+            if is_output:
+                processes[pid].add_output(name)
             else:
-                # Some line processing was delayed due to an interupted clone_match
-                processes[pid].cwd = processes[pid_clone].cwd # Set the correct cwd
-                processes[pid].delayed = False # Set that matching is no longer delayed
-                for delayed_line in processes[pid].delayed_lines:
-                    # Process all the delayed lines
-                    self._match_line(delayed_line, processes, unfinished)
-                processes[pid].delayed_lines = [] # Clear the lines
-        elif open_match:
-            match = open_match
-            mode = match.group('mode')
-            if 'O_WRONLY' in mode or 'O_RDWR' in mode:
-                # it's an output file if opened for writing
-                is_output = True
-        elif openat_match:
-            match = openat_match
-            mode = match.group('mode')
-            if 'O_WRONLY' in mode or 'O_RDWR' in mode:
-                # it's an output file if opened for writing
-                is_output = True
-        elif stat_match:
-            match = stat_match
-        elif creat_match:
-            match = creat_match
-            # a created file is an output file
-            is_output = True
-        elif mkdir_match:
-            match = mkdir_match
-            if match.group('result') == '0':
-                # a created directory is an output file
-                is_output = True
-        elif symlink_match:
-            match =  symlink_match
-            # the created symlink is an output file
-            is_output = True
-        elif rename_match:
-            match = rename_match
-            # the destination of a rename is an output file
-            is_output = True
-
-        if match:
-            name = match.group('name')
-            pid  = match.group('pid')
-            if not self._matching_is_delayed(processes, pid, line):
-                cwd = processes[pid].cwd
-                if cwd != '.':
-                    name = os.path.join(cwd, name)
-
-                # normalise path name to ensure files are only listed once
-                name = os.path.normpath(name)
-
-                # if it's an absolute path name under the build directory,
-                # make it relative to build_dir before saving to .deps file
-                if os.path.isabs(name) and name.startswith(self.build_dir):
-                    name = name[len(self.build_dir):]
-                    name = name.lstrip(os.path.sep)
-
-                if (self._builder._is_relevant(name)
-                    and not self.ignore(name)
-                    and os.path.lexists(name)):
-                    if is_output:
-                        processes[pid].add_output(name)
-                    else:
-                        processes[pid].add_dep(name)
-
-        match = self._chdir_re.match(line)
-        if match:
-            pid  = match.group('pid')
-            if not self._matching_is_delayed(processes, pid, line):
-                processes[pid].cwd = os.path.join(processes[pid].cwd, match.group('cwd'))
+                processes[pid].add_dep(name)
+
+    def _classify(self, cwd, name):
+        """ Return (name, toolchain, relevant) for file name (as bytes) opened
+            in directory cwd, where name is normalised, toolchain is the
+            pseudo-dependency for the toolchain tree it's in (if any), and
+            relevant is True if it's in the dependency search directories
+            and not ignored. """
+        name = _decode_name(name)
+        if cwd != '.':
+            name = os.path.join(cwd, name)
+
+        # normalise path name to ensure files are only listed once
+        name = os.path.normpath(name)
+
+        # if it's an absolute path name under the build directory,
+        # make it relative to build_dir before saving to .deps file
+        if os.path.isabs(name) and name.startswith(self.build_dir):
+            name = name[len(self.build_dir):]
+            name = name.lstrip(os.path.sep)
+
+        relevant = self._builder._is_relevant(name) and not self.ignore(name)
+        return name, self._builder._toolchain_dep(name), relevant
+
+    def _execve(self, pid, args, line, processes):
+        if pid not in processes and len(processes) == 0:
+            # This is the first process so create dict entry
+            processes[pid] = StraceProcess()
+        # Executables can be dependencies
+        self._add_file(pid, _strace_string(args)[0], False, line, processes)
+
+    def _clone(self, pid_clone, args, line, processes):
+        pid = _strace_result(args)
+        if not pid or not pid.isdigit():
+            return
+        if pid not in processes:
+            # Simple case where there are no delayed lines
+            processes[pid] = StraceProcess(processes[pid_clone].cwd)
+        else:
+            # Some line processing was delayed due to an interupted clone
+            processes[pid].cwd = processes[pid_clone].cwd # Set the correct cwd
+            processes[pid].delayed = False # Set that matching is no longer delayed
+            for delayed_line in processes[pid].delayed_lines:
+                # Process all the delayed lines
+                self._match_line(delayed_line, processes, {})
+            processes[pid].delayed_lines = [] # Clear the lines
+
+    def _open(self, pid, args, line, processes):
+        name, rest = _strace_string(args)
+        # it's an output file if opened for writing
+        mode = rest.split(b',')[1].partition(b')')[0] if name is not None \
+               and rest.startswith(b', ') else b''
+        self._add_file(pid, name, b'O_WRONLY' in mode or b'O_RDWR' in mode,
+                       line, processes)
+
+    def _openat(self, pid, args, line, processes):
+        # skip the directory fd, files are relative to the process's cwd
+        comma = args.find(b',')
+        if comma >= 0 and args[comma:comma+3] == b', "':
+            self._open(pid, args[comma+2:], line, processes)
+
+    def _stat(self, pid, args, line, processes):
+        self._add_file(pid, _strace_string(args)[0], False, line, processes)
+
+    def _creat(self, pid, args, line, processes):
+        # a created file is an output file
+        self._add_file(pid, _strace_string(args)[0], True, line, processes)
+
+    def _mkdir(self, pid, args, line, processes):
+        result = _strace_result(args)
+        if result is not None:
+            # a created directory is an output file
+            self._add_file(pid, _strace_string(args)[0], result == b'0',
+                           line, processes)
+
+    def _second_string(self, pid, args, line, processes):
+        # the created symlink or the destination of a rename is an output
+        name, rest = _strace_string(args)
+        if name is not None and rest.startswith(b', '):
+            name, rest = _strace_string(rest[2:])
+            if rest.startswith(b')'):
+                self._add_file(pid, name, True, line, processes)
+
+    def _chdir(self, pid, args, line, processes):
+        cwd, rest = _strace_string(args)
+        if cwd is not None and rest.startswith(b')') and \
+           not self._matching_is_delayed(processes, pid, line):
+            processes[pid].cwd = os.path.join(processes[pid].cwd,
+                                              _decode_name(cwd))
+
+    def _exit_group(self, pid, args, line, processes):
+        try:
+            self.status = int(args.partition(b')')[0])
+        except ValueError:
+            pass
 
-        match = self._exit_group_re.match(line)
-        if match:
-            self.status = int(match.group('status'))
+    # handler of each system call traced, by name
+    _handlers = {
+        b'execve': _execve,
+        b'clone': _clone, b'fork': _clone, b'vfork': _clone,
+        b'open': _open,
+        b'openat': _openat,
+        b'stat': _stat, b'lstat': _stat, b'stat64': _stat, b'lstat64': _stat,
+        b'creat': _creat,
+        b'mkdir': _mkdir,
+        b'symlink': _second_string, b'rename': _second_string,
+        b'chdir': _chdir,
+        b'exit_group': _exit_group,
+    }
 
     def _matching_is_delayed(self, processes, pid, line):
         # Check if matching is delayed and cache a delayed line
@@ -746,11 +1731,9 @@ class StraceRunner(Runner):
         else:
             return False
 
-    def __call__(self, *args, **kwargs):
-        """ Run command and return its dependencies and outputs, using strace
-            to determine dependencies (by looking at what files are opened or
-            modified). """
-        ignore_status = kwargs.pop('ignore_status', False)
+    def _strace_to_file(self, args, kwargs):
+        """ Run strace with its log in a temporary file (kept if keep_temps
+            is set), and return _do_strace()'s result. """
         if self.keep_temps:
             outname = 'strace%03d.txt' % self.temp_count
             self.temp_count += 1
@@ -760,21 +1743,39 @@ class StraceRunner(Runner):
 
         try:
             try:
-                outfile = os.fdopen(handle, 'r')
+                outfile = os.fdopen(handle, 'rb')
             except:
                 os.close(handle)
                 raise
             try:
-                status, deps, outputs = self._do_strace(args, kwargs, outfile, outname)
-                if status is None:
-                    raise ExecutionError(
-                        '%r was killed unexpectedly' % args[0], '', -1)
+                return self._do_strace(args, kwargs, outfile, outname)
             finally:
                 outfile.close()
         finally:
             if not self.keep_temps:
                 os.remove(outname)
 
+    def __call__(self, *args, **kwargs):
+        """ Run command and return its dependencies and outputs, using strace
+            to determine dependencies (by looking at what files are opened or
+            modified). The log goes through a named pipe, unless keep_temps
+            is set (or there are no named pipes), when it's a file. """
+        ignore_status = kwargs.pop('ignore_status', False)
+        if self.keep_temps or not hasattr(os, 'mkfifo'):
+            status, deps, outputs = self._strace_to_file(args, kwargs)
+        else:
+            temp_dir = tempfile.mkdtemp()
+            fifo = os.path.join(temp_dir, 'strace.fifo')
+            try:
+                os.mkfifo(fifo)
+                status, deps, outputs = self._stream_strace(args, kwargs, fifo)
+            finally:
+                if os.path.exists(fifo):
+                    os.remove(fifo)
+                os.rmdir(temp_dir)
+        if status is None:
+            raise ExecutionError('%r was killed unexpectedly' % args[0], '', -1)
+
         if status and not ignore_status:
             raise ExecutionError('%r exited with status %d'
                                  % (os.path.basename(args[0]), status),
@@ -957,14 +1958,14 @@ def _results_handler( builder, delay=0.01):
                 for r in _groups.item_list(id):
                     if r.results is None and r.async_result.ready():
                         try:
-                            d, o = r.async_result.get()
+                            d, o, h = r.async_result.get()
                         except ExecutionError as e:
                             r.results = e
                             _groups.set_ok(id, False)
                             message, data, status = e
                             printerr("fabricate: " + message)
                         else:
-                            builder.done(r.command, d, o) # save deps
+                            builder.done(r.command, d, o, h) # save deps
                             r.results = (r.command, d, o)
                         _groups.dec_count(id)
             # check if can now schedule things waiting on the after queue
@@ -1010,6 +2011,1738 @@ def _results_handler( builder, delay=0.01):
             printerr("Error: unexpected results handler exit")
             os._exit(1)
 
+class JsonDeps(dict):
+    """ The dependency database: a dict of command line -> {filename:
+        'input-<hash>' or 'output-<hash>'} that is loaded from and saved to
+        a JSON file. The name of the hasher its hashes were made with is
+        kept in self.hasher.
+
+        With "journal" set, each entry set or deleted during the build is
+        also appended to filename + '.journal' as soon as it's done, so that
+        saving at exit doesn't need to rewrite the whole file: the journal
+        is only compacted into it once the journal has grown to more than
+        compact_ratio times the size of the main file. Without a journal,
+        the whole file is rewritten at exit.
+
+        "checkpoint" (which needs "journal") is the number of seconds
+        between fsync()s of the journal, so that entries of commands that
+        finished more than that long ago survive the build being killed or
+        the machine crashing (None leaves flushing to the OS). The whole
+        file is always replaced atomically.
+
+        users(filename) returns the commands whose entries read or write
+        filename. A JsonDeps has to be read whole anyway, so it builds that
+        reverse index in memory the first time it's needed and keeps it up
+        to date from then on; the other formats store theirs.
+
+        Several builds can share the file at once: the entries each sets or
+        deletes are remembered, and saving (with filename + '.lock' locked)
+        first reloads the file to pick up what other builds have saved
+        since, then applies them on top. Journal appends take the lock
+        too. So builds only wait for each other while saving, and don't
+        lose each other's results.
+
+        Builds are numbered: self.generation is the number of the last
+        build saved, and touch(command, generation) records that build
+        number generation used command's entry, for last_used(command)
+        and generations(), so that Builder.gc() can remove entries that
+        haven't been used for a while. In the file these are the
+        '.deps_generation' and '.deps_used' {command: generation} keys. A
+        build that used every command the build before it did journals
+        that as one '.deps_reused' [previous, generation] line, so no-op
+        builds don't grow the journal by a line naming every command.
+
+        set_name(command, name) records a readable name for command, which
+        is how Builder keeps long command lines that it keys by their
+        digest, and name(command) returns it (or command if it has none).
+        In the file they're the '.deps_names' {command: name} key. """
+
+    journal_suffix = '.journal'
+    lock_suffix = '.lock'
+    compact_ratio = 0.25
+
+    def __init__(self, filename, journal=False, checkpoint=None):
+        dict.__init__(self)
+        self.filename = filename
+        self.path = os.path.abspath(filename)
+        self.journal = journal
+        self.checkpoint = checkpoint
+        self.hasher = None
+        self._journal_file = None
+        self._synced = time.time()
+        self._users = None
+        self._lock = _FileLock(self.path + self.lock_suffix)
+        self._changes = {}
+        self._replace = False
+        self.generation = 0
+        self.used = {}
+        self._touched = {}
+        self._used_before = {}
+        self.names = {}
+        self._named = {}
+        self._loaded = None
+
+    def __setitem__(self, command, entry):
+        self._apply(command, entry)
+        self._changes[command] = dict.__getitem__(self, command)
+        if self.journal:
+            self._append(command, entry)
+
+    def __delitem__(self, command):
+        if command not in self:
+            raise KeyError(command)
+        self._apply(command, None)
+        self._changes[command] = None
+        if self.journal:
+            self._append(command, None)
+
+    def clear(self):
+        """ Remove all entries; saving then replaces the file's entries
+            rather than merging with them. """
+        dict.clear(self)
+        self._users = None
+        self._changes = {}
+        self._replace = True
+        self.generation = 0
+        self.used = {}
+        self._touched = {}
+        self._used_before = {}
+        self.names = {}
+        self._named = {}
+
+    def remove(self, commands):
+        """ Remove the entries of all the given commands. """
+        for command in commands:
+            del self[command]
+
+    def touch(self, command, generation):
+        """ Record that build number generation used command's entry. """
+        if command not in self._touched:
+            self._used_before[command] = self.used.get(command, 0)
+        self.used[command] = generation
+        self._touched[command] = generation
+
+    def _touch_all(self, used):
+        """ Apply touch()es made elsewhere: {command: generation}. """
+        for command, generation in used.items():
+            if generation > self.used.get(command, 0):
+                self.used[command] = generation
+            if generation > self.generation:
+                self.generation = generation
+
+    def _reuse(self, previous, generation):
+        """ Apply a '.deps_reused' line: build number generation used every
+            command that build number previous was the last to use. """
+        for command, used in self.used.items():
+            if used == previous:
+                self.used[command] = generation
+        if generation > self.generation:
+            self.generation = generation
+
+    def last_used(self, command):
+        """ Return the number of the last build that used command's entry,
+            0 if unknown. """
+        return self.used.get(command, 0)
+
+    def set_name(self, command, name):
+        """ Record the readable name of command. """
+        if self.name(command) != name:
+            self.names[command] = name
+            self._named[command] = name
+            if self.journal:
+                self._append_line('.deps_names', {command: name})
+
+    def name(self, command):
+        """ Return the readable name of command. """
+        return self.names.get(command, command)
+
+    def generations(self):
+        """ Return {command: last_used(command)} for every command. """
+        return dict((command, self.used.get(command, 0))
+                    for command in dict.__iter__(self))
+
+    def users(self, filename):
+        """ Return the set of commands whose entries have filename in them,
+            as an input or an output. """
+        if self._users is None:
+            self._users = {}
+            for command in dict.__iter__(self):
+                self._add_users(command)
+        return set(self._users.get(filename, ()))
+
+    def _add_users(self, command):
+        for filename in dict.__getitem__(self, command):
+            self._users.setdefault(filename, set()).add(command)
+
+    def _remove_users(self, command):
+        for filename in dict.get(self, command, ()):
+            users = self._users.get(filename)
+            if users is not None:
+                users.discard(command)
+
+    def update(self, entries):
+        """ Set all the given (command, entry) pairs (or dict of them). """
+        if hasattr(entries, 'items'):
+            entries = entries.items()
+        for command, entry in entries:
+            self[command] = entry
+
+    def _apply(self, command, entry):
+        """ Set command's entry (or remove it if entry is None), without
+            journalling it or remembering it as a change. """
+        if entry is None:
+            self._discard(command)
+            return
+        if self._users is not None:
+            self._remove_users(command)
+        dict.__setitem__(self, command, self._store(entry))
+        if self._users is not None:
+            self._add_users(command)
+
+    def _discard(self, command):
+        """ Remove command's entry, if any. """
+        if self._users is not None:
+            self._remove_users(command)
+        dict.pop(self, command, None)
+
+    def _store(self, entry):
+        """ Return entry in the form this database keeps entries in. """
+        if isinstance(entry, dict):
+            return entry
+        return dict(entry)
+
+    def _append(self, command, entry):
+        """ Append setting command's entry (or deleting it if entry is None)
+            to the journal file. """
+        if entry is not None and not isinstance(entry, dict):
+            entry = dict(entry)
+        self._append_line(command, entry)
+
+    def _append_line(self, key, value):
+        """ Append the journal line [key, value]. """
+        line = json.dumps([key, value]) + '\n'
+        with self._lock:
+            self._open_journal()
+            self._journal_file.write(line)
+            self._journal_file.flush()
+        if self.checkpoint is not None and \
+           time.time() - self._synced >= self.checkpoint:
+            self.sync()
+
+    def _open_journal(self):
+        """ Open the journal file for appending, if it's not open or another
+            build has compacted it since. Called with the lock held. """
+        journal = self.path + self.journal_suffix
+        if self._journal_file is not None:
+            try:
+                replaced = os.stat(journal).st_ino != \
+                           os.fstat(self._journal_file.fileno()).st_ino
+            except OSError:
+                replaced = True
+            if replaced:
+                self._journal_file.close()
+                self._journal_file = None
+        if self._journal_file is None:
+            self._journal_file = open(journal, 'a')
+            if not self._journal_ends_line(journal):
+                # finish a last line cut short by a crash, so ours isn't
+                # appended to it and lost along with it
+                self._journal_file.write('\n')
+            if self.checkpoint is not None:
+                _fsync_dir(os.path.dirname(self.path))
+
+    @staticmethod
+    def _journal_ends_line(journal):
+        """ Return True if the journal file is empty or ends in a newline. """
+        f = open(journal, 'rb')
+        try:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+        finally:
+            f.close()
+
+    def sync(self):
+        """ Make sure everything journalled so far is on disk. """
+        if self._journal_file is not None:
+            os.fsync(self._journal_file.fileno())
+        self._synced = time.time()
+
+    def paths(self):
+        """ Return the files this database is stored in. """
+        return [self.path, self.path + self.journal_suffix,
+                self.path + self.lock_suffix]
+
+    def load(self):
+        """ Read the dependency file and replay its journal, if any. """
+        self.clear()
+        self._replace = False
+        self._loaded = None
+        try:
+            f = open(self.path)
+            try:
+                signature = _stat_signature(os.fstat(f.fileno()))
+                data = json.load(f)
+            finally:
+                f.close()
+        except IOError:
+            signature = None
+            data = {}
+        else:
+            # make sure the version is correct
+            if data.get('.deps_version', 0) != deps_version:
+                printerr('Bad %s dependency file version! Rebuilding.'
+                         % self.filename)
+                self.remove_journal()
+                return
+        data.pop('.deps_version', None)
+        self.hasher = data.pop('.deps_hasher', None)
+        self.generation = data.pop('.deps_generation', 0)
+        self.used = data.pop('.deps_used', {})
+        self.names = data.pop('.deps_names', {})
+        dict.update(self, data)
+        self._loaded = [signature, self._replay_journal()]
+
+    def _replay_journal(self):
+        """ Replay the journal, returning its stat signature from before it
+            was read, or None if there isn't one. """
+        try:
+            f = open(self.path + self.journal_suffix)
+        except IOError:
+            return None
+        try:
+            signature = _stat_signature(os.fstat(f.fileno()))
+            for line in f:
+                try:
+                    command, entry = json.loads(line)
+                except (ValueError, TypeError):
+                    continue    # a line cut short by a crash
+                if command == '.deps_used':
+                    self._touch_all(entry)
+                elif command == '.deps_reused':
+                    self._reuse(*entry)
+                elif command == '.deps_names':
+                    self.names.update(entry)
+                else:
+                    self._apply(command, entry)
+        finally:
+            f.close()
+        return signature
+
+    def _signatures(self):
+        """ Return the stat signatures of the file and its journal, with None
+            for either that doesn't exist. """
+        signatures = []
+        for path in [self.path, self.path + self.journal_suffix]:
+            try:
+                signatures.append(_stat_signature(os.stat(path)))
+            except OSError:
+                signatures.append(None)
+        return signatures
+
+    def _journal_size(self):
+        try:
+            return os.path.getsize(self.path + self.journal_suffix)
+        except OSError:
+            return None
+
+    def needs_compaction(self):
+        """ Return True if saving should rewrite the whole file. """
+        if not self.journal:
+            return True
+        journal_size = self._journal_size()
+        if journal_size is None:
+            return False
+        try:
+            return journal_size > self.compact_ratio * os.path.getsize(self.path)
+        except OSError:
+            return True
+
+    def save(self, filename=None, hasher=None, compact=False):
+        """ Save the dependency database to filename (default self.filename,
+            in which case a small enough journal is left to be replayed
+            rather than rewriting the whole file, unless "compact" is set).
+            "hasher" is the name of the hasher its hashes were made with.
+        """
+        if hasher is not None and hasher != self.hasher:
+            self.hasher = hasher
+            force = True        # journal entries would be misread
+        else:
+            force = compact
+        self._touch_all(self._touched)
+        if filename is not None and os.path.abspath(filename) != self.path:
+            self.write(filename)
+            return
+        with self._lock:
+            if force or self.needs_compaction():
+                self._merge()
+                self.write(self.path)
+                self.remove_journal()
+                signatures = self._signatures()
+                if signatures[1] is None:
+                    # what's saved is what's in memory
+                    self._loaded = signatures
+                self._changes = {}
+                self._replace = False
+                self._touched = {}
+                self._used_before = {}
+                self._named = {}
+            elif self._touched:
+                self._save_touched()
+                self._touched = {}
+                self._used_before = {}
+        self.close()
+
+    def save_touched(self):
+        """ Save just the touch()es since the last save, appending them to
+            the journal (even without "journal" set) rather than rewriting
+            the file, for when nothing else has changed. """
+        if self._touched:
+            self._touch_all(self._touched)
+            with self._lock:
+                self._save_touched()
+            self._touched = {}
+            self._used_before = {}
+        self.close()
+
+    def _save_touched(self):
+        """ Save the touch()es since the last save, without the rest, which
+            is either in the journal or unchanged. If every command the last
+            build before them used was touched (as when a build's run again
+            without changes), that's one '.deps_reused' line, plus the
+            touches of any other commands. Called with the lock held. """
+        touched = self._touched
+        generations = set(touched.values())
+        previous = max(self._used_before.values())
+        if len(generations) == 1 and previous and \
+           previous not in self.used.values():
+            self._append_line('.deps_reused', [previous, generations.pop()])
+            touched = dict((command, generation) for command, generation
+                           in touched.items()
+                           if self._used_before[command] != previous)
+            if not touched:
+                return
+        self._append_line('.deps_used', touched)
+
+    def _merge(self):
+        """ Reload the file, to pick up what other builds have saved to it
+            since it was loaded, and apply this build's changes on top.
+            Called with the lock held. """
+        if self._replace:
+            return
+        if self._loaded is not None and self._loaded == self._signatures():
+            return      # nothing's been saved since it was loaded
+        changes = self._changes
+        touched = self._touched
+        used_before = self._used_before
+        named = self._named
+        hasher = self.hasher
+        self.load()
+        if self.hasher not in (None, hasher):
+            printerr('%s was saved by another build using the %s hasher, '
+                     'dropping its entries' % (self.filename, self.hasher))
+            self.clear()
+        self.hasher = hasher
+        for command, entry in changes.items():
+            self._apply(command, entry)
+        self._touch_all(touched)
+        self.names.update(named)
+        self._changes = changes
+        self._touched = touched
+        self._used_before = used_before
+        self._named = named
+
+    def write(self, filename):
+        """ Write the whole dependency database to filename, atomically. """
+        used = dict((command, self.used[command])
+                    for command in dict.__iter__(self) if command in self.used)
+        dict.__setitem__(self, '.deps_version', deps_version)
+        if self.hasher is not None:
+            dict.__setitem__(self, '.deps_hasher', self.hasher)
+        if self.generation:
+            dict.__setitem__(self, '.deps_generation', self.generation)
+            dict.__setitem__(self, '.deps_used', used)
+        names = dict((command, name) for command, name in self.names.items()
+                     if dict.__contains__(self, command))
+        if names:
+            dict.__setitem__(self, '.deps_names', names)
+        try:
+            _atomic_write(filename, lambda f: json.dump(self, f, indent=4,
+                                                        sort_keys=True))
+        finally:
+            for key in ['.deps_version', '.deps_hasher', '.deps_generation',
+                        '.deps_used', '.deps_names']:
+                dict.pop(self, key, None)
+
+    def close(self):
+        """ Close the journal and lock files, if open. """
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+        self._lock.close()
+
+    def remove_journal(self):
+        """ Close and delete the journal file, if any. """
+        self.close()
+        journal = self.path + self.journal_suffix
+        try:
+            os.remove(journal)
+        except OSError:
+            if os.path.exists(journal):
+                # Windows won't delete it while another build has it open
+                open(journal, 'w').close()
+
+def _split_dep(filename):
+    """ Split filename into its directory prefix, including the trailing
+        separator, and the rest, so that prefix + rest == filename. """
+    index = max(filename.rfind('/'), filename.rfind(os.sep))
+    return filename[:index+1], filename[index+1:]
+
+class _DepsEntry(Mapping):
+    """ A read-only {filename: hash} dependency entry, made of a tuple of
+        (directory prefix, {name: hash}) groups which are shared between
+        all the entries that have the same files and hashes in the
+        directory. """
+
+    __slots__ = ('groups',)
+
+    def __init__(self, groups):
+        self.groups = groups
+
+    def __getitem__(self, filename):
+        prefix, name = _split_dep(filename)
+        for group_prefix, names in self.groups:
+            if group_prefix == prefix:
+                if name in names:
+                    return names[name]
+                break
+        raise KeyError(filename)
+
+    def __iter__(self):
+        for prefix, names in self.groups:
+            for name in names:
+                yield prefix + name
+
+    def __len__(self):
+        return sum(len(names) for prefix, names in self.groups)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+# uint32 array type code, and how hashes are packed in BinaryDeps files
+_uint32 = 'I' if array('I').itemsize == 4 else 'L'
+_hex_value = re.compile(r'(input|output)-((?:[0-9a-f][0-9a-f]){1,255})$')
+_value_kinds = {'input': 0, 'output': 1}
+_value_prefixes = ['input-', 'output-']
+_string_value = 2
+
+def _uint32_bytes(ints):
+    """ Return a list of ints as little-endian uint32 bytes. """
+    data = array(_uint32, ints)
+    if sys.byteorder != 'little':
+        data.byteswap()
+    return data.tobytes() if PY3 else data.tostring()
+
+def _encode_string(string):
+    return string.encode('utf-8', 'surrogatepass') if PY3 else \
+           string.encode('utf-8')
+
+def _decode_string(data):
+    return data.decode('utf-8', 'surrogatepass') if PY3 else \
+           data.decode('utf-8')
+
+def _slot_hash(key_bytes):
+    """ Hash of an encoded command line or file name for the BinaryDeps
+        slot tables; it has to be the same in every process, so not hash().
+    """
+    return zlib.crc32(key_bytes) & 0xffffffff
+
+def _slot_table(keys):
+    """ Return the BinaryDeps slot table for the list of encoded keys. """
+    slot_count = 1
+    while slot_count < 2 * len(keys):
+        slot_count *= 2
+    slots = [0] * slot_count
+    for number, key_bytes in enumerate(keys):
+        slot = _slot_hash(key_bytes) & (slot_count - 1)
+        while slots[slot]:
+            slot = (slot + 1) & (slot_count - 1)
+        slots[slot] = number + 1
+    return slots
+
+class _DepsIndex(object):
+    """ Read-only view of a BinaryDeps file through mmap, decoding only the
+        strings, values, groups and entries asked for. """
+
+    # section numbers, see BinaryDeps
+    META, STRING_OFFSETS, STRINGS, VALUE_OFFSETS, VALUES, GROUP_OFFSETS, \
+        GROUPS, ENTRY_OFFSETS, ENTRIES, SLOTS, GROUP_USER_OFFSETS, \
+        GROUP_USERS, FILE_OFFSETS, FILES, FILE_SLOTS, GENERATIONS, \
+        NAMES = range(17)
+    SECTIONS = 17
+
+    def __init__(self, filename, magic):
+        f = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        try:
+            if self.map[:len(magic)] != magic:
+                raise ValueError('%s has the wrong magic string' % filename)
+            count, = struct.unpack_from('<I', self.map, len(magic))
+            self.starts = struct.unpack_from('<%dQ' % (count + 1), self.map,
+                                             len(magic) + 4)
+            if count != self.SECTIONS or self.starts[-1] > len(self.map):
+                raise ValueError('%s is truncated' % filename)
+            self.meta = json.loads(_decode_string(
+                self.map[self.starts[self.META]:self.starts[self.META+1]]))
+            self.entry_count = self._count(self.ENTRY_OFFSETS) - 1
+        except:
+            self.close()
+            raise
+
+    def _count(self, section):
+        return (self.starts[section+1] - self.starts[section]) // 4
+
+    def _uints(self, section, start, end):
+        return struct.unpack_from('<%dI' % (end - start), self.map,
+                                  self.starts[section] + 4*start)
+
+    def _record(self, offsets, index):
+        """ Return the start and end of record index, from its offsets
+            section. """
+        return self._uints(offsets, index, index + 2)
+
+    def string_bytes(self, index):
+        start, end = self._record(self.STRING_OFFSETS, index)
+        base = self.starts[self.STRINGS]
+        return self.map[base+start:base+end]
+
+    def string(self, index):
+        return _decode_string(self.string_bytes(index))
+
+    def value(self, index):
+        start, end = self._record(self.VALUE_OFFSETS, index)
+        base = self.starts[self.VALUES]
+        data = self.map[base+start:base+end]
+        kind, = struct.unpack_from('<B', data)
+        if kind == _string_value:
+            return self.string(struct.unpack_from('<I', data, 1)[0])
+        return _value_prefixes[kind] + \
+               binascii.hexlify(data[1:]).decode('ascii')
+
+    def group(self, index):
+        """ Return (prefix string number, [name, value, name, value...]). """
+        start, end = self._record(self.GROUP_OFFSETS, index)
+        ints = self._uints(self.GROUPS, start, end)
+        return ints[0], ints[1:]
+
+    def entry(self, index):
+        """ Return (command string number, group numbers). """
+        start, end = self._record(self.ENTRY_OFFSETS, index)
+        ints = self._uints(self.ENTRIES, start, end)
+        return ints[0], ints[1:]
+
+    def group_users(self, index):
+        """ Return the numbers of the entries that have group index. """
+        start, end = self._record(self.GROUP_USER_OFFSETS, index)
+        return self._uints(self.GROUP_USERS, start, end)
+
+    def generation(self, index=None):
+        """ Return the last build number that used entry index, or the
+            number of the last build saved if index is None. """
+        index = 0 if index is None else index + 1
+        return self._uints(self.GENERATIONS, index, index + 1)[0]
+
+    def name(self, index):
+        """ Return the readable name of entry index, or None. """
+        string, = self._uints(self.NAMES, index, index + 1)
+        return self.string(string - 1) if string else None
+
+    def generation_offset(self, index=None):
+        """ Return where generation(index) is in the file. """
+        index = 0 if index is None else index + 1
+        return self.starts[self.GENERATIONS] + 4*index
+
+    def file(self, index):
+        """ Return (prefix string number, name string number, group numbers)
+            of file index. """
+        start, end = self._record(self.FILE_OFFSETS, index)
+        ints = self._uints(self.FILES, start, end)
+        return ints[0], ints[1], ints[2:]
+
+    def _probe(self, section, key_bytes, record_key):
+        """ Return the record number in slot table section whose key (as
+            given by record_key(number)) is key_bytes, or None. """
+        mask = self._count(section) - 1
+        slot = _slot_hash(key_bytes) & mask
+        while True:
+            index, = self._uints(section, slot, slot + 1)
+            if not index:
+                return None
+            if record_key(index - 1) == key_bytes:
+                return index - 1
+            slot = (slot + 1) & mask
+
+    def find(self, command):
+        """ Return the entry number of command, or None if it's not here. """
+        return self._probe(self.SLOTS, _encode_string(command),
+                           lambda index: self.string_bytes(self.entry(index)[0]))
+
+    def find_file(self, filename):
+        """ Return the file number of filename, or None if it's not here. """
+        def file_key(index):
+            prefix, name, groups = self.file(index)
+            return self.string_bytes(prefix) + self.string_bytes(name)
+        return self._probe(self.FILE_SLOTS, _encode_string(filename), file_key)
+
+    def close(self):
+        self.map.close()
+
+class BinaryDeps(JsonDeps):
+    """ A JsonDeps that's compact on disk and in memory, and that's loaded
+        lazily: opening it just mmaps the file, and an entry is only decoded
+        (through a hash table of command lines) when it's first used, so
+        startup time and memory don't grow with the history.
+
+        Command lines, file names and hashes are interned, the files of each
+        entry are kept as groups per directory that are shared by every
+        entry with the same files and hashes in that directory (eg: the
+        headers of an include directory), and "input-"/"output-" hex hashes
+        are stored as binary digests. Entries read back are read-only
+        mappings: replace an entry rather than changing it in place. The
+        journal is the same as JsonDeps's; use it with a large history, as
+        a build that changed anything otherwise has to decode and rewrite
+        the whole file when it's saved.
+
+        The file is the magic string, a uint32 section count (17), and the
+        uint64 start offset of each section plus the end of the last one.
+        All numbers are little-endian, records are numbered from 0, and the
+        *_OFFSETS sections are uint32 start offsets of each record in the
+        section after, plus the end of the last one. The sections are:
+            META: JSON {"version": deps_version, "hasher": name}
+            STRING_OFFSETS, STRINGS: the UTF-8 strings
+            VALUE_OFFSETS, VALUES: per hash, a kind byte (0 input, 1 output,
+                2 a string) and the digest or uint32 string number
+            GROUP_OFFSETS, GROUPS: uint32s, per group the prefix string and
+                its (name string, value) pairs
+            ENTRY_OFFSETS, ENTRIES: uint32s, per entry the command string
+                and its group numbers
+            SLOTS: a power of 2 uint32s of open-addressed hash table,
+                entry number + 1 (0 if unused) at crc32(command) & (size-1)
+                or the next free slot after it
+            GROUP_USER_OFFSETS, GROUP_USERS: uint32s, per group the numbers
+                of the entries that have it
+            FILE_OFFSETS, FILES: uint32s, per file name, its prefix and name
+                strings and the numbers of the groups it's in
+            FILE_SLOTS: like SLOTS, file numbers by crc32(prefix + name)
+            GENERATIONS: uint32s, the number of the last build saved, then
+                per entry, last_used(command)
+            NAMES: uint32s, per entry, the string number + 1 of name(command)
+                if it has one, else 0
+        GROUP_USER_OFFSETS to FILE_SLOTS are the reverse index used by
+        users(). Saving just the touch()es of a build updates GENERATIONS
+        in place. """
+
+    magic = b'FABDEPS\x05'
+
+    def __init__(self, filename, journal=False, checkpoint=None):
+        JsonDeps.__init__(self, filename, journal=journal,
+                          checkpoint=checkpoint)
+        self._strings = {}
+        self._groups = {}
+        self._index = None
+        self._index_groups = {}
+        self._deleted = set()
+
+    def _intern(self, string):
+        return self._strings.setdefault(string, string)
+
+    def _store(self, entry):
+        if isinstance(entry, _DepsEntry):
+            return entry
+        by_prefix = {}
+        intern = self._intern
+        for filename, value in entry.items():
+            prefix, name = _split_dep(filename)
+            by_prefix.setdefault(prefix, []).append(
+                (intern(name), intern(value)))
+        groups = []
+        for prefix in sorted(by_prefix):
+            groups.append(self._group(prefix, tuple(sorted(by_prefix[prefix]))))
+        return _DepsEntry(tuple(groups))
+
+    def _group(self, prefix, items):
+        """ Return the shared group of sorted (name, value) items in the
+            directory prefix. """
+        key = (prefix, items)
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = (self._intern(prefix), dict(items))
+        return group
+
+    def _index_group(self, number):
+        """ Return group number of the file, decoding it if need be. """
+        group = self._index_groups.get(number)
+        if group is None:
+            index = self._index
+            prefix, ints = index.group(number)
+            intern = self._intern
+            items = tuple(sorted((intern(index.string(ints[i])),
+                                  intern(index.value(ints[i+1])))
+                                 for i in range(0, len(ints), 2)))
+            group = self._index_groups[number] = \
+                self._group(index.string(prefix), items)
+        return group
+
+    def _find(self, command):
+        """ Return the file's entry number for command if it's not been
+            deleted since, or else None. """
+        if self._index is None or command in self._deleted:
+            return None
+        return self._index.find(command)
+
+    def _index_entry(self, number):
+        """ Return entry number of the file as (command, entry). """
+        command, groups = self._index.entry(number)
+        return self._index.string(command), _DepsEntry(
+            tuple([self._index_group(group) for group in groups]))
+
+    def __missing__(self, command):
+        number = self._find(command)
+        if number is None:
+            raise KeyError(command)
+        entry = self._index_entry(number)[1]
+        dict.__setitem__(self, command, entry)
+        return entry
+
+    def __contains__(self, command):
+        return dict.__contains__(self, command) or \
+               self._find(command) is not None
+
+    def get(self, command, default=None):
+        try:
+            return self[command]
+        except KeyError:
+            return default
+
+    def _apply(self, command, entry):
+        if entry is not None:
+            self._deleted.discard(command)
+        JsonDeps._apply(self, command, entry)
+
+    def _discard(self, command):
+        if self._find(command) is not None:
+            self._deleted.add(command)
+        dict.pop(self, command, None)
+
+    def last_used(self, command):
+        if command in self.used:
+            return self.used[command]
+        number = self._find(command)
+        return 0 if number is None else self._index.generation(number)
+
+    def name(self, command):
+        if command in self.names:
+            return self.names[command]
+        number = self._find(command)
+        name = None if number is None else self._index.name(number)
+        return command if name is None else name
+
+    def generations(self):
+        generations = dict.fromkeys(dict.__iter__(self), 0)
+        if self._index is not None:
+            index = self._index
+            for number in range(index.entry_count):
+                command = index.string(index.entry(number)[0])
+                if command not in self._deleted:
+                    generations[command] = index.generation(number)
+        for command, generation in self.used.items():
+            if command in generations:
+                generations[command] = generation
+        return generations
+
+    def users(self, filename):
+        """ Return the set of commands whose entries have filename in them,
+            from the file's reverse index and the entries set since. """
+        users = set(command for command, entry in dict.items(self)
+                    if filename in entry)
+        number = None if self._index is None else \
+                 self._index.find_file(filename)
+        if number is not None:
+            index = self._index
+            for group in index.file(number)[2]:
+                for entry in index.group_users(group):
+                    command = index.string(index.entry(entry)[0])
+                    if command not in self._deleted and \
+                       not dict.__contains__(self, command):
+                        users.add(command)
+        return users
+
+    def __iter__(self):
+        commands = list(dict.__iter__(self))
+        if self._index is not None:
+            seen = set(commands)
+            for number in range(self._index.entry_count):
+                command = self._index.string(self._index.entry(number)[0])
+                if command not in seen and command not in self._deleted:
+                    commands.append(command)
+        return iter(commands)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def keys(self):
+        return list(iter(self))
+
+    def items(self):
+        return [(command, self[command]) for command in self]
+
+    def values(self):
+        return [self[command] for command in self]
+
+    def clear(self):
+        JsonDeps.clear(self)
+        self._deleted = set()
+        self._index_groups = {}
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def load(self):
+        """ Open the dependency file and replay its journal, if any. """
+        self.clear()
+        self._replace = False
+        self._strings = {}
+        self._groups = {}
+        if os.path.exists(self.path):
+            try:
+                self._index = _DepsIndex(self.path, self.magic)
+                if self._index.meta.get('version') != deps_version:
+                    raise ValueError('bad version')
+            except (ValueError, struct.error, EnvironmentError):
+                self.clear()
+                printerr('Bad %s dependency file version! Rebuilding.'
+                         % self.filename)
+                self.remove_journal()
+                return
+            self.hasher = self._index.meta.get('hasher')
+            self.generation = self._index.generation()
+        self._replay_journal()
+
+    def _save_touched(self):
+        # another build may have rewritten the file since it was loaded
+        try:
+            index = _DepsIndex(self.path, self.magic)
+        except (ValueError, struct.error, EnvironmentError):
+            index = None
+        rest = {}
+        if index is not None:
+            f = open(self.path, 'r+b')
+            try:
+                for command, generation in self._touched.items():
+                    number = index.find(command)
+                    if number is None:
+                        rest[command] = generation
+                    elif generation > index.generation(number):
+                        f.seek(index.generation_offset(number))
+                        f.write(struct.pack('<I', generation))
+                if self.generation > index.generation():
+                    f.seek(index.generation_offset())
+                    f.write(struct.pack('<I', self.generation))
+            finally:
+                f.close()
+                index.close()
+        else:
+            rest = self._touched
+        if rest and self.journal:
+            self._append_line('.deps_used', rest)
+
+    def needs_compaction(self):
+        """ Return True if saving should rewrite the whole file, which isn't
+            needed if nothing's changed. """
+        if not self.journal and not self._changes and not self._replace \
+           and not self._named:
+            return False
+        return JsonDeps.needs_compaction(self)
+
+    def write(self, filename):
+        """ Write the whole dependency database to filename, atomically. """
+        strings = {}
+        string_data = []
+        string_offsets = [0]
+        def string(s):
+            index = strings.get(s)
+            if index is None:
+                index = strings[s] = len(strings)
+                data = _encode_string(s)
+                string_data.append(data)
+                string_offsets.append(string_offsets[-1] + len(data))
+            return index
+
+        values = {}
+        value_data = []
+        value_offsets = [0]
+        def value(v):
+            index = values.get(v)
+            if index is None:
+                index = values[v] = len(values)
+                match = _hex_value.match(v)
+                if match:
+                    data = struct.pack('<B', _value_kinds[match.group(1)]) + \
+                           binascii.unhexlify(match.group(2))
+                else:
+                    data = struct.pack('<BI', _string_value, string(v))
+                value_data.append(data)
+                value_offsets.append(value_offsets[-1] + len(data))
+            return index
+
+        groups = {}
+        group_ints = []
+        group_offsets = [0]
+        group_users = []
+        files = {}
+        entry_ints = []
+        entry_offsets = [0]
+        entry_generations = [self.generation]
+        entry_names = []
+        commands = []
+        for command in sorted(self):
+            entry = dict.get(self, command)
+            if entry is None:
+                entry = self._index_entry(self._find(command))[1]
+            entry = self._store(entry)
+            entry_generations.append(self.last_used(command))
+            name = self.name(command)
+            entry_names.append(0 if name == command else string(name) + 1)
+            commands.append(_encode_string(command))
+            entry_ints.append(string(command))
+            for group in entry.groups:
+                index = groups.get(id(group))
+                if index is None:
+                    index = groups[id(group)] = len(groups)
+                    prefix, names = group
+                    group_ints.append(string(prefix))
+                    for name in sorted(names):
+                        group_ints.extend([string(name), value(names[name])])
+                        files.setdefault((prefix, name), []).append(index)
+                    group_offsets.append(len(group_ints))
+                    group_users.append([])
+                group_users[index].append(len(commands) - 1)
+                entry_ints.append(index)
+            entry_offsets.append(len(entry_ints))
+
+        group_user_ints = []
+        group_user_offsets = [0]
+        for users in group_users:
+            group_user_ints.extend(users)
+            group_user_offsets.append(len(group_user_ints))
+        file_ints = []
+        file_offsets = [0]
+        file_keys = []
+        for (prefix, name), file_groups in sorted(files.items()):
+            file_ints.extend([string(prefix), string(name)] + file_groups)
+            file_offsets.append(len(file_ints))
+            file_keys.append(_encode_string(prefix + name))
+
+        meta = {'version': deps_version}
+        if self.hasher is not None:
+            meta['hasher'] = self.hasher
+        sections = [_encode_string(json.dumps(meta, sort_keys=True)),
+                    _uint32_bytes(string_offsets), b''.join(string_data),
+                    _uint32_bytes(value_offsets), b''.join(value_data),
+                    _uint32_bytes(group_offsets), _uint32_bytes(group_ints),
+                    _uint32_bytes(entry_offsets), _uint32_bytes(entry_ints),
+                    _uint32_bytes(_slot_table(commands)),
+                    _uint32_bytes(group_user_offsets),
+                    _uint32_bytes(group_user_ints),
+                    _uint32_bytes(file_offsets), _uint32_bytes(file_ints),
+                    _uint32_bytes(_slot_table(file_keys)),
+                    _uint32_bytes(entry_generations),
+                    _uint32_bytes(entry_names)]
+        header_size = len(self.magic) + 4 + 8 * (len(sections) + 1)
+        starts = [header_size]
+        for section in sections:
+            starts.append(starts[-1] + len(section))
+
+        def write_sections(f):
+            f.write(self.magic)
+            f.write(struct.pack('<I', len(sections)))
+            f.write(struct.pack('<%dQ' % len(starts), *starts))
+            for section in sections:
+                f.write(section)
+
+        if os.path.abspath(filename) != self.path:
+            _atomic_write(filename, write_sections, 'wb')
+            return
+        if self._index is not None:
+            # a mapped file can't be replaced on Windows
+            self._index.close()
+            self._index = None
+        try:
+            _atomic_write(filename, write_sections, 'wb')
+        except:
+            if os.path.exists(self.path):
+                self._index = _DepsIndex(self.path, self.magic)
+            raise
+        # entries not decoded yet are now read from the new file
+        self._deleted = set()
+        self._index_groups = {}
+        self._index = _DepsIndex(self.path, self.magic)
+
+def _split_value(value):
+    """ Split an entry's "input-<hash>" value into (io_type, hash). """
+    io_type, sep, hashed = value.partition('-')
+    return io_type, hashed if sep else None
+
+def _join_value(io_type, hashed):
+    """ The reverse of _split_value(). """
+    return io_type if hashed is None else io_type + '-' + hashed
+
+class SqliteDeps(MutableMapping):
+    """ A dependency database in an SQLite file, with the same interface as
+        JsonDeps, but which reads and writes entries as they're used rather
+        than loading and saving the whole file: each entry set is committed
+        in its own transaction, and lookups of an entry use the indexes.
+        Entries read are plain dicts, but only copies: set an entry again to
+        change it. It's in WAL mode, so other processes can read it while a
+        build is running.
+
+        There's a row in commands per entry, in files per file name, and in
+        edges per file of each entry, with the "input-<hash>" value split
+        into io_type "input" and hash "<hash>". commands.generation is
+        last_used(command), commands.name is name(command) if it has one
+        (set_name() needs the entry to be set first), and meta has the version, hasher name and last
+        build number (see JsonDeps). "journal" is ignored, SQLite has its
+        own. Committed entries always survive the build crashing;
+        with "checkpoint" set (to any value) they're also synced to disk
+        before the commit returns, so they survive the machine crashing. """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT);
+        CREATE TABLE IF NOT EXISTS commands (
+            id INTEGER PRIMARY KEY,
+            command TEXT NOT NULL UNIQUE,
+            generation INTEGER NOT NULL DEFAULT 0,
+            name TEXT);
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS edges (
+            command INTEGER NOT NULL REFERENCES commands (id),
+            file INTEGER NOT NULL REFERENCES files (id),
+            io_type TEXT NOT NULL,
+            hash TEXT,
+            PRIMARY KEY (command, file));
+        CREATE INDEX IF NOT EXISTS edges_file ON edges (file);
+        """
+
+    entry_query = """
+        SELECT files.name, edges.io_type, edges.hash FROM commands
+        LEFT JOIN edges ON edges.command = commands.id
+        LEFT JOIN files ON files.id = edges.file
+        WHERE commands.command = ?"""
+
+    def __init__(self, filename, journal=False, checkpoint=None):
+        if sqlite3 is None:
+            raise NotImplementedError('sqlite3 module not available, '
+                                      "can't use %s" % filename)
+        self.filename = filename
+        self.path = os.path.abspath(filename)
+        self.checkpoint = checkpoint
+        self.hasher = None
+        self.db = None
+        self.lock = threading.RLock()
+        self.generation = 0
+        self.used = {}
+
+    def _connect(self):
+        """ Return the database connection, opening it if need be. """
+        if self.db is None:
+            # entries are set by the results thread of parallel builds
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=%s'
+                       % ('NORMAL' if self.checkpoint is None else 'FULL'))
+            db.executescript(self.schema)
+            columns = [row[1] for row in
+                       db.execute('PRAGMA table_info(commands)')]
+            if 'generation' not in columns:
+                # made before builds were numbered
+                db.execute('ALTER TABLE commands ADD COLUMN '
+                           'generation INTEGER NOT NULL DEFAULT 0')
+            if 'name' not in columns:
+                db.execute('ALTER TABLE commands ADD COLUMN name TEXT')
+            with db:
+                db.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)',
+                           ('version', str(deps_version)))
+            self.db = db
+        return self.db
+
+    def _set_meta(self, key, value):
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                       (key, value))
+
+    def paths(self):
+        """ Return the files this database is stored in. """
+        return [self.path, self.path + '-wal', self.path + '-shm',
+                self.path + '-journal']
+
+    def load(self):
+        """ Open the dependency file, creating it if need be, and check its
+            version. Entries are only read when they're used. """
+        with self.lock:
+            try:
+                meta = dict(self._connect().execute(
+                                'SELECT key, value FROM meta'))
+            except sqlite3.DatabaseError:
+                meta = {}       # not an SQLite file
+                self.close()
+                for path in self.paths():
+                    if os.path.exists(path):
+                        os.remove(path)
+            if meta.get('version') != str(deps_version):
+                printerr('Bad %s dependency file version! Rebuilding.'
+                         % self.filename)
+                self.clear()
+                self._set_meta('version', str(deps_version))
+                meta = {}
+            self.hasher = meta.get('hasher')
+            self.generation = int(meta.get('generation', 0))
+            self.used = {}
+
+    def __getitem__(self, command):
+        with self.lock:
+            rows = self._connect().execute(self.entry_query,
+                                           (command,)).fetchall()
+        if not rows:
+            raise KeyError(command)
+        return dict((name, _join_value(io_type, hashed))
+                    for name, io_type, hashed in rows if name is not None)
+
+    def __contains__(self, command):
+        with self.lock:
+            return self._connect().execute(
+                'SELECT 1 FROM commands WHERE command = ?',
+                (command,)).fetchone() is not None
+
+    def _command_id(self, db, command):
+        row = db.execute('SELECT id FROM commands WHERE command = ?',
+                         (command,)).fetchone()
+        return None if row is None else row[0]
+
+    def __setitem__(self, command, entry):
+        self.update([(command, entry)])
+
+    def update(self, entries):
+        """ Set all the given (command, entry) pairs (or dict of them) in
+            one transaction. """
+        if hasattr(entries, 'items'):
+            entries = entries.items()
+        with self.lock:
+            db = self._connect()
+            file_ids = {}
+            with db:
+                for command, entry in entries:
+                    self._set(db, command, entry, file_ids)
+
+    def _set(self, db, command, entry, file_ids):
+        command_id = self._command_id(db, command)
+        if command_id is None:
+            command_id = db.execute('INSERT INTO commands (command) VALUES (?)',
+                                    (command,)).lastrowid
+        else:
+            db.execute('DELETE FROM edges WHERE command = ?', (command_id,))
+        edges = []
+        for name, value in entry.items():
+            edges.append((command_id, self._file_id(db, name, file_ids)) +
+                         _split_value(value))
+        db.executemany('INSERT INTO edges VALUES (?, ?, ?, ?)', edges)
+
+    def _file_id(self, db, name, file_ids):
+        """ Return the id of file name, adding it to files if need be. Ids
+            are only remembered in file_ids for the current transaction, as
+            another build's compaction may delete (and later reuse) them. """
+        file_id = file_ids.get(name)
+        if file_id is None:
+            db.execute('INSERT OR IGNORE INTO files (name) VALUES (?)',
+                       (name,))
+            file_id = file_ids[name] = db.execute(
+                'SELECT id FROM files WHERE name = ?', (name,)).fetchone()[0]
+        return file_id
+
+    def __delitem__(self, command):
+        with self.lock:
+            db = self._connect()
+            with db:
+                command_id = self._command_id(db, command)
+                if command_id is None:
+                    raise KeyError(command)
+                db.execute('DELETE FROM edges WHERE command = ?', (command_id,))
+                db.execute('DELETE FROM commands WHERE id = ?', (command_id,))
+
+    def __iter__(self):
+        with self.lock:
+            commands = [command for command, in self._connect().execute(
+                            'SELECT command FROM commands ORDER BY id')]
+        return iter(commands)
+
+    def remove(self, commands):
+        """ Remove the entries of all the given commands, in one
+            transaction. """
+        with self.lock:
+            db = self._connect()
+            with db:
+                for command in commands:
+                    command_id = self._command_id(db, command)
+                    if command_id is None:
+                        raise KeyError(command)
+                    db.execute('DELETE FROM edges WHERE command = ?',
+                               (command_id,))
+                    db.execute('DELETE FROM commands WHERE id = ?',
+                               (command_id,))
+
+    def touch(self, command, generation):
+        """ Record that build number generation used command's entry; these
+            are written when the database is saved. """
+        self.used[command] = generation
+
+    def last_used(self, command):
+        if command in self.used:
+            return self.used[command]
+        with self.lock:
+            row = self._connect().execute(
+                'SELECT generation FROM commands WHERE command = ?',
+                (command,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def set_name(self, command, name):
+        with self.lock:
+            with self._connect() as db:
+                db.execute('UPDATE commands SET name = ? WHERE command = ?',
+                           (None if name == command else name, command))
+
+    def name(self, command):
+        with self.lock:
+            row = self._connect().execute(
+                'SELECT name FROM commands WHERE command = ?',
+                (command,)).fetchone()
+        return command if row is None or row[0] is None else row[0]
+
+    def generations(self):
+        with self.lock:
+            generations = dict(self._connect().execute(
+                'SELECT command, generation FROM commands'))
+        for command, generation in self.used.items():
+            if command in generations:
+                generations[command] = generation
+        return generations
+
+    def users(self, filename):
+        """ Return the set of commands whose entries have filename in them,
+            using the index on edges.file. """
+        with self.lock:
+            return set(command for command, in self._connect().execute("""
+                SELECT commands.command FROM files
+                JOIN edges ON edges.file = files.id
+                JOIN commands ON commands.id = edges.command
+                WHERE files.name = ?""", (filename,)))
+
+    def __len__(self):
+        with self.lock:
+            return self._connect().execute(
+                'SELECT COUNT(*) FROM commands').fetchone()[0]
+
+    def items(self):
+        """ Return a list of all (command, entry) pairs, read in one query
+            rather than one per entry. """
+        entries = {}
+        order = []
+        with self.lock:
+            rows = self._connect().execute("""
+                SELECT commands.command, files.name, edges.io_type, edges.hash
+                FROM commands
+                LEFT JOIN edges ON edges.command = commands.id
+                LEFT JOIN files ON files.id = edges.file
+                ORDER BY commands.id""")
+            for command, name, io_type, hashed in rows:
+                entry = entries.get(command)
+                if entry is None:
+                    entry = entries[command] = {}
+                    order.append(command)
+                if name is not None:
+                    entry[name] = _join_value(io_type, hashed)
+        return [(command, entries[command]) for command in order]
+
+    def values(self):
+        return [entry for command, entry in self.items()]
+
+    def clear(self):
+        with self.lock:
+            with self._connect() as db:
+                db.execute('DELETE FROM edges')
+                db.execute('DELETE FROM commands')
+                db.execute('DELETE FROM files')
+            self.generation = 0
+            self.used = {}
+
+    def save(self, filename=None, hasher=None, compact=False):
+        """ Entries are already saved, but record the hasher name and the
+            touch()es, copy the database to filename if that's given, and
+            close it. "compact" removes unused files rows and shrinks the
+            database file to fit. """
+        with self.lock:
+            if hasher is not None and hasher != self.hasher:
+                self.hasher = hasher
+                self._set_meta('hasher', hasher)
+            if self.used:
+                self.generation = max([self.generation] +
+                                      list(self.used.values()))
+                with self._connect() as db:
+                    db.executemany('UPDATE commands SET generation = '
+                                   'MAX(generation, ?) WHERE command = ?',
+                                   [(generation, command) for command,
+                                    generation in self.used.items()])
+                    db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                               ('generation', str(self.generation)))
+                self.used = {}
+            if filename is not None and os.path.abspath(filename) != self.path:
+                _copy_deps(self, filename)
+            if compact:
+                db = self._connect()
+                with db:
+                    db.execute('DELETE FROM files WHERE id NOT IN '
+                               '(SELECT file FROM edges)')
+                db.execute('VACUUM')
+                db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.close()
+
+    def save_touched(self):
+        """ Save the touch()es; entries are already saved. """
+        self.save()
+
+    def sync(self):
+        """ Commits are already on disk. """
+
+    def close(self):
+        """ Close the database connection, if open. """
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def remove_journal(self):
+        """ Close the database, SQLite removes its own journals. """
+        self.close()
+
+# dependency file classes by file name suffix; other names are JsonDeps
+deps_formats = {
+    '.bin': BinaryDeps,
+    '.sqlite': SqliteDeps,
+}
+
+def open_deps(filename, **kwargs):
+    """ Return an (unloaded) dependency database for filename, of the class
+        deps_formats gives for its suffix. kwargs are passed to the class.
+    """
+    deps_class = deps_formats.get(os.path.splitext(filename)[1], JsonDeps)
+    return deps_class(filename, **kwargs)
+
+def convert_deps(source, dest):
+    """ Convert dependency file source (with its journal) to dest, each in
+        the format given by its suffix, eg: convert_deps('.deps',
+        '.deps.bin'). The conversion is loss-free. """
+    if not os.path.exists(source):
+        raise IOError('dependency file %s not found' % source)
+    deps = open_deps(source)
+    deps.load()
+    _copy_deps(deps, dest)
+    deps.close()
+
+def _copy_deps(deps, dest):
+    """ Replace the contents of dependency file dest with those of the
+        loaded dependency database deps. """
+    copy = open_deps(dest)
+    copy.clear()
+    copy.update(deps.items())
+    copy.generation = deps.generation
+    for command, generation in deps.generations().items():
+        copy.touch(command, generation)
+        name = deps.name(command)
+        if name != command:
+            copy.set_name(command, name)
+    copy.save(hasher=deps.hasher)
+
+class ShardedDeps(object):
+    """ A dependency database split into shards, each one a dependency file
+        of its own in the directory filename + '.shards' (in the format
+        open_deps() gives for filename's suffix), so that a build only loads
+        and saves the shards of the commands it checks or runs, rather than
+        the whole history.
+
+        place(command, shard) says which shard command goes in if it isn't
+        already in one that's been loaded; other commands go in the shard
+        default_shard. A shard is loaded when a command in it is first
+        used, and only shards that were changed are saved, each by its own
+        save(); those only touch()ed just save that, with save_touched(),
+        so builds that change nothing don't rewrite them. Listing all the
+        entries, users() and generations() load
+        every shard. The hasher name and the number of the last build
+        saved are kept in the directory's meta.json. """
+
+    default_shard = 'default'
+    meta_name = 'meta.json'
+    lock_name = 'meta.lock'
+
+    def __init__(self, filename, journal=False, checkpoint=None):
+        self.filename = filename
+        self.path = os.path.abspath(filename)
+        self.dir = self.path + '.shards'
+        self.suffix = '.deps' + os.path.splitext(filename)[1]
+        self.journal = journal
+        self.checkpoint = checkpoint
+        self.hasher = None
+        self.generation = 0
+        self.shards = {}
+        self._where = {}
+        self._changed = set()
+        self._touched = set()
+        self._saved_hasher = None
+        self._lock = _FileLock(os.path.join(self.dir, self.lock_name))
+
+    def shard_names(self):
+        """ Return the sorted names of all the shards. """
+        names = set(self.shards)
+        if os.path.isdir(self.dir):
+            names.update(name[:-len(self.suffix)]
+                         for name in os.listdir(self.dir)
+                         if name.endswith(self.suffix))
+        return sorted(names)
+
+    def _shard_path(self, name):
+        return os.path.join(self.dir, name + self.suffix)
+
+    def shard(self, name):
+        """ Return the dependency database of shard name, loading it if
+            need be. """
+        store = self.shards.get(name)
+        if store is None:
+            if not os.path.isdir(self.dir):
+                os.makedirs(self.dir)
+            store = open_deps(self._shard_path(name), journal=self.journal,
+                              checkpoint=self.checkpoint)
+            store.load()
+            if store.hasher not in (None, self.hasher):
+                printerr('%s was saved using the %s hasher, dropping its '
+                         'entries' % (store.filename, store.hasher))
+                store.clear()
+                self._changed.add(name)
+            self.shards[name] = store
+        return store
+
+    def place(self, command, shard):
+        """ Put command in the shard named shard (default_shard if None),
+            unless it's been found in another. """
+        if shard is None:
+            shard = self.default_shard
+        self._where.setdefault(command, re.sub(r'[^\w-]', '_', shard))
+
+    def _store(self, command, change=False):
+        """ Return the database of command's shard, remembering that it's
+            changed if "change" is set. """
+        name = self._where.get(command, self.default_shard)
+        if change:
+            self._changed.add(name)
+        return self.shard(name)
+
+    def _found(self, command, name):
+        """ Return True if command, found in shard name, belongs there. """
+        return self._where.setdefault(command, name) == name
+
+    def __getitem__(self, command):
+        return self._store(command)[command]
+
+    def get(self, command, default=None):
+        return self._store(command).get(command, default)
+
+    def __contains__(self, command):
+        return command in self._store(command)
+
+    def __setitem__(self, command, entry):
+        self._store(command, change=True)[command] = entry
+
+    def __delitem__(self, command):
+        del self._store(command, change=True)[command]
+
+    def update(self, entries):
+        """ Set all the given (command, entry) pairs (or dict of them). """
+        if hasattr(entries, 'items'):
+            entries = entries.items()
+        for command, entry in entries:
+            self[command] = entry
+
+    def remove(self, commands):
+        """ Remove the entries of all the given commands. """
+        by_shard = {}
+        for command in commands:
+            by_shard.setdefault(self._where.get(command, self.default_shard),
+                                []).append(command)
+        for name, shard_commands in by_shard.items():
+            self._changed.add(name)
+            self.shard(name).remove(shard_commands)
+
+    def touch(self, command, generation):
+        self._touched.add(self._where.get(command, self.default_shard))
+        self._store(command).touch(command, generation)
+
+    def last_used(self, command):
+        return self._store(command).last_used(command)
+
+    def set_name(self, command, name):
+        store = self._store(command)
+        if store.name(command) != name:
+            self._store(command, change=True).set_name(command, name)
+
+    def name(self, command):
+        return self._store(command).name(command)
+
+    def __iter__(self):
+        commands = []
+        for name in self.shard_names():
+            commands.extend(command for command in self.shard(name)
+                            if self._found(command, name))
+        return iter(commands)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def keys(self):
+        return list(iter(self))
+
+    def items(self):
+        return [(command, self[command]) for command in self]
+
+    def values(self):
+        return [self[command] for command in self]
+
+    def generations(self):
+        generations = {}
+        for name in self.shard_names():
+            for command, generation in self.shard(name).generations().items():
+                if self._found(command, name):
+                    generations[command] = generation
+        return generations
+
+    def users(self, filename):
+        """ Return the set of commands whose entries have filename in them,
+            from every shard's reverse index. """
+        users = set()
+        for name in self.shard_names():
+            users.update(command for command in self.shard(name).users(filename)
+                         if self._found(command, name))
+        return users
+
+    def _read_meta(self):
+        try:
+            f = open(os.path.join(self.dir, self.meta_name))
+        except IOError:
+            return {}
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+        finally:
+            f.close()
+
+    def load(self):
+        """ Read the hasher name and build number; shards are only loaded
+            when they're used. """
+        self.close()
+        self.shards = {}
+        self._where = {}
+        self._changed = set()
+        self._touched = set()
+        meta = self._read_meta()
+        if meta and meta.get('version') != deps_version:
+            printerr('Bad %s dependency file version! Rebuilding.'
+                     % self.filename)
+            self.clear()
+            meta = {}
+        self.hasher = self._saved_hasher = meta.get('hasher')
+        self.generation = meta.get('generation', 0)
+
+    def clear(self):
+        """ Remove the entries of every shard. """
+        for name in self.shard_names():
+            self.shard(name).clear()
+            self._changed.add(name)
+        self._where = {}
+        self.generation = 0
+
+    def save(self, filename=None, hasher=None, compact=False):
+        """ Save the shards that have changed (or all those loaded, if the
+            hasher has), or if filename is given, save all of them to that
+            one dependency file. """
+        if hasher is not None:
+            self.hasher = hasher
+        if filename is not None and os.path.abspath(filename) != self.path:
+            _copy_deps(self, filename)
+            return
+        if self.hasher != self._saved_hasher:
+            self._changed.update(self.shards)
+        for name in sorted(self._changed | self._touched):
+            store = self.shard(name)
+            if name in self._changed or compact:
+                store.save(hasher=self.hasher, compact=compact)
+            else:
+                store.save_touched()
+            self.generation = max(self.generation, store.generation)
+        self._changed = set()
+        self._touched = set()
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        with self._lock:
+            # another build may have saved a later build number since
+            meta = self._read_meta()
+            self.generation = max(self.generation, meta.get('generation', 0))
+            saved = {'version': deps_version, 'generation': self.generation}
+            if self.hasher is not None:
+                saved['hasher'] = self.hasher
+            if saved != meta:
+                _atomic_write(os.path.join(self.dir, self.meta_name),
+                              lambda f: json.dump(saved, f, sort_keys=True))
+        self._saved_hasher = self.hasher
+        self.close()
+
+    def sync(self):
+        for store in self.shards.values():
+            store.sync()
+
+    def close(self):
+        """ Close every shard's files. """
+        for store in self.shards.values():
+            store.close()
+        self._lock.close()
+
+    def remove_journal(self):
+        for store in self.shards.values():
+            store.remove_journal()
+
+    def paths(self):
+        """ Return the files this database is stored in, after filename
+            itself (which isn't used) as with the other formats. """
+        paths = [self.path]
+        for name in self.shard_names():
+            paths.extend(open_deps(self._shard_path(name)).paths())
+        return paths + [os.path.join(self.dir, self.meta_name),
+                        os.path.join(self.dir, self.lock_name), self.dir]
+
 class Builder(object):
     """ The Builder.
 
@@ -1029,7 +3762,10 @@ class Builder(object):
 
     def __init__(self, runner=None, dirs=None, dirdepth=100, ignoreprefix='.',
                  ignore=None, hasher=md5_hasher, depsname='.deps',
-                 quiet=False, debug=False, inputs_only=False, parallel_ok=False):
+                 quiet=False, debug=False, inputs_only=False, parallel_ok=False,
+                 stat_cache=False, hash_jobs=0, toolchain=None, journal=False,
+                 checkpoint=None, changed=None, digest_commands=1000,
+                 shard=None):
         """ Initialise a Builder with the given options.
 
         "runner" specifies how programs should be run.  It is either a
@@ -1052,8 +3788,16 @@ class Builder(object):
             comments allowed -- use \ prefix to insert these characters)
         "hasher" is a function which returns a string which changes when
             the contents of its filename argument changes, or None on error.
-            Default is md5_hasher, but can also be mtime_hasher.
-        "depsname" is the name of the JSON dependency file to load/save.
+            Default is md5_hasher, but can also be mtime_hasher,
+            hybrid_hasher (which implies "stat_cache"), a MerkleHasher to
+            hash directories by their contents, or the name of any hasher in
+            the "hashers" dict, such as 'blake2b', 'fast' or 'merkle'.
+            The hasher's name is saved in the .deps file, and changing
+            hashers re-hashes files recorded with the old one rather than
+            rebuilding everything.
+        "depsname" is the name of the JSON dependency file to load/save, or
+            of a binary one if it ends in '.bin', or an SQLite database if
+            it ends in '.sqlite' (see deps_formats).
         "quiet" set to True tells the builder to not display the commands being
             executed (or other non-error output).
         "debug" set to True makes the builder print debug output, such as why
@@ -1062,22 +3806,82 @@ class Builder(object):
             have changed (ignores output hashes); use with tools that touch
             files that shouldn't cause a rebuild; e.g. g++ collect phase
         "parallel_ok" set to True to indicate script is safe for parallel running
+        "stat_cache" set to True keeps a persistent cache of file hashes
+            (in depsname + '.stat') keyed by each file's size, inode and
+            nanosecond mtime/ctime, so unchanged files aren't re-hashed
+        "hash_jobs" is the number of threads used to hash every file
+            recorded in the .deps file up front, before the first command is
+            checked (0 to hash each file lazily as commands are checked)
+        "toolchain" is a list of read-only directories or files outside (or
+            inside) "dirs", eg: ['/usr/include', '/usr/bin/gcc'], that are
+            fingerprinted once per build with toolchain_fingerprint(). A
+            command that uses any file in one of them gets a single
+            "toolchain:<path>" pseudo-dependency on it rather than one per
+            file, so upgrading a compiler or SDK rebuilds what used it.
+            The strace runner records only the toolchains each command
+            used; other runners record all of them for every command.
+        "journal" set to True appends each command's dependencies to a
+            journal file (depsname + '.journal') as the command finishes,
+            instead of rewriting the whole .deps file at exit every build;
+            the journal is compacted into the .deps file once it's large
+        "checkpoint" is the number of seconds between syncing the journal to
+            disk (0 for after every command); it implies "journal". Commands
+            that finished before a crash or kill -9 are then up to date in
+            the next build, rather than only those of builds that exited
+            normally.
+        "changed" is a list of the only files that have changed since the
+            last build (eg: from version control or a file watcher), or None
+            if unknown. Commands that have been run before and aren't
+            affected() by these are then up to date without hashing their
+            dependencies.
+        "digest_commands" is the length above which a command line is
+            keyed in the deps by its digest, rather than by itself; the
+            command line is then only stored once, as the entry's name.
+            None keys every command by its command line.
+        "shard" splits the deps into a ShardedDeps, in the directory
+            depsname + '.shards', so that a build only loads and saves the
+            shards it uses. It's "function" to shard commands by the build
+            script function that run() them, or a function that's passed a
+            command line and returns the name of its shard (or None for the
+            default shard). A command that moves to another shard is rebuilt
+            once, and its old entry is left for gc() to remove.
         """
         if dirs is None:
             dirs = ['.']
         self.dirs = dirs
         self.dirdepth = dirdepth
+        self._dirs_tries = {}
         self.ignoreprefix = ignoreprefix
         if ignore is None:
             ignore = r'$x^'         # something that can't match
         self.ignore = re.compile(ignore, re.VERBOSE)
         self.depsname = depsname
-        self.hasher = hasher
+        self.journal = journal or checkpoint is not None
+        self.checkpoint = checkpoint
+        self.changed = changed
+        self.digest_commands = digest_commands
+        self.shard = shard
+        self._dirty = None
+        self.generation = None
+        self.hasher = hasher = get_hasher(hasher)
         self.quiet = quiet
         self.debug = debug
         self.inputs_only = inputs_only
         self.checking = False
-        self.hash_cache = {}
+        self.hash_cache = HashCache()
+        self.hash_jobs = hash_jobs
+        self.toolchain = [os.path.abspath(path) for path in toolchain or []]
+        self.prehash_time = None
+        if stat_cache or hasher is hybrid_hasher:
+            self.stat_cache = StatCache(os.path.abspath(depsname + '.stat'),
+                                        hasher_name(hasher))
+        else:
+            self.stat_cache = None
+        if isinstance(hasher, MerkleHasher):
+            # each builder has its own, so builders don't share directory
+            # hashes, and it shares our stat cache unless given its own
+            self.hasher = hasher = MerkleHasher(hasher.hasher,
+                                                hasher.cache or self.stat_cache)
 
         # instantiate runner after the above have been set in case it needs them
         if runner is not None:
@@ -1189,32 +3993,52 @@ class Builder(object):
             sys.stderr.flush()
             sys.stdout.flush()
 
-    def done(self, command, deps, outputs):
-        """ Store the results in the .deps file when they are available """
+    def done(self, command, deps, outputs, hashes=None):
+        """ Store the results in the .deps file when they are available.
+            "hashes" is an optional dict of hashes of deps and outputs already
+            computed (by a parallel worker), used instead of hashing them
+            again. """
         if deps is not None or outputs is not None:
             deps_dict = {}
-
-            # hash the dependency inputs and outputs
+            if hashes is None:
+                hashes = {}
+            if self.toolchain and not self._runner_sees_toolchain():
+                deps = list(deps) + [toolchain_prefix + path
+                                     for path in self.toolchain]
+
+            # hash the dependency inputs and outputs, in batches; inputs are
+            # cached as they may be new files, and if any were already hashed
+            # this doesn't repeat the hashing work
+            inputs = self._cached_hash_many(
+                [dep for dep in deps if dep not in hashes])
             for dep in deps:
-                if dep in self.hash_cache:
-                    # already hashed so don't repeat hashing work
-                    hashed = self.hash_cache[dep]
+                if dep in inputs:
+                    hashed = inputs[dep]
                 else:
-                    hashed = self.hasher(dep)
+                    hashed = self.hash_cache.hash(dep, hashes.get)
                 if hashed is not None:
                     deps_dict[dep] = "input-" + hashed
-                    # store hash in hash cache as it may be a new file
-                    self.hash_cache[dep] = hashed
 
+            fresh = self._compute_hash_many(
+                [output for output in outputs if output not in hashes])
             for output in outputs:
-                hashed = self.hasher(output)
+                if output in fresh:
+                    hashed = fresh[output]
+                else:
+                    hashed = hashes[output]
                 if hashed is not None:
                     deps_dict[output] = "output-" + hashed
                     # update hash cache as this file should already be in
                     # there but has probably changed
                     self.hash_cache[output] = hashed
 
-            self.deps[command] = deps_dict
+            key = self.deps_key(command)
+            if self.shard is not None:
+                self.deps.place(key, self._shard_of(command))
+            self.deps[key] = deps_dict
+            if key != command:
+                self.deps.set_name(key, command)
+            self.deps.touch(key, self.generation)
 
         return command, deps, outputs
 
@@ -1246,27 +4070,128 @@ class Builder(object):
         self.checking = False
         return self.outofdate_flag
 
+    def _compute_hash(self, filename):
+        """ Return self.hasher(filename), via the stat cache if enabled. """
+        if filename.startswith(toolchain_prefix):
+            return toolchain_fingerprint(filename[len(toolchain_prefix):])
+        if self.stat_cache is not None:
+            return self.stat_cache.hash(filename, self.hasher)
+        return self.hasher(filename)
+
+    def _compute_hash_many(self, filenames):
+        """ Return a dict of filename -> hash for each of filenames, using
+            the stat cache if enabled and the hasher's hash_many() if it has
+            one. """
+        hashes = {}
+        if self.toolchain:
+            for filename in filenames:
+                if filename.startswith(toolchain_prefix):
+                    hashes[filename] = self._compute_hash(filename)
+            filenames = [f for f in filenames if f not in hashes]
+        if self.stat_cache is not None:
+            hashes.update(self.stat_cache.hash_many(filenames, self.hasher))
+        else:
+            hashes.update(hash_many(self.hasher, filenames))
+        return hashes
+
+    def _cached_hash(self, filename):
+        """ Return hash of filename, hashing it only if not already done in
+            this build. """
+        return self.hash_cache.hash(filename, self._compute_hash)
+
+    def _cached_hash_many(self, filenames):
+        """ Return a dict of filename -> hash for each of filenames, hashing
+            (in one batch) only those not already hashed in this build. """
+        return self.hash_cache.hash_many(filenames, self._compute_hash_many)
+
+    def prehash(self, jobs=None):
+        """ Hash every file recorded in the .deps file using a pool of "jobs"
+            threads (default self.hash_jobs) and store the hashes in
+            hash_cache, so checking commands doesn't wait on each file's I/O
+            in turn. Return the time taken in seconds. """
+        if jobs is None:
+            jobs = self.hash_jobs
+        time0 = time.time()
+        if self.stat_cache is not None and self.stat_cache.entries is None:
+            # before the threads start, rather than one loading it while
+            # the others find it empty
+            self.stat_cache.load()
+        filenames = set()
+        for deps in self.deps.values():
+            filenames.update(deps)
+        filenames = [f for f in filenames if f not in self.hash_cache]
+        if filenames:
+            pool = multiprocessing.dummy.Pool(max(jobs, 1))
+            try:
+                # hand each thread batches of files for the hasher's hash_many()
+                size = len(filenames) // (max(jobs, 1) * 4) + 1
+                batches = [filenames[i:i+size]
+                           for i in range(0, len(filenames), size)]
+                pool.map(self._cached_hash_many, batches)
+            finally:
+                pool.close()
+                pool.join()
+        self.prehash_time = time.time() - time0
+        self.echo('prehashed %d files in %.3f seconds using %d threads'
+                  % (len(filenames), self.prehash_time, jobs))
+        return self.prehash_time
+
+    def deps_key(self, command):
+        """ Return the key of command line command's entry in the deps:
+            the command line, or if it's longer than digest_commands, a
+            fixed-size digest of it. """
+        if self.digest_commands is None or \
+           len(command) <= self.digest_commands:
+            return command
+        return 'md5:' + md5func(_encode_string(command)).hexdigest()
+
+    def _shard_of(self, command):
+        """ Return the name of the shard command goes in, or None for the
+            default. """
+        if self.shard != 'function':
+            return self.shard(command)
+        # the first caller outside fabricate, which may be a method of a
+        # Builder subclass
+        frame = sys._getframe(1)
+        while frame is not None and frame.f_globals is globals():
+            frame = frame.f_back
+        if frame is None or frame.f_code.co_name == '<module>':
+            return None
+        return frame.f_code.co_name
+
     def cmdline_outofdate(self, command):
         """ Return True if given command line is out of date. """
-        if command in self.deps:
+        key = self.deps_key(command)
+        if self.shard is not None:
+            self.deps.place(key, self._shard_of(command))
+        if key != command and key not in self.deps and command in self.deps:
+            # saved by a fabricate that keyed it by the command line
+            self.deps[key] = self.deps[command]
+            self.deps.set_name(key, command)
+            del self.deps[command]
+        if self.changed is not None:
+            if self._dirty is None:
+                self._dirty = set(self.affected(self.changed))
+            if command not in self._dirty:
+                if key in self.deps:
+                    self.deps.touch(key, self.generation)
+                    return False
+                return True
+        elif self.hash_jobs and self.prehash_time is None:
+            self.prehash()
+        entry = self.deps.get(key)
+        if entry is not None:
+            self.deps.touch(key, self.generation)
             # command has been run before, see if deps have changed
-            for dep, oldhash in self.deps[command].items():
+            newhashes = self._cached_hash_many(list(entry))
+            for dep, oldhash in entry.items():
                 assert oldhash.startswith('input-') or \
                        oldhash.startswith('output-'), \
                     "%s file corrupt, do a clean!" % self.depsname
                 io_type, oldhash = oldhash.split('-', 1)
 
                 # make sure this dependency or output hasn't changed
-                if dep in self.hash_cache:
-                    # already hashed so don't repeat hashing work
-                    newhash = self.hash_cache[dep]
-                else:
-                    # not in hash_cache so make sure this dependency or
-                    # output hasn't changed
-                    newhash = self.hasher(dep)
-                    if newhash is not None:
-                       # Add newhash to the hash cache
-                       self.hash_cache[dep] = newhash
+                newhash = newhashes[dep]
 
                 if newhash is None:
                     self.echo_debug("rebuilding %r, %s %s doesn't exist" %
@@ -1295,6 +4220,13 @@ class Builder(object):
             outputs.extend(dep for dep, hashed in deps.items()
                            if hashed.startswith('output-'))
         outputs.append(self.depsname)
+        self._deps.close()
+        outputs.extend(path for path in self._deps.paths()[1:]
+                       if os.path.exists(path))
+        if os.path.exists(self.depsname + '.stat'):
+            outputs.append(self.depsname + '.stat')
+        if self.stat_cache is not None:
+            self.stat_cache.entries = None
         self._deps = None
         for output in outputs:
             try:
@@ -1329,34 +4261,78 @@ class Builder(object):
 
     def read_deps(self):
         """ Read dependency JSON file into deps object. """
-        try:
-            f = open(self.depsname)
-            try:
-                self._deps = json.load(f)
-                # make sure the version is correct
-                if self._deps.get('.deps_version', 0) != deps_version:
-                    printerr('Bad %s dependency file version! Rebuilding.'
-                             % self.depsname)
-                    self._deps = {}
-                self._deps.pop('.deps_version', None)
-            finally:
-                f.close()
-        except IOError:
-            self._deps = {}
+        if self.shard is not None:
+            self._deps = ShardedDeps(self.depsname, journal=self.journal,
+                                     checkpoint=self.checkpoint)
+        else:
+            self._deps = open_deps(self.depsname, journal=self.journal,
+                                   checkpoint=self.checkpoint)
+        self._deps.load()
+        self.generation = self._deps.generation + 1
+        # files written before hashers were tagged are taken as-is
+        tag = self._deps.hasher
+        if tag is not None and tag != hasher_name(self.hasher):
+            self.rehash_deps(tag)
+            if self.journal:
+                # before journalling any entries made by the new hasher
+                self._deps.save(hasher=hasher_name(self.hasher))
+
+    def rehash_deps(self, old_name):
+        """ Convert the hashes in deps, made by the hasher named old_name, to
+            hashes made by this builder's hasher. Files that still match their
+            old hash are re-hashed so their commands stay up to date; files
+            that don't (or if old_name's hasher isn't available) keep their
+            old hash, which won't match, so their commands get rebuilt. """
+        old_hasher = hashers.get(old_name)
+        if old_hasher is None:
+            printerr('%s was hashed with unknown hasher %r! Rebuilding.'
+                     % (self.depsname, old_name))
+            return
+        self.echo_debug('rehashing %s from %s to %s' %
+                        (self.depsname, old_name, hasher_name(self.hasher)))
+        old_hashes = {}
+        for command, deps in list(self._deps.items()):
+            rehashed = dict(deps)
+            for dep, hashed in deps.items():
+                io_type, oldhash = hashed.split('-', 1)
+                if dep not in old_hashes:
+                    old_hashes[dep] = old_hasher(dep)
+                if old_hashes[dep] is None or old_hashes[dep] != oldhash:
+                    continue
+                newhash = self._cached_hash(dep)
+                if newhash is not None:
+                    rehashed[dep] = io_type + '-' + newhash
+            if rehashed != deps:
+                self._deps[command] = rehashed
 
     def write_deps(self, depsname=None):
         """ Write out deps object into JSON dependency file. """
         if self._deps is None:
             return                      # we've cleaned so nothing to save
-        self.deps['.deps_version'] = deps_version
-        if depsname is None:
-            depsname = self.depsname
-        f = open(depsname, 'w')
-        try:
-            json.dump(self.deps, f, indent=4, sort_keys=True)
-        finally:
-            f.close()
-            self._deps.pop('.deps_version', None)
+        self._deps.save(depsname, hasher=hasher_name(self.hasher))
+
+    def gc(self, keep=0):
+        """ Remove the deps entries of commands that weren't used by this
+            build or the "keep" builds before it (so by default, those this
+            build didn't run or check), and save the deps compacted. Report
+            and return (entries removed, bytes reclaimed). """
+        deps = self.deps
+        size = self._deps_size()
+        oldest = self.generation - keep
+        generations = deps.generations()
+        stale = [command for command, generation in generations.items()
+                 if generation < oldest]
+        deps.remove(stale)
+        deps.save(hasher=hasher_name(self.hasher), compact=True)
+        reclaimed = size - self._deps_size()
+        self.echo('fabricate: gc removed %d of %d entries, reclaimed %d bytes'
+                  % (len(stale), len(generations), reclaimed))
+        return len(stale), reclaimed
+
+    def _deps_size(self):
+        """ Return the total size of the files the deps are stored in. """
+        return sum(os.path.getsize(path) for path in self._deps.paths()
+                   if os.path.isfile(path))
 
     _runner_map = {
         'atimes_runner' : AtimesRunner,
@@ -1381,24 +4357,96 @@ class Builder(object):
                 # pass builder to runner class to get a runner instance
                 self.runner = runner(self)
 
+    def _dirs_tree(self):
+        """ Return the absolute dependency search directories as a tree of
+            dicts keyed by path component, where a None key holds the
+            directory that ends at that node. Relative dirs are relative to
+            the current directory, so there's a tree for each one. """
+        cwd = os.getcwd()
+        trie = self._dirs_tries.get(cwd)
+        if trie is None:
+            trie = self._dirs_tries[cwd] = {}
+            for path in self.dirs:
+                path = os.path.abspath(path)
+                node = trie
+                for part in path.rstrip(os.sep).split(os.sep):
+                    node = node.setdefault(part, {})
+                node[None] = path
+        return trie
+
     def _is_relevant(self, fullname):
         """ Return True if file is in the dependency search directories. """
 
         # need to abspath to compare rel paths with abs
         fullname = os.path.abspath(fullname)
-        for path in self.dirs:
-            path = os.path.abspath(path)
-            if fullname.startswith(path):
+        node = self._dirs_tree()
+        for part in fullname.rstrip(os.sep).split(os.sep) + [None]:
+            path = node.get(None)
+            if path is not None:
                 rest = fullname[len(path):]
-                # files in dirs starting with ignoreprefix are not relevant
-                if os.sep+self.ignoreprefix in os.sep+os.path.dirname(rest):
-                    continue
-                # files deeper than dirdepth are not relevant
-                if rest.count(os.sep) > self.dirdepth:
-                    continue
-                return True
+                # files in dirs starting with ignoreprefix are not relevant,
+                # nor are files deeper than dirdepth
+                if (os.sep+self.ignoreprefix not in
+                        os.sep+os.path.dirname(rest) and
+                        rest.count(os.sep) <= self.dirdepth):
+                    return True
+            node = node.get(part)
+            if node is None:
+                break
         return False
 
+    def affected(self, filenames):
+        """ Return the list of commands that read or write any of the given
+            files, or (transitively) any output of those commands, as found
+            by the deps' reverse index. """
+        affected = []
+        seen = set()
+        checked = set()
+        pending = list(filenames)
+        while pending:
+            filename = pending.pop()
+            names = set([filename, os.path.abspath(filename)])
+            try:
+                names.add(os.path.relpath(filename))
+            except ValueError:
+                pass            # on another drive
+            for name in names - checked:
+                checked.add(name)
+                for command in sorted(self.deps.users(name)):
+                    if command in seen:
+                        continue
+                    seen.add(command)
+                    affected.append(command)
+                    pending.extend(dep for dep, hashed in
+                                   self.deps[command].items()
+                                   if hashed.startswith('output-'))
+        return [self.deps.name(command) for command in affected]
+
+    def __getstate__(self):
+        # the builder is pickled along with its runner for each parallel job,
+        # and the workers have no use for the (potentially huge) deps; its
+        # hash caches pickle as empty ones too
+        state = self.__dict__.copy()
+        state.pop('_deps', None)
+        return state
+
+    def _toolchain_dep(self, fullname):
+        """ Return the pseudo-dependency for the toolchain tree that file
+            fullname is in, or None if it isn't in one. """
+        if not self.toolchain:
+            return None
+        fullname = os.path.abspath(fullname)
+        for path in self.toolchain:
+            if fullname == path or fullname.startswith(path.rstrip(os.sep) + os.sep):
+                return toolchain_prefix + path
+        return None
+
+    def _runner_sees_toolchain(self):
+        """ Return True if the runner reports toolchain use itself. """
+        actual_runner = getattr(self.runner, 'actual_runner', None)
+        return actual_runner is not None and \
+               isinstance(actual_runner(), StraceRunner)
+
     def _join_results_handler(self):
         """Stops then joins the results handler thread"""
         _stop_results.set()
@@ -1499,8 +4547,19 @@ def parse_options(usage=_usage, extra_options=None, command_line=None):
     parser.disable_interspersed_args()
     parser.add_option('-t', '--time', action='store_true',
                       help='use file modification times instead of MD5 sums')
+    parser.add_option('-s', '--stat', action='store_true',
+                      help='use MD5 sums (or the -H hasher), but only '
+                           're-hash files whose size, inode or modification '
+                           'time changed')
+    parser.add_option('-H', '--hasher', type='choice',
+                      choices=sorted(hashers),
+                      help='hash files with HASHER, one of: %s'
+                           % ', '.join(sorted(hashers)))
     parser.add_option('-d', '--dir', action='append',
                       help='add DIR to list of relevant directories')
+    parser.add_option('-T', '--toolchain', action='append',
+                      help='fingerprint read-only TOOLCHAIN dir or file as a '
+                           'whole instead of tracking its files')
     parser.add_option('-c', '--clean', action='store_true',
                       help='autoclean build outputs before running')
     parser.add_option('-q', '--quiet', action='store_true',
@@ -1511,6 +4570,27 @@ def parse_options(usage=_usage, extra_options=None, command_line=None):
                       help='keep temporary strace output files')
     parser.add_option('-j', '--jobs', type='int',
                       help='maximum number of parallel jobs')
+    parser.add_option('-J', '--hash-jobs', type='int',
+                      help='hash all known dependencies up front using '
+                           'HASH_JOBS threads')
+    parser.add_option('--affected', action='store_true',
+                      help='print the commands affected by changes to the '
+                           'files given as arguments and exit')
+    parser.add_option('--changed', action='append', metavar='FILE',
+                      help='only FILE (and others given this way) changed '
+                           'since the last build, only check commands '
+                           'affected by them')
+    parser.add_option('--shard', choices=['function'],
+                      help="split the dependency file into one per build "
+                           "script function (in DEPSNAME.shards), loaded "
+                           "as they're used")
+    parser.add_option('--gc', type='int', metavar='N',
+                      help='after building, remove dependency entries not '
+                           'used by this build or the N before it')
+    parser.add_option('--convert-deps', nargs=2, metavar='FROM TO',
+                      help='convert dependency file FROM to TO (JSON, '
+                           'binary if named *.bin or SQLite if named '
+                           '*.sqlite) and exit')
     if extra_options:
         # add any user-specified options passed in via main()
         for option in extra_options:
@@ -1565,14 +4645,35 @@ def main(globals_dict=None, build_dir=None, extra_options=None, builder=None,
         parser, options, actions = _parsed_options
     else:
         parser, options, actions = parse_options(extra_options=extra_options, command_line=command_line)
+    if options.convert_deps:
+        convert_deps(*options.convert_deps)
+        sys.exit(0)
     kwargs['quiet'] = options.quiet
     kwargs['debug'] = options.debug
+    if options.time and (options.hasher or options.stat):
+        parser.error('-t/--time hashes by modification time, so it can\'t '
+                     'be used with -H/--hasher or -s/--stat')
+    if options.hasher:
+        kwargs['hasher'] = options.hasher
+        if options.stat:
+            # keep the chosen hasher, but only re-hash changed files
+            kwargs['stat_cache'] = True
+    elif options.stat:
+        kwargs['hasher'] = hybrid_hasher
     if options.time:
         kwargs['hasher'] = mtime_hasher
     if options.dir:
         kwargs['dirs'] = options.dir
+    if options.toolchain:
+        kwargs['toolchain'] = options.toolchain
     if options.keep:
         StraceRunner.keep_temps = options.keep
+    if options.hash_jobs is not None:
+        kwargs['hash_jobs'] = options.hash_jobs
+    if options.changed:
+        kwargs['changed'] = options.changed
+    if options.shard:
+        kwargs['shard'] = options.shard
     main.options = options
     if options.jobs is not None:
         jobs = options.jobs
@@ -1611,6 +4712,11 @@ def main(globals_dict=None, build_dir=None, extra_options=None, builder=None,
         use_builder = builder
     default_builder = use_builder(**kwargs)
 
+    if options.affected:
+        for command in default_builder.affected(actions):
+            print(command)
+        sys.exit(0)
+
     if options.clean:
         default_builder.autoclean()
 
@@ -1628,6 +4734,10 @@ def main(globals_dict=None, build_dir=None, extra_options=None, builder=None,
                 printerr('%r command not defined!' % action)
                 sys.exit(1)
         after() # wait till the build commands are finished
+        default_builder.echo_debug('hash cache: '
+                                   + default_builder.hash_cache.stats())
+        if options.gc is not None:
+            default_builder.gc(options.gc)
     except ExecutionError as exc:
         message, data, status = exc.args
         printerr('fabricate: ' + message)
@@ -1641,9 +4751,18 @@ def main(globals_dict=None, build_dir=None, extra_options=None, builder=None,
 def cli():
     # if called as a script, emulate memoize.py -- run() command line
     parser, options, args = parse_options('[options] command line to run')
+    if options.convert_deps:
+        convert_deps(*options.convert_deps)
+        sys.exit(0)
     status = 0
-    if args:
+    if options.affected:
+        _set_default_builder()
+        for command in default_builder.affected(args):
+            print(command)
+    elif args:
         status = memoize(args)
+        if options.gc is not None:
+            default_builder.gc(options.gc)
     elif not options.clean:
         parser.print_help()
         status = 1
@@ -32,6 +32,7 @@ def test_create(builddir, runner):
             'foo.tar.gz': 'output-',
             'a.c': 'input-'
         },
+        '.deps_hasher': 'md5',
         '.deps_version': 2
     }
 
@@ -10,7 +10,7 @@ from copy import copy
 
 
 from fabricate import *
-from fabricate import md5func
+from fabricate import md5func, get_hasher, hasher_name
 from conftest import *
 
 EMPTY_FILE_MD5 = 'd41d8cd98f00b204e9800998ecf8427e'
@@ -31,3 +31,1188 @@ def test_md5_hasher(builddir):
         assert md5_hasher('testlink_nofile') == md5func('nofile'.encode('utf-8')).hexdigest()
 
 
+
+def test_md5_hasher_streaming(builddir, monkeypatch):
+    import fabricate
+    data = os.urandom(3*1024 + 17)
+    expected = md5func(data).hexdigest()
+    with local.cwd(builddir):
+        with open('bigfile', 'wb') as f:
+            f.write(data)
+        monkeypatch.setattr(fabricate, 'hash_chunk_size', 4096)
+        # chunked read() path
+        assert md5_hasher('bigfile') == expected
+        # mmap path
+        monkeypatch.setattr(fabricate, 'hash_mmap_threshold', 1024)
+        assert md5_hasher('bigfile') == expected
+
+def test_stat_cache(builddir, monkeypatch):
+    import atexit
+    monkeypatch.setattr(atexit, 'register', lambda *args, **kwargs: None)
+    calls = []
+    def hasher(filename):
+        calls.append(filename)
+        return md5_hasher(filename)
+    with local.cwd(builddir):
+        with open('testfile', 'w') as f:
+            f.write('one')
+        cache = StatCache('cache.stat', 'md5')
+        # freshly written files are "racy" so must be re-hashed
+        assert cache.hash('testfile', hasher) == md5func(b'one').hexdigest()
+        assert cache.hash('testfile', hasher) == md5func(b'one').hexdigest()
+        assert len(calls) == 2
+        # once old enough the stat signature is trusted
+        old = os.stat('testfile').st_mtime - 10
+        os.utime('testfile', (old, old))
+        cache.hash('testfile', hasher)
+        cache.hash('testfile', hasher)
+        assert len(calls) == 3
+        cache.save()
+        cache = StatCache('cache.stat', 'md5')
+        cache.hash('testfile', hasher)
+        assert len(calls) == 3
+        # a different hasher tag invalidates the cache file
+        StatCache('cache.stat', 'other').hash('testfile', hasher)
+        assert len(calls) == 4
+        with open('testfile', 'w') as f:
+            f.write('two')
+        os.utime('testfile', (old, old))
+        assert cache.hash('testfile', hasher) == md5func(b'two').hexdigest()
+        assert len(calls) == 5
+
+def test_stat_cache_threads(builddir, monkeypatch):
+    import atexit
+    import json
+    import threading
+    import time
+    monkeypatch.setattr(atexit, 'register', lambda *args, **kwargs: None)
+    with local.cwd(builddir):
+        with open('testfile', 'w') as f:
+            f.write('one')
+        old = os.stat('testfile').st_mtime - 10
+        os.utime('testfile', (old, old))
+        cache = StatCache('cache.stat', 'md5')
+        cache.hash('testfile', md5_hasher)
+        cache.save()
+
+        # the other threads wait for the (slow) load instead of finding the
+        # cache empty and hashing again
+        load = json.load
+        def slow_load(f):
+            time.sleep(0.1)
+            return load(f)
+        monkeypatch.setattr(json, 'load', slow_load)
+        calls = []
+        def hasher(filename):
+            calls.append(filename)
+            return md5_hasher(filename)
+        cache = StatCache('cache.stat', 'md5')
+        threads = [threading.Thread(target=cache.hash,
+                                    args=('testfile', hasher))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert calls == []
+        assert list(cache.entries) == ['testfile']
+
+class ListRunner(Runner):
+    """ Runner that reports the files named in its "deps" and "outputs"
+        keyword arguments instead of tracing the command. """
+    def __init__(self, builder):
+        self._builder = builder
+
+    def __call__(self, *args, **kwargs):
+        deps = kwargs.pop('deps', [])
+        outputs = kwargs.pop('outputs', [])
+        shell(*args, **kwargs)
+        return list(deps), list(outputs)
+
+@pytest.fixture
+def no_atexit(monkeypatch):
+    """ Collect atexit handlers registered by the test so they can be run
+        explicitly instead of at interpreter exit """
+    import atexit
+    handlers = []
+    monkeypatch.setattr(atexit, 'register',
+                        lambda func, *args, **kwargs: handlers.append((func, args, kwargs)))
+    def run():
+        while handlers:
+            func, args, kwargs = handlers.pop()
+            func(*args, **kwargs)
+    return run
+
+def test_prehash(builddir, no_atexit):
+    with local.cwd(builddir):
+        for name in ['a.c', 'b.c', 'c.h']:
+            with open(name, 'w') as f:
+                f.write(name)
+        builder = Builder(runner=ListRunner, quiet=True)
+        builder.run('true', deps=['a.c', 'c.h'], outputs=[])
+        builder.run('echo', deps=['b.c', 'c.h'], outputs=[])
+        no_atexit()
+
+        builder = Builder(runner=ListRunner, quiet=True, hash_jobs=4)
+        assert builder.run('true', deps=['a.c', 'c.h'], outputs=[]) == \
+            ('true', None, None)
+        assert builder.prehash_time is not None
+        assert sorted(builder.hash_cache) == ['a.c', 'b.c', 'c.h']
+        assert builder.hash_cache['b.c'] == md5func(b'b.c').hexdigest()
+
+def test_hasher_switch(builddir, no_atexit):
+    import json
+    with local.cwd(builddir):
+        for name in ['a.c', 'b.c']:
+            with open(name, 'w') as f:
+                f.write(name)
+        builder = Builder(runner=ListRunner, quiet=True)
+        builder.run('true', deps=['a.c'], outputs=[])
+        builder.run('echo', deps=['b.c'], outputs=[])
+        no_atexit()
+        with open('.deps') as f:
+            assert json.load(f)['.deps_hasher'] == 'md5'
+
+        with open('b.c', 'w') as f:
+            f.write('changed')
+        builder = Builder(runner=ListRunner, quiet=True, hasher='blake2b')
+        assert builder.hasher is blake2b_hasher
+        # a.c is unchanged so only needs re-hashing, b.c changed so rebuild
+        assert builder.run('true', deps=['a.c'], outputs=[]) == \
+            ('true', None, None)
+        assert builder.run('echo', deps=['b.c'], outputs=[]) == \
+            ('echo', ['b.c'], [])
+        no_atexit()
+        with open('.deps') as f:
+            deps = json.load(f)
+        assert deps['.deps_hasher'] == 'blake2b'
+        assert deps['true'] == {'a.c': 'input-' + blake2b_hasher('a.c')}
+
+def test_xxhash_optional(monkeypatch):
+    import fabricate
+    if fabricate.xxhash is not None:
+        assert get_hasher('xxhash') is fabricate.xxhash_hasher
+        assert hasher_name(fabricate.xxhash_hasher) == fabricate.xxhash_name
+        return
+    # without the xxhash module there's no hasher to fail mid-build
+    assert 'xxhash_hasher' not in fabricate.__all__
+    assert not hasattr(fabricate, 'xxhash_hasher')
+    with pytest.raises(ValueError):
+        get_hasher('xxhash')
+    errors = []
+    monkeypatch.setattr('optparse.OptionParser.error',
+                        lambda self, message: errors.append(message))
+    parse_options(command_line=['-H', 'xxhash'])
+    assert 'xxhash' in errors[0]
+
+def test_hasher_options(builddir, no_atexit, monkeypatch):
+    import fabricate
+    class NoBuild(FabricateBuild):
+        pass
+    def hasher_of(*command_line):
+        NoBuild(build_dir=builddir, runner=ListRunner).main(
+            command_line=list(command_line) + ['build'])
+        no_atexit()
+        return fabricate.default_builder
+    builder = hasher_of('-s')
+    assert builder.hasher is hybrid_hasher and builder.stat_cache is not None
+    # -s keeps the hasher -H chose, adding a stat cache
+    builder = hasher_of('-H', 'blake2b', '-s')
+    assert builder.hasher is blake2b_hasher
+    assert builder.stat_cache is not None
+    assert hasher_of('-t').hasher is mtime_hasher
+
+    def error(self, message):
+        raise ValueError(message)
+    monkeypatch.setattr('optparse.OptionParser.error', error)
+    for command_line in [['-t', '-s'], ['-t', '-H', 'md5']]:
+        with pytest.raises(ValueError):
+            hasher_of(*command_line)
+
+def test_hybrid_hasher(builddir, no_atexit):
+    with local.cwd(builddir):
+        with open('a.c', 'w') as f:
+            f.write('a.c')
+        old = os.stat('a.c').st_mtime - 10
+        os.utime('a.c', (old, old))
+        builder = Builder(runner=ListRunner, quiet=True)
+        builder.run('true', deps=['a.c'], outputs=[])
+        no_atexit()
+
+        # same tag as md5_hasher, so switching needs no rehash
+        builder = Builder(runner=ListRunner, quiet=True, hasher='hybrid')
+        assert builder.stat_cache is not None
+        assert builder.run('true', deps=['a.c'], outputs=[]) == \
+            ('true', None, None)
+        no_atexit()
+        assert os.path.exists('.deps.stat')
+
+        # touching a file re-hashes it, but doesn't rebuild
+        os.utime('a.c', None)
+        builder = Builder(runner=ListRunner, quiet=True, hasher='hybrid')
+        assert builder.run('true', deps=['a.c'], outputs=[]) == \
+            ('true', None, None)
+        no_atexit()
+
+def test_hash_cache_single_flight():
+    import pickle
+    import threading
+    import time
+    calls = []
+    def slow_hasher(filename):
+        calls.append(filename)
+        time.sleep(0.05)
+        return 'hash-' + filename
+    cache = HashCache()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+                   cache.hash('header.h', slow_hasher))) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == ['header.h']
+    assert results == ['hash-header.h'] * 8
+    assert cache.misses == 1 and cache.coalesced + cache.hits == 7
+    assert cache.hash('header.h', slow_hasher) == 'hash-header.h'
+    # hashes of missing files aren't cached
+    assert cache.hash('missing', lambda filename: None) is None
+    assert 'missing' not in cache
+    # parallel workers get an empty cache rather than every hash so far
+    copy = pickle.loads(pickle.dumps(cache))
+    assert copy == {} and not copy.pending
+    assert copy.hash('header.h', slow_hasher) == 'hash-header.h'
+    assert copy.misses == 1
+
+def test_hash_cache_error():
+    import threading
+    import time
+    started = threading.Event()
+    def failing_hasher(filename):
+        started.set()
+        time.sleep(0.2)
+        raise IOError('%s: permission denied' % filename)
+    cache = HashCache()
+    errors = []
+    def hash_header():
+        try:
+            cache.hash('header.h', failing_hasher)
+        except IOError as e:
+            errors.append(e)
+    leader = threading.Thread(target=hash_header)
+    leader.start()
+    started.wait()
+    waiters = [threading.Thread(target=hash_header) for i in range(4)]
+    for thread in waiters:
+        thread.start()
+    for thread in [leader] + waiters:
+        thread.join()
+    # waiters get the leader's error, not None as if the file was missing
+    assert len(errors) == 5
+    assert cache.misses == 1 and cache.coalesced == 4
+    assert 'header.h' not in cache and not cache.pending
+    with pytest.raises(IOError):
+        cache.hash_many(['a.h', 'b.h'], lambda filenames: failing_hasher('a.h'))
+    assert not cache.pending
+    assert cache.hash('header.h', lambda filename: 'hash') == 'hash'
+
+def test_worker_hashes(builddir, no_atexit):
+    import json
+    import pickle
+    import fabricate
+    with local.cwd(builddir):
+        for name in ['a.c', 'a.o']:
+            with open(name, 'w') as f:
+                f.write(name)
+        builder = Builder(runner=ListRunner, quiet=True, stat_cache=True,
+                          hasher=MerkleHasher())
+        builder.deps    # builder's deps aren't sent to the workers
+        os.mkdir('sub')
+        builder._cached_hash_many(['a.c', 'sub'])
+        assert builder.hash_cache and builder.stat_cache.entries is not None
+        assert builder.hasher.dirs
+        builder.stat_cache.save()
+        # nor are its caches: workers get the names of the files already
+        # hashed, and read (but never save) the stat cache file
+        worker_runner = pickle.loads(pickle.dumps(builder.runner))
+        worker = worker_runner._builder
+        assert not hasattr(worker, '_deps')
+        assert worker.hash_cache == {}
+        assert worker.hash_cache.known == set(['a.c', 'sub'])
+        assert worker.stat_cache.entries is None
+        assert worker.stat_cache.read_only
+        assert worker.hasher.dirs == {}
+        assert worker.hasher.cache is worker.stat_cache
+        worker.stat_cache.load()
+        assert worker.stat_cache.entries == builder.stat_cache.entries
+        worker.stat_cache.entries = {}
+        worker.stat_cache.save()
+        with open(builder.stat_cache.filename) as f:
+            assert json.load(f)['entries'] == builder.stat_cache.entries
+
+        with open('b.c', 'w') as f:
+            f.write('b.c')
+        builder = Builder(runner=ListRunner, quiet=True)
+        builder._cached_hash('a.c')
+        worker_runner = pickle.loads(pickle.dumps(builder.runner))
+        deps, outputs, hashes = fabricate._call_strace(
+            worker_runner, 'true', deps=['a.c', 'b.c'], outputs=['a.o'])
+        # the worker only hashed the deps the builder hadn't
+        assert hashes == {'b.c': md5_hasher('b.c'), 'a.o': md5_hasher('a.o')}
+
+        # done() uses the worker's hashes instead of hashing again
+        def no_hasher(filename):
+            raise AssertionError('%s hashed twice' % filename)
+        builder.hasher = no_hasher
+        builder.done('true', deps, outputs, hashes)
+        assert builder.deps['true'] == {'a.c': 'input-' + md5_hasher('a.c'),
+                                        'b.c': 'input-' + hashes['b.c'],
+                                        'a.o': 'output-' + hashes['a.o']}
+        no_atexit()
+
+def test_hash_many(builddir, monkeypatch):
+    import fabricate
+    with local.cwd(builddir):
+        sh.touch('testfile')
+        sh.mkdir('testdir')
+        sh.ln('-s', 'testfile', 'testlink')
+        sh.ln('-s', 'nofile', 'testlink_nofile')
+        with open('bigfile', 'wb') as f:
+            f.write(os.urandom(10000))
+        monkeypatch.setattr(fabricate, 'hash_chunk_size', 4096)
+        names = ['testfile', 'testdir', 'testlink', 'testlink_nofile',
+                 'bigfile', 'nofile']
+        for hasher in [md5_hasher, mtime_hasher, blake2b_hasher]:
+            assert fabricate.hash_many(hasher, names) == \
+                dict((name, hasher(name)) for name in names)
+
+        cache = HashCache({'testfile': 'cached'})
+        batches = []
+        def hasher_many(filenames):
+            batches.append(filenames)
+            return fabricate.hash_many(md5_hasher, filenames)
+        hashes = cache.hash_many(names + ['testfile'], hasher_many)
+        assert batches == [names[1:]]
+        assert hashes['testfile'] == 'cached'
+        assert hashes['bigfile'] == md5_hasher('bigfile')
+        assert 'nofile' not in cache
+
+def test_merkle_hasher(builddir, monkeypatch, no_atexit):
+    import fabricate
+    with local.cwd(builddir):
+        sh.mkdir('-p', 'tree/a/b', 'tree/c')
+        for name in ['tree/top', 'tree/a/b/deep', 'tree/c/other']:
+            with open(name, 'w') as f:
+                f.write(name)
+        sh.ln('-s', 'a', 'tree/link')
+        old = os.stat('tree').st_mtime - 10
+        for path in ['tree/top', 'tree/a/b/deep', 'tree/c/other',
+                     'tree/a/b', 'tree/a', 'tree/c', 'tree']:
+            os.utime(path, (old, old))
+        calls = []
+        def content_hasher(filename):
+            if not os.path.islink(filename):    # links are always re-read
+                calls.append(filename)
+            return md5_hasher(filename)
+        hasher = MerkleHasher(content_hasher)
+        first = hasher('tree')
+        assert first != md5_hasher('tree')
+        assert hasher('tree/top') == md5_hasher('tree/top')
+        assert len(calls) == 3
+        assert hasher('tree') == first and len(calls) == 3
+
+        # a change deep in the tree only re-reads that file
+        with open('tree/a/b/deep', 'w') as f:
+            f.write('changed')
+        os.utime('tree/a/b/deep', (old, old))
+        second = hasher('tree')
+        assert second != first
+        assert calls[3:] == ['tree/a/b/deep']
+        assert MerkleHasher()('tree') == second
+        # a new file changes the hash too
+        sh.touch('tree/c/new')
+        assert hasher('tree') not in (first, second)
+
+        # an unreadable directory is hashed like a missing file
+        assert MerkleHasher()('missing') is None
+        listdir = os.listdir
+        def failing_listdir(path):
+            if path == os.path.join('tree', 'c'):
+                raise OSError(13, 'Permission denied')
+            return listdir(path)
+        monkeypatch.setattr(os, 'listdir', failing_listdir)
+        fresh = MerkleHasher()
+        assert fresh('tree/c') is None
+        assert fresh('tree') not in (None, first, second)
+        monkeypatch.setattr(os, 'listdir', listdir)
+
+        # each builder has its own, sharing its own stat cache
+        builder = Builder(runner=ListRunner, quiet=True, hasher='merkle',
+                          stat_cache=True)
+        other = Builder(runner=ListRunner, quiet=True, hasher='merkle',
+                        depsname='.other.deps', stat_cache=True)
+        assert builder.hasher is not other.hasher
+        assert builder.hasher.cache is builder.stat_cache
+        assert other.hasher.cache is other.stat_cache
+        shared = fabricate.hashers['merkle']
+        assert shared.cache is None and not shared.dirs
+        assert builder.hasher('tree') == other.hasher('tree')
+        assert builder.hasher.dirs and not shared.dirs
+        no_atexit()
+
+def test_toolchain(builddir, no_atexit):
+    with local.cwd(builddir):
+        sh.mkdir('-p', 'sdk/include/sys')
+        sh.touch('sdk/include/sys/types.h', 'a.c')
+        sdk = os.path.abspath('sdk')
+        assert toolchain_fingerprint('nosdk') is None
+        first = toolchain_fingerprint(sdk)
+
+        builder = Builder(runner=ListRunner, quiet=True, toolchain=['sdk'])
+        command, deps, outputs = builder.run('true', deps=['a.c'], outputs=[])
+        assert builder.deps['true'] == {
+            'a.c': 'input-' + md5_hasher('a.c'),
+            'toolchain:' + sdk: 'input-' + first}
+        no_atexit()
+
+        builder = Builder(runner=ListRunner, quiet=True, toolchain=['sdk'])
+        assert builder.run('true', deps=['a.c'], outputs=[]) == \
+            ('true', None, None)
+        no_atexit()
+
+        # a new header deep in the SDK means an upgrade, so rebuild
+        sh.touch('sdk/include/sys/new.h')
+        assert toolchain_fingerprint(sdk) != first
+        builder = Builder(runner=ListRunner, quiet=True, toolchain=['sdk'])
+        assert builder.run('true', deps=['a.c'], outputs=[])[1] is not None
+        no_atexit()
+
+def test_deps_journal(builddir, no_atexit, monkeypatch):
+    import json
+    with local.cwd(builddir):
+        for name in ['a.c', 'b.c']:
+            with open(name, 'w') as f:
+                f.write(name)
+        builder = Builder(runner=ListRunner, quiet=True, journal=True)
+        builder.run('true', deps=['a.c'], outputs=[])
+        no_atexit()
+        # no .deps file yet, so the first save writes it in full
+        assert not os.path.exists('.deps.journal')
+        with open('.deps') as f:
+            assert list(json.load(f)) == ['.deps_generation', '.deps_hasher',
+                                          '.deps_used', '.deps_version', 'true']
+
+        monkeypatch.setattr(JsonDeps, 'compact_ratio', 100)
+        builder = Builder(runner=ListRunner, quiet=True, journal=True)
+        builder.run('echo', deps=['b.c'], outputs=[])
+        no_atexit()
+        # the new entry is only in the journal
+        with open('.deps') as f:
+            assert 'echo' not in json.load(f)
+        with open('.deps.journal') as f:
+            assert [json.loads(line)[0] for line in f] == ['echo', '.deps_used']
+        builder = Builder(runner=ListRunner, quiet=True, journal=True)
+        assert builder.run('echo', deps=['b.c'], outputs=[]) == \
+            ('echo', None, None)
+        assert sorted(builder.deps) == ['echo', 'true']
+
+        # compacted once the journal gets big enough
+        monkeypatch.setattr(JsonDeps, 'compact_ratio', 0)
+        builder.run('echo', 'x', deps=['b.c'], outputs=[])
+        no_atexit()
+        assert not os.path.exists('.deps.journal')
+        with open('.deps') as f:
+            assert sorted(json.load(f)) == ['.deps_generation', '.deps_hasher',
+                                            '.deps_used', '.deps_version',
+                                            'echo', 'echo x', 'true']
+        builder.autoclean()
+        assert not os.path.exists('.deps')
+
+@pytest.mark.parametrize('deps_class,depsname', [(JsonDeps, '.deps'),
+                                                  (BinaryDeps, '.deps.bin')])
+def test_deps_journal_torn_line(builddir, deps_class, depsname):
+    import json
+    with local.cwd(builddir):
+        deps = deps_class(depsname, journal=True)
+        deps.load()
+        deps['true'] = {'a.c': 'input-1'}
+        deps.save(compact=True)
+        with open(depsname + '.journal', 'w') as f:
+            f.write(json.dumps(['echo', {'b.c': 'input-2'}]) + '\n')
+            f.write('["cut", {"c.c": "inp')    # killed while appending
+        deps = deps_class(depsname, journal=True)
+        deps.load()
+        assert sorted(deps) == ['echo', 'true']
+
+        # what the next build journals isn't lost along with the torn line
+        deps['ls'] = {'d.c': 'input-3'}
+        deps['cat'] = {'e.c': 'input-4'}
+        deps.close()
+        deps = deps_class(depsname, journal=True)
+        deps.load()
+        assert sorted(deps) == ['cat', 'echo', 'ls', 'true']
+        assert deps['ls'] == {'d.c': 'input-3'}
+        deps.close()
+
+def test_deps_checkpoint(builddir, no_atexit):
+    with local.cwd(builddir):
+        for name in ['a.c', 'b.c']:
+            with open(name, 'w') as f:
+                f.write(name)
+        builder = Builder(runner=ListRunner, quiet=True, checkpoint=0)
+        builder.run('true', deps=['a.c'], outputs=[])
+        builder.run('echo', deps=['b.c'], outputs=[])
+        # killed before the atexit handlers could write .deps
+        builder.deps.close()
+        assert not os.path.exists('.deps')
+
+        builder = Builder(runner=ListRunner, quiet=True, checkpoint=0)
+        assert builder.run('true', deps=['a.c'], outputs=[]) == \
+            ('true', None, None)
+        assert builder.run('echo', deps=['b.c'], outputs=[]) == \
+            ('echo', None, None)
+        no_atexit()
+        assert os.path.exists('.deps')
+        assert not os.path.exists('.deps.journal')
+        assert [name for name in os.listdir('.') if name.endswith('.tmp')] == []
+
+def test_binary_deps(builddir, no_atexit):
+    with local.cwd(builddir):
+        headers = dict(('include/h%d.h' % i, 'input-%032x' % i)
+                       for i in range(5))
+        deps = JsonDeps('.deps')
+        deps.hasher = 'md5'
+        for i in range(3):
+            entry = dict(headers)
+            entry['src/s%d.c' % i] = 'input-%032x' % (100 + i)
+            entry['s%d.o' % i] = 'output-%032x' % (200 + i)
+            deps['cc -c src/s%d.c' % i] = entry
+        deps['touch odd'] = {'odd': 'input-1234.5', 'caf\xe9': 'output-'}
+        deps.save()
+
+        convert_deps('.deps', '.deps.bin')
+        binary = BinaryDeps('.deps.bin')
+        binary.load()
+        assert binary.hasher == 'md5'
+        assert dict((c, dict(e)) for c, e in binary.items()) == \
+            dict(deps.items())
+        # the include directory's group is shared by all compile commands
+        groups = set(id(group) for c, e in binary.items() for group in e.groups)
+        assert len(groups) == 1 + 3 + 3 + 1
+        assert os.path.getsize('.deps.bin') < os.path.getsize('.deps')
+
+        convert_deps('.deps.bin', 'roundtrip.deps')
+        with open('.deps') as f1, open('roundtrip.deps') as f2:
+            assert f1.read() == f2.read()
+
+        # builds work the same with a binary dependency file
+        with open('a.c', 'w') as f:
+            f.write('a')
+        builder = Builder(runner=ListRunner, quiet=True, depsname='.deps.bin',
+                          journal=True)
+        builder.run('true', deps=['a.c'], outputs=[])
+        no_atexit()
+        builder = Builder(runner=ListRunner, quiet=True, depsname='.deps.bin')
+        assert builder.run('true', deps=['a.c'], outputs=[]) == \
+            ('true', None, None)
+        assert 'cc -c src/s1.c' in builder.deps
+
+def test_sqlite_deps(builddir, no_atexit):
+    import json
+    sqlite3 = pytest.importorskip('sqlite3')
+    with local.cwd(builddir):
+        for name in ['a.c', 'b.c']:
+            with open(name, 'w') as f:
+                f.write(name)
+        builder = Builder(runner=ListRunner, quiet=True,
+                          depsname='.deps.sqlite')
+        builder.run('true', deps=['a.c'], outputs=['a.o'])
+        builder.run('echo', deps=['a.c', 'b.c'], outputs=[])
+        # committed as each command finishes, readable by other processes
+        db = sqlite3.connect('.deps.sqlite')
+        assert db.execute('SELECT COUNT(*) FROM commands').fetchone()[0] == 2
+        db.close()
+        no_atexit()
+
+        with open('b.c', 'w') as f:
+            f.write('changed')
+        builder = Builder(runner=ListRunner, quiet=True,
+                          depsname='.deps.sqlite')
+        assert builder.deps.hasher == 'md5'
+        assert sorted(builder.deps['echo']) == ['a.c', 'b.c']
+        assert not builder.cmdline_outofdate('true')
+        assert builder.cmdline_outofdate('echo')
+        del builder.deps['true']
+        assert list(builder.deps) == ['echo']
+        no_atexit()
+
+        convert_deps('.deps.sqlite', '.deps')
+        convert_deps('.deps', 'copy.sqlite')
+        store = SqliteDeps('copy.sqlite')
+        store.load()
+        with open('.deps') as f:
+            data = json.load(f)
+        assert store.hasher == data.pop('.deps_hasher')
+        data.pop('.deps_version')
+        assert store.generation == data.pop('.deps_generation')
+        assert dict(store.generations()) == data.pop('.deps_used')
+        assert dict(store.items()) == data
+        store.close()
+
+def test_sqlite_deps_shared_compaction(builddir):
+    pytest.importorskip('sqlite3')
+    with local.cwd(builddir):
+        first = SqliteDeps('.deps.sqlite')
+        first.load()
+        first['cc a'] = {'a.c': 'input-1'}
+        # another build removes the entry and compacts, so a.c's files row
+        # goes and its id is reused for b.c
+        second = SqliteDeps('.deps.sqlite')
+        second.load()
+        del second['cc a']
+        second.save(compact=True)
+        second = SqliteDeps('.deps.sqlite')
+        second.load()
+        second['cc b'] = {'b.c': 'input-2'}
+        second.close()
+        first['cc a'] = {'a.c': 'input-3'}
+        assert first['cc a'] == {'a.c': 'input-3'}
+        assert first['cc b'] == {'b.c': 'input-2'}
+        first.close()
+
+def test_binary_deps_lazy(builddir):
+    with local.cwd(builddir):
+        deps = BinaryDeps('.deps.bin')
+        for i in range(50):
+            deps['cc %d' % i] = {'include/a.h': 'input-%032x' % 1,
+                                 'src/%d.c' % i: 'input-%032x' % i}
+        deps.save(hasher='md5')
+
+        deps = BinaryDeps('.deps.bin', journal=True)
+        deps.load()
+        # nothing is decoded until it's used
+        assert dict.__len__(deps) == 0
+        assert 'cc 7' in deps and 'cc 50' not in deps
+        assert dict(deps['cc 7']) == {'include/a.h': 'input-%032x' % 1,
+                                      'src/7.c': 'input-%032x' % 7}
+        assert deps.get('cc 50') is None
+        assert dict.__len__(deps) == 1
+        assert len(deps) == 50
+        del deps['cc 3']
+        deps['cc 50'] = {'src/50.c': 'input-%032x' % 50}
+        deps.save()
+        assert os.path.exists('.deps.bin.journal')
+
+        # from the journal, then from the compacted file
+        for attempt in range(2):
+            deps = BinaryDeps('.deps.bin', journal=True)
+            deps.load()
+            assert 'cc 3' not in deps and 'cc 50' in deps
+            assert sorted(deps) == sorted('cc %d' % i for i in range(51)
+                                          if i != 3)
+            assert deps.hasher == 'md5'
+            deps.write(deps.path)
+            deps.remove_journal()
+            # still readable after the file it was mapped from is replaced
+            assert dict(deps['cc 9'])['src/9.c'] == 'input-%032x' % 9
+
+@pytest.mark.parametrize('depsname', ['.deps', '.deps.bin', '.deps.sqlite'])
+def test_affected(builddir, no_atexit, depsname):
+    with local.cwd(builddir):
+        for name in ['a.c', 'b.c', 'c.h', 'd.c', 'a.o', 'b.o', 'prog']:
+            with open(name, 'w') as f:
+                f.write(name)
+        builder = Builder(runner=ListRunner, quiet=True, depsname=depsname)
+        builder.run('echo', 'a', deps=['a.c', 'c.h'], outputs=['a.o'])
+        builder.run('echo', 'b', deps=['b.c', 'c.h'], outputs=['b.o'])
+        builder.run('echo', 'link', deps=['a.o', 'b.o'], outputs=['prog'])
+        builder.run('echo', 'd', deps=['d.c'], outputs=[])
+        no_atexit()
+
+        builder = Builder(runner=ListRunner, quiet=True, depsname=depsname)
+        assert builder.affected(['a.c']) == ['echo a', 'echo link']
+        assert sorted(builder.affected(['c.h'])) == \
+            ['echo a', 'echo b', 'echo link']
+        assert builder.affected([os.path.abspath('d.c')]) == ['echo d']
+        assert builder.affected(['nothing.c']) == []
+        builder.deps['echo d'] = {'a.c': 'input-1'}
+        assert builder.affected(['d.c']) == []
+        assert sorted(builder.affected(['a.c'])) == \
+            ['echo a', 'echo d', 'echo link']
+        no_atexit()
+
+        # only commands affected by the changed files are checked
+        with open('a.c', 'w') as f:
+            f.write('changed')
+        with open('b.c', 'w') as f:
+            f.write('changed')
+        builder = Builder(runner=ListRunner, quiet=True, depsname=depsname,
+                          changed=['a.c'])
+        assert builder.cmdline_outofdate('echo a')
+        assert not builder.cmdline_outofdate('echo b')
+        assert builder.cmdline_outofdate('echo new')
+        no_atexit()
+
+@pytest.mark.parametrize('depsname', ['.deps', '.deps.bin'])
+@pytest.mark.parametrize('journal', [False, True])
+def test_deps_concurrent_builds(builddir, depsname, journal):
+    with local.cwd(builddir):
+        deps = open_deps(depsname)
+        deps['old'] = {'old.c': 'input-1'}
+        deps['gone'] = {'gone.c': 'input-1'}
+        deps.save(hasher='md5')
+
+        # two builds load the same file, then save in turn
+        first = open_deps(depsname, journal=journal)
+        first.load()
+        second = open_deps(depsname, journal=journal)
+        second.load()
+        first['a'] = {'a.c': 'input-1'}
+        del first['gone']
+        second['b'] = {'b.c': 'input-2'}
+        # the first build compacting the journal doesn't lose what the
+        # second appends to it later
+        first.compact_ratio = 0
+        first.save(hasher='md5')
+        second['c'] = {'c.c': 'input-3'}
+        second.save(hasher='md5')
+
+        deps = open_deps(depsname)
+        deps.load()
+        assert sorted(deps) == ['a', 'b', 'c', 'old']
+        assert dict(deps['c']) == {'c.c': 'input-3'}
+        deps.close()
+
+def test_deps_merge_unchanged(builddir, monkeypatch):
+    import fabricate
+    with local.cwd(builddir):
+        deps = open_deps('.deps')
+        deps.load()
+        deps['a'] = {'a.c': 'input-1'}
+        loads = []
+        load = fabricate.JsonDeps.load
+        monkeypatch.setattr(fabricate.JsonDeps, 'load',
+            lambda self: loads.append(self) or load(self))
+
+        # saving again without anyone else saving in between doesn't reload
+        deps.save(hasher='md5')
+        deps['b'] = {'b.c': 'input-2'}
+        deps.save(hasher='md5')
+        assert loads == []
+
+        # but does once another build has saved
+        other = open_deps('.deps')
+        other.load()
+        other['c'] = {'c.c': 'input-3'}
+        other.save(hasher='md5')
+        deps['d'] = {'d.c': 'input-4'}
+        deps.save(hasher='md5')
+        assert loads == [other, deps]
+        monkeypatch.undo()
+        deps = open_deps('.deps')
+        deps.load()
+        assert sorted(deps) == ['a', 'b', 'c', 'd']
+        deps.close()
+
+@pytest.mark.parametrize('depsname', ['.deps', '.deps.bin', '.deps.sqlite'])
+def test_deps_gc(builddir, no_atexit, depsname):
+    with local.cwd(builddir):
+        for name in ['a.c', 'b.c', 'c.c']:
+            with open(name, 'w') as f:
+                f.write(name)
+        builder = Builder(runner=ListRunner, quiet=True, depsname=depsname)
+        builder.run('echo', 'a', deps=['a.c'], outputs=[])
+        assert builder.generation == 1
+        builder.run('echo', 'b', deps=['b.c'], outputs=[])
+        builder.run('echo', 'c', deps=['c.c'], outputs=[])
+        no_atexit()
+
+        builder = Builder(runner=ListRunner, quiet=True, depsname=depsname)
+        builder.run('echo', 'a', deps=['a.c'], outputs=[])
+        assert builder.generation == 2
+        builder.run('echo', 'b', deps=['b.c'], outputs=[])
+        no_atexit()
+
+        # "echo b" is checked but up to date, which still counts as a use
+        builder = Builder(runner=ListRunner, quiet=True, depsname=depsname)
+        assert builder.deps.last_used('echo c') == 1
+        builder.run('echo', 'b', deps=['b.c'], outputs=[])
+        removed, reclaimed = builder.gc(1)
+        assert removed == 1 and reclaimed > 0
+        assert sorted(builder.deps) == ['echo a', 'echo b']
+        no_atexit()
+
+        builder = Builder(runner=ListRunner, quiet=True, depsname=depsname)
+        assert dict(builder.deps.generations()) == {'echo a': 2, 'echo b': 3}
+        assert builder.gc()[0] == 2
+        assert builder.generation == 4
+        assert list(builder.deps) == []
+        no_atexit()
+
+def test_deps_noop_touches(builddir, no_atexit, monkeypatch):
+    import json
+    monkeypatch.setattr(JsonDeps, 'compact_ratio', 100)
+    with local.cwd(builddir):
+        sources = ['s%d.c' % i for i in range(50)]
+        for name in sources:
+            with open(name, 'w') as f:
+                f.write(name)
+        def build(names):
+            builder = Builder(runner=ListRunner, quiet=True, journal=True)
+            for name in names:
+                builder.run('echo', name, deps=[name], outputs=[])
+            no_atexit()
+            return builder
+        build(sources)
+        assert not os.path.exists('.deps.journal')
+
+        # no-op builds append one short line each, not one naming every
+        # command they used
+        for generation in [2, 3, 4]:
+            build(sources)
+        with open('.deps.journal') as f:
+            lines = [json.loads(line) for line in f]
+        assert lines == [['.deps_reused', [1, 2]], ['.deps_reused', [2, 3]],
+                         ['.deps_reused', [3, 4]]]
+
+        # only commands the build before didn't use are listed
+        with open('new.c', 'w') as f:
+            f.write('new.c')
+        build(sources + ['new.c'])
+        with open('.deps.journal') as f:
+            lines = [json.loads(line) for line in f][3:]
+        assert [line[0] for line in lines] == ['echo new.c', '.deps_reused',
+                                               '.deps_used']
+        assert lines[1:] == [['.deps_reused', [4, 5]],
+                             ['.deps_used', {'echo new.c': 5}]]
+
+        # a build using fewer commands lists those it used
+        builder = build(sources[:2])
+        with open('.deps.journal') as f:
+            assert json.loads(f.readlines()[-1]) == \
+                ['.deps_used', {'echo s0.c': 6, 'echo s1.c': 6}]
+        builder = Builder(runner=ListRunner, quiet=True, journal=True)
+        generations = builder.deps.generations()
+        assert generations['echo s0.c'] == 6
+        assert generations['echo s2.c'] == 5
+        assert generations['echo new.c'] == 5
+        assert builder.gc(2)[0] == 0
+
+@pytest.mark.parametrize('depsname', ['.deps', '.deps.bin', '.deps.sqlite'])
+def test_digest_commands(builddir, no_atexit, depsname):
+    with local.cwd(builddir):
+        with open('a.o', 'w') as f:
+            f.write('a.o')
+        builder = Builder(runner=ListRunner, quiet=True, depsname=depsname,
+                          digest_commands=None)
+        builder.run('echo', 'ld', '-o', 'prog', 'a.o', deps=['a.o'], outputs=[])
+        assert list(builder.deps) == ['echo ld -o prog a.o']
+        no_atexit()
+
+        # entries keyed by the command line are re-keyed by its digest
+        builder = Builder(runner=ListRunner, quiet=True, depsname=depsname,
+                          digest_commands=10)
+        assert builder.run('echo', 'ld', '-o', 'prog', 'a.o', deps=['a.o'],
+                           outputs=[]) == ('echo ld -o prog a.o', None, None)
+        key = builder.deps_key('echo ld -o prog a.o')
+        assert key.startswith('md5:') and len(key) == 36
+        assert list(builder.deps) == [key]
+        builder.run('echo', 'ld', '-o', 'prog2', 'a.o', deps=['a.o'], outputs=[])
+        no_atexit()
+
+        builder = Builder(runner=ListRunner, quiet=True, depsname=depsname,
+                          digest_commands=10)
+        assert not builder.cmdline_outofdate('echo ld -o prog2 a.o')
+        assert builder.deps.name(builder.deps_key('echo ld -o prog2 a.o')) == \
+            'echo ld -o prog2 a.o'
+        assert sorted(builder.affected(['a.o'])) == \
+            ['echo ld -o prog a.o', 'echo ld -o prog2 a.o']
+        no_atexit()
+
+@pytest.mark.parametrize('depsname', ['.deps', '.deps.bin', '.deps.sqlite'])
+def test_sharded_deps(builddir, no_atexit, depsname):
+    with local.cwd(builddir):
+        for name in ['a.c', 'b.c']:
+            with open(name, 'w') as f:
+                f.write(name)
+        def compile(builder):
+            builder.run('echo', 'a', deps=['a.c'], outputs=[])
+        def link(builder):
+            builder.run('echo', 'b', deps=['b.c'], outputs=[])
+        builder = Builder(runner=ListRunner, quiet=True, depsname=depsname,
+                          shard='function')
+        compile(builder)
+        link(builder)
+        builder.run('echo', 'c', deps=['a.c'], outputs=[])
+        no_atexit()
+        assert not os.path.exists(depsname)
+        # the test function issued the last run()
+        assert ShardedDeps(depsname).shard_names() == \
+            ['compile', 'link', 'test_sharded_deps']
+
+        # only the shard of the command checked is loaded and saved
+        builder = Builder(runner=ListRunner, quiet=True, depsname=depsname,
+                          shard='function')
+        link_shard = os.path.join(depsname + '.shards', 'link.deps' +
+                                  os.path.splitext(depsname)[1])
+        mtime = os.path.getmtime(link_shard) - 10
+        os.utime(link_shard, (mtime, mtime))
+        compile(builder)
+        assert list(builder.deps.shards) == ['compile']
+        assert sorted(builder.affected(['a.c'])) == ['echo a', 'echo c']
+        no_atexit()
+        assert os.path.getmtime(link_shard) == mtime
+
+        # a build that only checks commands doesn't rewrite their shard
+        compile_shard = os.path.join(depsname + '.shards', 'compile.deps' +
+                                     os.path.splitext(depsname)[1])
+        with open(compile_shard, 'rb') as f:
+            contents = f.read()
+        os.utime(compile_shard, (mtime, mtime))
+        builder = Builder(runner=ListRunner, quiet=True, depsname=depsname,
+                          shard='function')
+        compile(builder)
+        generation = builder.generation
+        no_atexit()
+        if depsname != '.deps.sqlite':
+            # SQLite updates the generation in place, binary files too
+            if depsname == '.deps':
+                assert os.path.getmtime(compile_shard) == mtime
+                with open(compile_shard, 'rb') as f:
+                    assert f.read() == contents
+            assert os.path.getsize(compile_shard) == len(contents)
+        builder = Builder(runner=ListRunner, quiet=True, depsname=depsname,
+                          shard='function')
+        assert builder.deps.generations()['echo a'] == generation > 1
+        no_atexit()
+
+        builder = Builder(runner=ListRunner, quiet=True, depsname=depsname,
+                          shard='function')
+        assert not builder.cmdline_outofdate('echo c')
+        assert sorted(builder.deps) == ['echo a', 'echo b', 'echo c']
+        assert builder.gc()[0] == 2
+        no_atexit()
+        convert_deps_dest = 'single' + depsname
+        builder.deps.save(convert_deps_dest)
+        single = open_deps(convert_deps_dest)
+        single.load()
+        assert list(single) == ['echo c']
+        single.close()
+        builder.autoclean()
+        assert not os.path.exists(depsname + '.shards')
+
+def test_sharded_deps_methods(builddir, no_atexit):
+    with local.cwd(builddir):
+        with open('a.c', 'w') as f:
+            f.write('a.c')
+        class MyBuilder(Builder):
+            def compile(self):
+                self.run('echo', 'a', deps=['a.c'], outputs=[])
+            def link(self):
+                self.run('echo', 'b', deps=['a.c'], outputs=[])
+        # build steps written as methods of a Builder subclass name shards
+        builder = MyBuilder(runner=ListRunner, quiet=True, shard='function')
+        builder.compile()
+        builder.link()
+        no_atexit()
+        assert ShardedDeps('.deps').shard_names() == ['compile', 'link']
+
+FAKE_STRACE = r'''#!/bin/sh
+# just enough of strace to run a command and log what it reads and writes
+if [ "$1" = "-e" ] && [ $# -eq 2 ]; then
+    # probing what strace supports: STRACE_INVALID lists what it doesn't
+    echo "$2" >> strace.probes
+    for call in $STRACE_INVALID; do
+        case ",${2#trace=}," in
+        *,$call,*) echo "strace: invalid system call '$call'" >&2; exit 1;;
+        esac
+    done
+    exit 0
+fi
+options=
+while [ "$1" != "-fo" ]; do
+    options="$options $1"
+    shift
+done
+if [ "$2" = /dev/null ]; then
+    echo "$options" >> strace.probes
+fi
+for option in $STRACE_INVALID; do
+    case "$options " in
+    *" $option "*) echo "strace: invalid option -- '$option'" >&2; exit 1;;
+    esac
+done
+log=$2
+shift 4
+"$@"
+status=$?
+[ -n "$STRACE_FAIL" ] && exit 1
+{
+    echo "1 execve(\"/bin/$1\", [\"$1\"], 0x0 /* 0 vars */) = 0"
+    echo "1 openat(AT_FDCWD, \"a.c\", O_RDONLY) = 3"
+    echo "1 openat(AT_FDCWD, \"a.o\", O_WRONLY|O_CREAT|O_TRUNC, 0666) = 4"
+    echo "1 exit_group($status) = ?"
+} > "$log"
+exit $status
+'''
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='needs named pipes')
+def test_strace_stream(builddir, monkeypatch):
+    with local.cwd(builddir):
+        with open('strace', 'w') as f:
+            f.write(FAKE_STRACE)
+        os.chmod('strace', 0o755)
+        monkeypatch.setenv('PATH', os.getcwd() + os.pathsep + os.environ['PATH'])
+        with open('a.c', 'w') as f:
+            f.write('a.c')
+        runner = StraceRunner(Builder(runner=ListRunner, quiet=True))
+        assert runner('cp', 'a.c', 'a.o') == (['a.c'], ['a.o'])
+        with pytest.raises(ExecutionError):
+            runner('false')
+        # strace failing before it opens the pipe doesn't hang the reader
+        monkeypatch.setenv('STRACE_FAIL', '1')
+        with pytest.raises(ExecutionError):
+            runner('true')
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='needs named pipes')
+def test_strace_parser(builddir, monkeypatch):
+    with local.cwd(builddir):
+        with open('strace', 'w') as f:
+            f.write(FAKE_STRACE)
+        os.chmod('strace', 0o755)
+        monkeypatch.setenv('PATH', os.getcwd() + os.pathsep + os.environ['PATH'])
+        for name in ['a.c', 'sub/b.h', 'sub/new', 'sub/link', 'out', 'd']:
+            if os.path.dirname(name) and not os.path.exists('sub'):
+                os.mkdir('sub')
+            with open(name, 'w') as f:
+                f.write(name)
+        runner = StraceRunner(Builder(runner=ListRunner, quiet=True))
+        log = b'''\
+1  execve("/bin/sh", ["sh"], 0x7ffd /* 1 var */) = 0
+1  openat(AT_FDCWD, "a.c", O_RDONLY <unfinished ...>
+2  chdir("sub") = 0
+1  <... openat resumed>) = 3
+1  clone(child_stack=NULL, flags=SIGCHLD) = 2
+2  open("b.h", O_RDONLY) = 4
+2  stat("missing.h", 0x7ffd) = -1 ENOENT (No such file or directory)
+2  rename("tmp", "new") = 0
+2  symlink("b.h", "link") = 0
+1  creat("out", 0644) = 5
+1  mkdir("d", 0777) = -1 EEXIST (File exists)
+1  --- SIGCHLD {si_signo=SIGCHLD} ---
+2  +++ exited with 0 +++
+1  exit_group(3) = ?
+'''
+        status, deps, outputs = runner._parse(log.splitlines(True))
+        assert status == 3
+        # chdir("sub") was delayed until the clone that made process 2
+        assert sorted(deps) == ['a.c', 'd', os.path.join('sub', 'b.h')]
+        assert sorted(outputs) == ['out', os.path.join('sub', 'link'),
+                                   os.path.join('sub', 'new')]
+
+def test_strace_path_cache(builddir, monkeypatch):
+    with local.cwd(builddir):
+        with open('strace', 'w') as f:
+            f.write(FAKE_STRACE)
+        os.chmod('strace', 0o755)
+        monkeypatch.setenv('PATH', os.getcwd() + os.pathsep + os.environ['PATH'])
+        for name in ['src/a.h', 'src/.svn/b.h', 'srcother/c.h']:
+            if not os.path.exists(os.path.dirname(name)):
+                os.makedirs(os.path.dirname(name))
+            with open(name, 'w') as f:
+                f.write(name)
+        builder = Builder(runner=ListRunner, dirs=['src'], quiet=True)
+        # dirs only match whole path components
+        assert builder._is_relevant('src/a.h')
+        assert builder._is_relevant('src')
+        assert not builder._is_relevant('src/.svn/b.h')
+        assert not builder._is_relevant('srcother/c.h')
+
+        runner = StraceRunner(builder)
+        log = b'''\
+1  execve("/bin/sh", ["sh"], 0x7ffd /* 1 var */) = 0
+1  open("src/a.h", O_RDONLY) = 3
+1  open("src/new.h", O_RDONLY) = -1 ENOENT (No such file or directory)
+1  open("src/.svn/b.h", O_RDONLY) = 3
+1  open("srcother/c.h", O_RDONLY) = 3
+1  exit_group(0) = ?
+'''
+        status, deps, outputs = runner._parse(log.splitlines(True))
+        assert sorted(deps) == [os.path.join('src', 'a.h')]
+        assert runner._paths[('.', b'src/a.h')][2]
+
+        # whether files exist isn't remembered, so they're seen once made,
+        # and not once deleted
+        with open('src/new.h', 'w') as f:
+            f.write('new')
+        status, deps, outputs = runner._parse(log.splitlines(True))
+        assert sorted(deps) == [os.path.join('src', 'a.h'),
+                                os.path.join('src', 'new.h')]
+        os.remove('src/new.h')
+        status, deps, outputs = runner._parse(log.splitlines(True))
+        assert sorted(deps) == [os.path.join('src', 'a.h')]
+
+        # parallel jobs share their worker process's caches
+        import pickle
+        job = pickle.loads(pickle.dumps(runner))
+        job._parse(log.splitlines(True))
+        assert ('.', b'src/a.h') in job._paths
+        job = pickle.loads(pickle.dumps(runner))
+        assert ('.', b'src/a.h') in job._path_caches[os.getcwd()]
+        assert pickle.loads(pickle.dumps(StraceRunner(builder))) \
+            ._path_caches == {}
+
+        # names are resolved against the directory the build script is in
+        os.mkdir('other')
+        with local.cwd('other'):
+            status, deps, outputs = runner._parse(log.splitlines(True))
+            assert deps == []
+            os.mkdir('src')
+            with open('src/a.h', 'w') as f:
+                f.write('other')
+            status, deps, outputs = runner._parse(log.splitlines(True))
+            assert deps == [os.path.join('src', 'a.h')]
+            assert builder._is_relevant('src/a.h')
+        status, deps, outputs = runner._parse(log.splitlines(True))
+        assert deps == [os.path.join('src', 'a.h')]
+
+def test_strace_probe_cache(builddir, monkeypatch):
+    with local.cwd(builddir):
+        with open('strace', 'w') as f:
+            f.write(FAKE_STRACE)
+        os.chmod('strace', 0o755)
+        monkeypatch.setenv('PATH', os.getcwd() + os.pathsep + os.environ['PATH'])
+        monkeypatch.setenv('STRACE_INVALID', 'stat64 lstat64 -qq')
+        monkeypatch.setattr(StraceRunner, 'probe_cache',
+                            os.path.abspath('cache/strace.json'))
+        monkeypatch.setattr(StraceRunner, '_probed', {})
+        def probes():
+            with open('strace.probes') as f:
+                return len(f.readlines())
+
+        calls = StraceRunner.get_strace_system_calls().split(',')
+        assert 'stat64' not in calls and 'lstat64' not in calls
+        assert 'openat' in calls and len(calls) == 14
+        # one run with all the calls, then one per call it didn't know,
+        # then one per option (mkdir's EEXIST failures are needed, so failed
+        # calls are never filtered out)
+        assert probes() == 6
+        options = ['--seccomp-bpf', '-e', 'signal=none']
+        assert StraceRunner.get_strace_options() == options
+        assert StraceRunner(Builder(runner=ListRunner)).strace_options == options
+        assert probes() == 6
+
+        # a new process reads the cache instead of running strace
+        monkeypatch.setattr(StraceRunner, '_probed', {})
+        assert StraceRunner.get_strace_system_calls().split(',') == calls
+        assert StraceRunner.get_strace_options() == options
+        assert probes() == 6
+
+        # a different strace is probed again
+        monkeypatch.setattr(StraceRunner, '_probed', {})
+        monkeypatch.setenv('STRACE_INVALID', '')
+        with open('strace', 'a') as f:
+            f.write('# upgraded\n')
+        assert len(StraceRunner.get_strace_system_calls().split(',')) == 16
+        assert len(StraceRunner.get_strace_options()) == 4
+        assert probes() == 10
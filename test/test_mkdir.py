@@ -51,6 +51,7 @@ def test_mkdir(builddir, runner):
 
     expected_json = {
         ".deps_version": 2,
+        ".deps_hasher": "md5",
         "mkdir -p existingdir/a": {
             "existingdir": "input-ae394c47b4ccf49007dc9ec847f657b9",
             "existingdir/a": "output-16873f5a4ba5199a8b51f812d159e37e"
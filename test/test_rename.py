@@ -35,6 +35,7 @@ def test_rename(builddir, runner):
 
     expected_json = {
         ".deps_version": 2,
+        ".deps_hasher": "md5",
         "mv originalfile testfile": {
             "originalfile": "input-d41d8cd98f00b204e9800998ecf8427e",
             "testfile": "output-d41d8cd98f00b204e9800998ecf8427e"
@@ -55,6 +56,7 @@ def test_rename(builddir, runner):
 
     expected_json = {
         ".deps_version": 2,
+        ".deps_hasher": "md5",
         "mv originalfile testfile": {
             "originalfile": "input-321060ae067e2a25091be3372719e053",
             "testfile": "output-321060ae067e2a25091be3372719e053"
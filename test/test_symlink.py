@@ -29,6 +29,7 @@ def test_symlink(builddir, runner):
 
     expected_json = {
         ".deps_version": 2,
+        ".deps_hasher": "md5",
         "ln -s nofile testlink_nofile": {
             "testlink_nofile": "output-"
         },